@@ -0,0 +1,153 @@
+"""
+This module contains functions for analysing acquisition level data from DoseTrack, i.e. exports with one row per
+irradiation event (run) instead of one row per procedure.
+These exports can have tens of millions of rows, so the files are read in chunks and each chunk is reduced to one
+row per accession number with grouped NumPy operations before the chunks are combined.
+
+-------------------------------- DoseTrack acquisition level data: --------------------------------
+The names of the columns in the acquisition level export are set in the constants below, and must be changed if the
+export uses other names. The following columns are required:
+Accession Number
+Irradiation Event Type:         The type of each run. The types in FLUOROSCOPY_EVENT_TYPES are counted as
+                                fluoroscopy, all other types (e.g. 'Stationary Acquisition') as acquisition.
+Dose Area Product (Gy*cm2):     The DAP of each run.
+Dose (RP) (mGy):                The cumulative air kerma (CAK) at the reference point of each run.
+-------------------------------------------------------------------------------------
+
+-------------------------------- Functions: --------------------------------
+calc_acquisition_statistics_per_accession:  Calculates the number of runs, the fluoroscopy and acquisition DAP and
+                                            the peak CAK of a single run for each accession number, from a dataframe
+                                            or directly from a CSV or xlsx file read in chunks.
+
+summarize_acquisition_statistics:           Calculates the distributions (median, IQR etc.) of the values per
+                                            accession number, for all procedures or per group (e.g. procedure),
+                                            using reporting_module.calc_statistics.
+-------------------------------------------------------------------------------------
+"""
+
+import time
+import numpy as np
+import pandas as pd
+import dt_ids7_export_module as bh_utils
+import reporting_module as bh_report
+
+# The names of the columns in the acquisition level export:
+ACCESSION_COLUMN = 'Accession Number'
+EVENT_TYPE_COLUMN = 'Irradiation Event Type'
+EVENT_DAP_COLUMN = 'Dose Area Product (Gy*cm2)'
+EVENT_CAK_COLUMN = 'Dose (RP) (mGy)'
+
+# The event types that are counted as fluoroscopy:
+FLUOROSCOPY_EVENT_TYPES = ['Fluoroscopy']
+
+# How the values per accession number of each chunk are combined:
+ACQUISITION_AGGREGATION = {'Number of runs': 'sum',
+                           'Number of fluoroscopy runs': 'sum',
+                           'Number of acquisition runs': 'sum',
+                           'Fluoroscopy DAP (Gy*cm2)': 'sum',
+                           'Acquisition DAP (Gy*cm2)': 'sum',
+                           'Peak run CAK (mGy)': 'max'}
+
+def _reduce_events(df_events):
+    """
+    This utility function reduces a dataframe with one row per run to one row per accession number.
+    The accession numbers are converted to integer codes once, and all the values are then calculated with
+    np.bincount (counts and sums) and np.fmax.reduceat on the rows sorted by code (peak CAK, missing values ignored).
+    Rows without an accession number are ignored.
+    Returns a dataframe indexed by accession number with the columns in ACQUISITION_AGGREGATION.
+    """
+    codes, accessions = pd.factorize(df_events[ACCESSION_COLUMN])
+    has_accession = codes >= 0
+    codes = codes[has_accession]
+    n_accessions = len(accessions)
+
+    fluoroscopy = df_events[EVENT_TYPE_COLUMN].isin(FLUOROSCOPY_EVENT_TYPES).to_numpy()[has_accession]
+    dap = pd.to_numeric(df_events[EVENT_DAP_COLUMN], errors='coerce').to_numpy(dtype=float)[has_accession]
+    cak = pd.to_numeric(df_events[EVENT_CAK_COLUMN], errors='coerce').to_numpy(dtype=float)[has_accession]
+    dap = np.nan_to_num(dap)
+
+    n_runs = np.bincount(codes, minlength=n_accessions)
+    n_fluoroscopy_runs = np.bincount(codes, weights=fluoroscopy, minlength=n_accessions).astype(np.int64)
+    fluoroscopy_dap = np.bincount(codes, weights=np.where(fluoroscopy, dap, 0), minlength=n_accessions)
+    acquisition_dap = np.bincount(codes, weights=np.where(fluoroscopy, 0, dap), minlength=n_accessions)
+
+    # The peak CAK is found per block of rows with the same code, after sorting the rows by code:
+    peak_cak = np.full(n_accessions, np.nan)
+    if n_accessions > 0:
+        order = np.argsort(codes, kind='stable')
+        starts = np.searchsorted(codes[order], np.arange(n_accessions))
+        with np.errstate(invalid='ignore'):
+            peak_cak = np.fmax.reduceat(cak[order], starts)
+
+    return pd.DataFrame({'Number of runs': n_runs,
+                         'Number of fluoroscopy runs': n_fluoroscopy_runs,
+                         'Number of acquisition runs': n_runs - n_fluoroscopy_runs,
+                         'Fluoroscopy DAP (Gy*cm2)': fluoroscopy_dap,
+                         'Acquisition DAP (Gy*cm2)': acquisition_dap,
+                         'Peak run CAK (mGy)': peak_cak},
+                        index=pd.Index(accessions, name=ACCESSION_COLUMN))
+
+def calc_acquisition_statistics_per_accession(data, chunk_size=1_000_000, sep=',', decimal='.', verbose=True):
+    """
+    This function calculates the following values for each accession number from acquisition level DoseTrack data:
+    Number of runs, Number of fluoroscopy runs, Number of acquisition runs,
+    Fluoroscopy DAP (Gy*cm2), Acquisition DAP (Gy*cm2), Fluoroscopy DAP fraction and Peak run CAK (mGy).
+    data is either a dataframe with one row per run, or the path to a CSV or xlsx export, which is then read in
+    chunks of chunk_size rows, so that only the columns needed and one chunk of rows are in memory at a time.
+    sep and decimal are passed to pandas.read_csv for CSV files.
+    Returns a dataframe with one row per accession number.
+    """
+    columns = [ACCESSION_COLUMN, EVENT_TYPE_COLUMN, EVENT_DAP_COLUMN, EVENT_CAK_COLUMN]
+    start = time.perf_counter()
+    if isinstance(data, pd.DataFrame):
+        chunks = [data]
+        source = 'DoseTrack'
+    else:
+        chunks = bh_utils._iter_export_chunks(data, columns=columns, chunk_size=chunk_size, sep=sep, decimal=decimal)
+        source = str(data)
+
+    partials = []
+    n_rows = 0
+    for chunk in chunks:
+        if n_rows == 0 and not all(bh_utils._check_for_column(chunk, source, column) for column in columns):
+            print('The names of the columns can be changed in the constants at the top of acquisition_module.')
+            print('\n')
+            return None
+        n_rows += len(chunk)
+        partials.append(_reduce_events(chunk))
+
+    if len(partials) == 0:
+        print('WARNING: There are no runs in ' + source + '.')
+        return None
+
+    # Combine the chunks, an accession number can have runs in more than one chunk:
+    if len(partials) == 1:
+        per_accession = partials[0]
+    else:
+        per_accession = pd.concat(partials).groupby(level=0, sort=False).agg(ACQUISITION_AGGREGATION)
+
+    total_dap = per_accession['Fluoroscopy DAP (Gy*cm2)'] + per_accession['Acquisition DAP (Gy*cm2)']
+    per_accession.insert(5, 'Fluoroscopy DAP fraction', per_accession['Fluoroscopy DAP (Gy*cm2)'] / total_dap.where(total_dap > 0))
+    per_accession = per_accession.reset_index()
+
+    if verbose:
+        print('Reduced {} runs to {} accession numbers in {:.2f} s.'.format(n_rows, len(per_accession), time.perf_counter() - start))
+    return per_accession
+
+def summarize_acquisition_statistics(per_accession, data=None, by=None, ci=False, seed=None):
+    """
+    This function calculates the distribution (n, median, IQR and range, and optionally the confidence interval of
+    the median) over the accession numbers of each value from calc_acquisition_statistics_per_accession.
+    To get the distributions per procedure or per lab, pass the merged data as data and the column to group by as by,
+    e.g. by='Mapped Procedures'. The data is then joined to the values on 'Accession Number'.
+    Returns the table from reporting_module.calc_statistics.
+    """
+    metrics = [column for column in per_accession.columns if column != ACCESSION_COLUMN]
+    if by is not None:
+        if data is None or not bh_utils._check_for_column(data, 'Merged', by):
+            print('Without the merged data with the column ' + str(by) + ', the values can not be grouped.')
+            print('\n')
+            return None
+        per_accession = per_accession.merge(data[['Accession Number', by]].drop_duplicates('Accession Number'),
+                                            left_on=ACCESSION_COLUMN, right_on='Accession Number', how='inner')
+    return bh_report.calc_statistics(per_accession, metrics, by=by, ci=ci, seed=seed)
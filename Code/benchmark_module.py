@@ -0,0 +1,208 @@
+"""
+This module contains functions for benchmarking the other modules on synthetic data.
+The synthetic data mimics the exports from IDS7 and DoseTrack, but contains no patient information,
+so the benchmarks can be run anywhere and shared freely.
+
+-------------------------------- Synthetic data: --------------------------------
+make_synthetic_descriptions:    Makes a list of unique descriptions (column: 'Beskrivelse') by combining the
+                                criteria used in a mapping dictionary, in the same way as the IDS7 export
+                                concatenates several procedure codes separated by a comma.
+make_synthetic_exports:         Makes a cleaned IDS7 export and a DoseTrack export with matching accession numbers,
+                                with the columns used by dt_ids7_export_module.merge_ids7_dt.
+-------------------------------------------------------------------------------------
+
+-------------------------------- Benchmarks: --------------------------------
+benchmark_map_procedures:       Compares the row-level mapping (compiled=False) with the mapping on unique
+                                descriptions (compiled=True) in mapping_module.map_procedures.
+benchmark_merge_ids7_dt:        Compares the concatenation of the descriptions per accession number with the Python
+                                aggregator _concatenate_protocol with the sort-then-join used in merge_ids7_dt,
+                                and times the whole merge.
+benchmark_partitioned_pipeline: Times parallel_module.run_partitioned_pipeline with 1 to N processes against the
+                                serial run_all_cleanup_filters_and_checks and merge_ids7_dt, and reports the speedup.
+-------------------------------------------------------------------------------------
+"""
+
+import io
+import os
+import time
+import contextlib
+import numpy as np
+import pandas as pd
+import mapping_module as bh_map
+import dt_ids7_export_module as bh_utils
+import parallel_module as bh_parallel
+
+def make_synthetic_descriptions(mapping, n_unique=3000, seed=0):
+    """
+    This function makes a list of n_unique descriptions from the criteria in the mapping dictionary.
+    Each description consists of one to three criteria separated by a comma, some in upper or lower case,
+    so that both inclusion and exclusion criteria are triggered.
+    """
+    rng = np.random.default_rng(seed)
+
+    # Collect all the criteria in the mapping dictionary, without the '~' and '&' characters:
+    criteria = set()
+    for key in mapping.keys():
+        for criterion in key.split(' & '):
+            criterion = criterion.replace('~', '').replace('&', '').strip()
+            if criterion:
+                criteria.add(criterion)
+    criteria = sorted(criteria) + ['UL Veiledning', 'Annen prosedyre']
+
+    descriptions = set()
+    while len(descriptions) < n_unique:
+        picked = rng.choice(len(criteria), rng.integers(1, 4), replace=False)
+        description = ', '.join(criteria[i] for i in picked)
+        if rng.random() < 0.2:
+            description = description.upper() if rng.random() < 0.5 else description.lower()
+        # Add a number to make the description unique if we run out of combinations:
+        if description in descriptions:
+            description = description + ' ' + str(len(descriptions))
+        descriptions.add(description)
+    return sorted(descriptions)
+
+def make_synthetic_exports(n_rows=500_000, descriptions=None, seed=0):
+    """
+    This function makes a synthetic IDS7 export with n_rows rows and a DoseTrack export with matching accession numbers.
+    Each accession number has one to three rows (procedure codes) in IDS7, and about 90 % of them are found in
+    DoseTrack with one or two rows each. The exports look like they have been through the cleanup filters and checks,
+    i.e. they have the columns 'Henvisning_i_dt' and 'Henvisning_i_ids7'.
+    If descriptions is None, 300 generic descriptions are used.
+    Returns the IDS7 and the DoseTrack dataframes.
+    """
+    rng = np.random.default_rng(seed)
+    if descriptions is None:
+        descriptions = ['Prosedyre ' + str(i) for i in range(300)]
+    descriptions = np.array(descriptions, dtype=object)
+    rooms = np.array(['Lab 1', 'Lab 2', 'Lab 3', 'Lab 4', 'Lab 5'], dtype=object)
+
+    # One to three IDS7 rows per accession number:
+    rows_per_accession = rng.integers(1, 4, n_rows)
+    n_accessions = np.searchsorted(np.cumsum(rows_per_accession), n_rows) + 1
+    accession_index = np.repeat(np.arange(n_accessions), rows_per_accession[:n_accessions])[:n_rows]
+    accession_numbers = pd.Series(np.arange(n_accessions)).map('NRRH{:012d}'.format).to_numpy(dtype=object)
+    booked = pd.Timestamp('2023-01-01') + pd.to_timedelta(rng.integers(0, 60*24*365, n_accessions), unit='min')
+    in_dt = rng.random(n_accessions) < 0.9
+
+    df_ids7 = pd.DataFrame({'Pasient': pd.Series(accession_index // 2).map('PAS{:07d}'.format),
+                            'Bestilt dato og tidspunkt': booked[accession_index],
+                            'Henvisnings-ID': accession_numbers[accession_index],
+                            'Beskrivelse': descriptions[rng.integers(0, len(descriptions), n_rows)],
+                            'Kjønn': np.where(accession_index % 4 < 2, 'K', 'M'),
+                            'Rom/modalitet (RIS)': rooms[accession_index % len(rooms)],
+                            'Henvisning_i_dt': in_dt[accession_index]})
+
+    # One or two DoseTrack rows per accession number that is found in DoseTrack:
+    dt_accessions = np.flatnonzero(in_dt)
+    dt_index = np.repeat(dt_accessions, rng.integers(1, 3, len(dt_accessions)))
+    n_dt = len(dt_index)
+    df_dt = pd.DataFrame({'Accession Number': accession_numbers[dt_index],
+                          'Study Date': booked[dt_index].normalize(),
+                          'Age (Years)': rng.integers(1, 90, n_accessions)[dt_index],
+                          'DAP Total (Gy*cm2)': rng.gamma(2, 10, n_dt),
+                          'CAK (mGy)': rng.gamma(2, 100, n_dt),
+                          'F+A Time (s)': rng.gamma(2, 200, n_dt),
+                          'Modality Room': rooms[dt_index % len(rooms)],
+                          'Henvisning_i_ids7': True})
+    return df_ids7, df_dt
+
+def _time_call(function, *args, **kwargs):
+    """
+    This utility function calls the function with the printed output suppressed.
+    Returns the result and the wall time in seconds.
+    """
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def benchmark_map_procedures(mapping, n_rows=1_000_000, n_unique=3000, seed=0, run_row_level=True):
+    """
+    This function benchmarks mapping_module.map_procedures on a synthetic export with n_rows rows and
+    n_unique unique descriptions. The row-level path (compiled=False) is slow on large datasets,
+    and can be skipped by passing run_row_level=False.
+    Returns a dataframe with the time and the memory usage of the 'Mapped Procedures' column for each path.
+    """
+    rng = np.random.default_rng(seed)
+    descriptions = np.array(make_synthetic_descriptions(mapping, n_unique=n_unique, seed=seed), dtype=object)
+    df_data = pd.DataFrame({'Beskrivelse': descriptions[rng.integers(0, len(descriptions), n_rows)]})
+    print('Synthetic export: {} rows, {} unique descriptions, {} mapping keys.'.format(n_rows, len(descriptions), len(mapping)))
+
+    results = []
+    paths = [('Unique descriptions', True)]
+    if run_row_level:
+        paths.insert(0, ('Row level', False))
+
+    mapped = {}
+    for name, compiled in paths:
+        df_mapped, seconds = _time_call(bh_map.map_procedures, df_data.copy(), mapping, compiled=compiled)
+        mapped[name] = df_mapped['Mapped Procedures']
+        memory = df_mapped['Mapped Procedures'].memory_usage(deep=True) / 1024**2
+        results.append({'Path': name, 'Time (s)': seconds, 'Memory (MB)': memory})
+        print('{:20}: {:8.2f} s, Mapped Procedures uses {:8.1f} MB'.format(name, seconds, memory))
+
+    if run_row_level:
+        identical = (mapped['Row level'].astype(str) == mapped['Unique descriptions'].astype(str)).all()
+        print('The two paths give identical mappings: {}'.format(identical))
+
+    return pd.DataFrame(results)
+
+def benchmark_merge_ids7_dt(n_rows=500_000, seed=0):
+    """
+    This function benchmarks dt_ids7_export_module.merge_ids7_dt on synthetic exports with n_rows IDS7 rows.
+    The concatenation of the descriptions per accession number is timed both with the Python aggregator
+    _concatenate_protocol (one call per accession number) and with the sort-then-join on the whole dataframe
+    (_join_sorted_groups) used in merge_ids7_dt, and the results are compared. Finally the whole merge is timed.
+    Returns a dataframe with the time for each step.
+    """
+    df_ids7, df_dt = make_synthetic_exports(n_rows=n_rows, seed=seed)
+    print('Synthetic exports: {} IDS7 rows, {} DoseTrack rows.'.format(len(df_ids7), len(df_dt)))
+
+    df_in_dt = df_ids7[df_ids7['Henvisning_i_dt'] == True]
+    python_agg, python_seconds = _time_call(lambda: df_in_dt.groupby('Henvisnings-ID')['Beskrivelse'].agg(bh_utils._concatenate_protocol))
+    joined, join_seconds = _time_call(lambda: bh_utils._join_sorted_groups(df_in_dt.sort_values(['Henvisnings-ID', 'Beskrivelse']),
+                                                                           ['Henvisnings-ID'], 'Beskrivelse'))
+    _, merge_seconds = _time_call(bh_utils.merge_ids7_dt, df_ids7, df_dt)
+
+    identical = (joined.set_index('Henvisnings-ID')['Beskrivelse'].reindex(python_agg.index) == python_agg).all()
+    results = pd.DataFrame({'Step': ['Concatenation with _concatenate_protocol', 'Concatenation with sort and join', 'merge_ids7_dt'],
+                            'Time (s)': [python_seconds, join_seconds, merge_seconds]})
+    for _, row in results.iterrows():
+        print('{:42}: {:8.2f} s'.format(row['Step'], row['Time (s)']))
+    print('Speedup of the concatenation: {:.1f}x'.format(python_seconds / join_seconds))
+    print('The two concatenations are identical: {}'.format(identical))
+    return results
+
+def benchmark_partitioned_pipeline(n_rows=500_000, max_workers=None, n_partitions=None, seed=0):
+    """
+    This function benchmarks parallel_module.run_partitioned_pipeline on synthetic exports with n_rows IDS7 rows,
+    with 1, 2, 4, ... up to max_workers processes (default is the number of CPUs), against the serial
+    run_all_cleanup_filters_and_checks followed by merge_ids7_dt. n_partitions is passed on (default is one
+    partition per process). The results of each run are compared with the serial result.
+    Returns a dataframe with the time, the speedup and the efficiency (speedup per process) for each number of processes.
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    df_ids7, df_dt = make_synthetic_exports(n_rows=n_rows, seed=seed)
+    df_ids7 = df_ids7.drop('Henvisning_i_dt', axis=1)
+    df_dt = df_dt.drop('Henvisning_i_ids7', axis=1)
+    print('Synthetic exports: {} IDS7 rows, {} DoseTrack rows, {} CPUs.'.format(len(df_ids7), len(df_dt), os.cpu_count()))
+
+    def serial():
+        df_dt_serial = df_dt.copy()
+        df_ids7_serial = bh_utils.run_all_cleanup_filters_and_checks(df_ids7.copy(), df_dt_serial)
+        return bh_utils.merge_ids7_dt(df_ids7_serial, df_dt_serial)
+    serial_data, serial_seconds = _time_call(serial)
+    print('{:12}: {:8.2f} s'.format('Serial', serial_seconds))
+
+    n_workers_list = sorted(set([2**i for i in range(int(np.log2(max_workers)) + 1)] + [max_workers]))
+    results = [{'Processes': 0, 'Time (s)': serial_seconds, 'Speedup': 1.0, 'Efficiency': np.nan, 'Identical': True}]
+    for n_workers in n_workers_list:
+        (_, _, data), seconds = _time_call(bh_parallel.run_partitioned_pipeline, df_ids7, df_dt,
+                                           n_partitions=n_partitions, n_workers=n_workers)
+        identical = data.equals(serial_data)
+        results.append({'Processes': n_workers, 'Time (s)': seconds, 'Speedup': serial_seconds / seconds,
+                        'Efficiency': serial_seconds / seconds / n_workers, 'Identical': identical})
+        print('{:2} processes: {:8.2f} s, speedup {:5.2f}x, identical to the serial result: {}'.format(
+            n_workers, seconds, serial_seconds / seconds, identical))
+    return pd.DataFrame(results)
@@ -0,0 +1,633 @@
+"""
+This module contains functions for storing the cleaned IDS7 and DoseTrack data, and the merged data,
+as partitioned parquet datasets. This way each analysis can load only the partitions and columns it needs,
+instead of reading and cleaning all the Excel exports again.
+The parquet files are written and read with pyarrow, which must be installed.
+
+-------------------------------- Datasets: --------------------------------
+Each dataset is stored in its own folder in the store folder:
+ids7:       The cleaned IDS7 data (output of dt_ids7_export_module.run_all_cleanup_filters_and_checks).
+            Partitioned by the year and month of 'Bestilt dato og tidspunkt'.
+dt:         The DoseTrack data (with the column 'Henvisning_i_ids7').
+            Partitioned by the year and month of 'Study Date' and by 'Modality Room'.
+merged:     The merged data (output of dt_ids7_export_module.merge_ids7_dt, optionally with 'Mapped Procedures').
+            Partitioned by the year and month of 'Study Date' and by 'Modality Room'.
+
+The partition columns are named Year, Month and Room. Rows without a date are put in Year = 0, Month = 0,
+and rows without a room are put in Room = 'Unknown'. The original columns are stored unchanged.
+-------------------------------------------------------------------------------------
+
+-------------------------------- Functions: --------------------------------
+save_dataset:       Stores a dataframe as one of the datasets, replacing the dataset if it exists.
+
+load_dataset:       Loads a dataset. Only the given columns are read, and filters on the partition columns
+                    (e.g. [('Year', '>=', 2023), ('Room', '==', 'RRH_XA1')]) only read the matching partitions.
+
+save_cleaned_data:  Stores the cleaned IDS7, DoseTrack and merged data in one call.
+
+upsert_dataset:     Replaces the stored rows with the same key (e.g. 'Accession Number') as the new rows.
+                    Only the partitions holding these keys, or receiving new rows, are rewritten.
+-------------------------------------------------------------------------------------
+
+-------------------------------- Out-of-core merge: --------------------------------
+merge_out_of_core:  Merges IDS7 and DoseTrack data that do not fit in memory together (e.g. many years of exports)
+                    and stores the result as the dataset 'merged'. Both inputs are read in chunks and split by a hash
+                    of the accession number into buckets on disk, so all the rows of an accession number end up in
+                    the same bucket. The buckets are then merged one at a time with merge_ids7_dt and written to the
+                    dataset, so the peak memory depends on the size of a bucket and not on the length of the history.
+-------------------------------------------------------------------------------------
+
+-------------------------------- Incremental update: --------------------------------
+append_new_exports: Adds new monthly IDS7 and DoseTrack exports to the store, without importing and cleaning
+                    the history again. The new IDS7 rows are filtered with the same filters as in
+                    run_all_cleanup_filters_and_checks. The accession numbers are then reconciled
+                    (check_accession_ids7_vs_dt, overwrite_duplicated_accession_numbers and check_accession_dt_vs_ids7)
+                    together with the stored history of the affected patients, so duplicates across months are
+                    still caught. Finally the affected accession numbers are merged and upserted in the stored data.
+-------------------------------------------------------------------------------------
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+import dt_ids7_export_module as bh_utils
+import mapping_module as bh_map
+
+# The column with the date and room used for partitioning each dataset:
+DATASETS = {'ids7':   {'date': 'Bestilt dato og tidspunkt', 'room': None},
+            'dt':     {'date': 'Study Date', 'room': 'Modality Room'},
+            'merged': {'date': 'Study Date', 'room': 'Modality Room'}}
+
+PARTITION_COLUMNS = ['Year', 'Month', 'Room']
+
+# The dtypes used when storing the datasets. Columns not listed here are stored with their current dtype.
+# Text columns with few unique values are stored as category, the rest as string:
+DTYPES = {'Henvisnings-ID': 'string',
+          'Accession Number': 'string',
+          'Pasient': 'string',
+          'Beskrivelse': 'string',
+          'Kjønn': 'category',
+          'Avbrutt': 'category',
+          'Henvisningskategori (RIS)': 'category',
+          'Rom/modalitet (RIS)': 'category',
+          'Modality Room': 'category',
+          'Mapped Procedures': 'category',
+          'Source_File': 'category',
+          'Bestilt dato og tidspunkt': 'datetime64[ns]',
+          'Study Date': 'datetime64[ns]',
+          'Age (Years)': 'float64',
+          'DAP Total (Gy*cm2)': 'float64',
+          'CAK (mGy)': 'float64',
+          'F+A Time (s)': 'float64',
+          'Henvisning_i_dt': 'bool',
+          'Henvisning_i_ids7': 'bool'}
+
+# Utility functions:
+def _check_dataset_name(name):
+    """
+    This utility function checks that the name is one of the known datasets.
+    """
+    if name not in DATASETS:
+        print('WARNING: Unknown dataset "' + str(name) + '". Use one of: ' + ', '.join(DATASETS.keys()))
+        return False
+    return True
+
+def _apply_dtypes(df):
+    """
+    This utility function converts the columns of the dataframe to the dtypes in DTYPES.
+    """
+    dtypes = {column: dtype for column, dtype in DTYPES.items() if column in df.columns}
+    for column, dtype in dtypes.items():
+        if dtype.startswith('datetime64'):
+            df[column] = pd.to_datetime(df[column]).astype(dtype)
+        elif dtype == 'bool':
+            df[column] = df[column].fillna(False).astype(bool)
+        else:
+            df[column] = df[column].astype(dtype)
+    return df
+
+def _add_partition_columns(df, name):
+    """
+    This utility function adds the partition columns Year, Month and Room to a copy of the dataframe.
+    """
+    df = _apply_dtypes(df.copy())
+    date_column = DATASETS[name]['date']
+    room_column = DATASETS[name]['room']
+
+    if date_column in df.columns:
+        df['Year'] = df[date_column].dt.year.fillna(0).astype('int32')
+        df['Month'] = df[date_column].dt.month.fillna(0).astype('int32')
+    else:
+        print('WARNING: The column "' + date_column + '" does not exist, all rows are stored in Year = 0 and Month = 0.')
+        df['Year'] = 0
+        df['Month'] = 0
+
+    if room_column is not None and room_column in df.columns:
+        df['Room'] = df[room_column].astype('string').fillna('Unknown')
+    else:
+        df['Room'] = 'Unknown'
+    return df
+
+def _dataset_path(store_folder, name):
+    """
+    This utility function returns the path to the folder of a dataset.
+    """
+    return os.path.join(store_folder, name)
+
+def _temporary_folder(path):
+    """
+    This utility function creates an empty folder next to path (path + '.tmp'), for writing a new version of a dataset.
+    """
+    temp_path = path + '.tmp'
+    if os.path.exists(temp_path):
+        shutil.rmtree(temp_path)
+    os.makedirs(temp_path)
+    return temp_path
+
+def _swap_folder(new_path, path):
+    """
+    This utility function replaces the folder path with the folder new_path. The old folder is first renamed to
+    path + '.old' and only deleted after new_path has been moved into place.
+    """
+    old_path = path + '.old'
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+    if os.path.exists(path):
+        os.replace(path, old_path)
+    os.replace(new_path, path)
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+
+def save_dataset(df, store_folder, name, verbose=False):
+    """
+    This function stores the dataframe as the dataset with the given name ('ids7', 'dt' or 'merged')
+    in the store folder, partitioned by Year, Month and Room. An existing dataset with the same name is replaced.
+    """
+    if not _check_dataset_name(name):
+        return
+
+    path = _dataset_path(store_folder, name)
+    df_store = _add_partition_columns(df, name)
+
+    # Write to a temporary folder first, so that a failed write does not destroy the stored dataset:
+    temp_path = _temporary_folder(path)
+    try:
+        df_store.to_parquet(temp_path, partition_cols=PARTITION_COLUMNS, index=False)
+    except Exception:
+        shutil.rmtree(temp_path, ignore_errors=True)
+        raise
+    _swap_folder(temp_path, path)
+
+    if verbose:
+        print('Stored {} rows in the dataset "{}" ({} partitions).'.format(
+            len(df_store), name, len(df_store.groupby(PARTITION_COLUMNS, observed=True))))
+
+def load_dataset(store_folder, name, columns=None, filters=None, keep_partition_columns=False):
+    """
+    This function loads the dataset with the given name ('ids7', 'dt' or 'merged') from the store folder.
+    Only the columns in the list columns are read (all columns if None).
+    The filters are passed on to pyarrow, e.g. [('Year', '==', 2024), ('Room', 'in', ['RRH_XA1', 'RRH_XA2'])].
+    Filters on Year, Month and Room only read the matching partitions.
+    The partition columns are dropped unless keep_partition_columns is True.
+    """
+    if not _check_dataset_name(name):
+        return
+
+    path = _dataset_path(store_folder, name)
+    if not os.path.exists(path):
+        print('WARNING: The dataset "' + name + '" does not exist in ' + str(store_folder))
+        return
+
+    df = pd.read_parquet(path, columns=columns, filters=filters)
+
+    # The partition columns are read as categories, convert them back:
+    for column in ['Year', 'Month']:
+        if column in df.columns:
+            df[column] = df[column].astype('int32')
+    if 'Room' in df.columns:
+        df['Room'] = df['Room'].astype('string')
+
+    if not keep_partition_columns:
+        df = df.drop([column for column in PARTITION_COLUMNS if column in df.columns and
+                      (columns is None or column not in columns)], axis=1)
+    return df
+
+def save_cleaned_data(store_folder, df_ids7=None, df_dt=None, data=None, verbose=False):
+    """
+    This function stores the cleaned IDS7 data, the DoseTrack data and the merged data
+    as the datasets 'ids7', 'dt' and 'merged'. Dataframes that are None are not stored.
+    """
+    for name, df in [('ids7', df_ids7), ('dt', df_dt), ('merged', data)]:
+        if df is not None:
+            save_dataset(df, store_folder, name, verbose=verbose)
+
+def _remove_empty_folders(path):
+    """
+    This utility function removes empty folders below path, e.g. partitions where all files have been removed.
+    """
+    for folder, subfolders, files in os.walk(path, topdown=False):
+        if folder != path and not os.listdir(folder):
+            os.rmdir(folder)
+
+def upsert_dataset(df, store_folder, name, key_column, keys=None, verbose=False):
+    """
+    This function replaces all the stored rows in the dataset with the given name where key_column is in keys
+    with the rows in df. If keys is None, the keys in df[key_column] are used.
+    Only the partitions holding any of the keys, or receiving rows from df, are read and rewritten.
+    If the dataset does not exist, df is stored as a new dataset.
+    """
+    if not _check_dataset_name(name):
+        return
+
+    path = _dataset_path(store_folder, name)
+    if not os.path.exists(path):
+        save_dataset(df, store_folder, name, verbose=verbose)
+        return
+
+    if keys is None:
+        keys = df[key_column].dropna().unique()
+    keys = pd.Index(keys)
+
+    # Find the partitions holding the keys, by reading only the key column and the partition columns:
+    stored_keys = load_dataset(store_folder, name, columns=[key_column] + PARTITION_COLUMNS)
+    df_new = _add_partition_columns(df, name)
+    touched = pd.concat([stored_keys.loc[stored_keys[key_column].isin(keys), PARTITION_COLUMNS],
+                         df_new[PARTITION_COLUMNS]]).drop_duplicates()
+    touched = set((int(year), int(month), str(room)) for year, month, room in touched.itertuples(index=False))
+
+    # Read the touched partitions and remove their files:
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    fragments = []
+    for fragment in dataset.get_fragments():
+        partition = ds.get_partition_keys(fragment.partition_expression)
+        if (int(partition['Year']), int(partition['Month']), str(partition['Room'])) in touched:
+            fragments.append(fragment.path)
+
+    if len(fragments) > 0:
+        df_old = ds.dataset(fragments, format='parquet').to_table().to_pandas()
+        df_old = df_old.drop([column for column in PARTITION_COLUMNS if column in df_old.columns], axis=1)
+        n_replaced = df_old[key_column].isin(keys).sum()
+        df_old = df_old[~df_old[key_column].isin(keys)]
+    else:
+        df_old = df.iloc[:0]
+        n_replaced = 0
+
+    df_store = _add_partition_columns(pd.concat([df_old, df], ignore_index=True), name)
+
+    # Write the new files to a temporary folder first, so that the stored rows are not lost if the write fails.
+    # The new files are then moved into the partitions, before the old files are removed:
+    temp_path = _temporary_folder(path)
+    try:
+        df_store.to_parquet(temp_path, partition_cols=PARTITION_COLUMNS, index=False)
+    except Exception:
+        shutil.rmtree(temp_path, ignore_errors=True)
+        raise
+    for folder, _, files in os.walk(temp_path):
+        target_folder = os.path.join(path, os.path.relpath(folder, temp_path))
+        for file_name in files:
+            os.makedirs(target_folder, exist_ok=True)
+            os.replace(os.path.join(folder, file_name), os.path.join(target_folder, file_name))
+    shutil.rmtree(temp_path)
+    for fragment in fragments:
+        os.remove(fragment)
+    _remove_empty_folders(path)
+
+    if verbose:
+        print('Upserted {} rows in the dataset "{}": {} stored rows replaced, {} partitions rewritten.'.format(
+            len(df), name, n_replaced, len(touched)))
+
+def _read_new_export(export, n_workers=None, cache_folder=None):
+    """
+    This utility function returns the export as a dataframe.
+    The export can be a dataframe or a folder with Excel files.
+    """
+    if isinstance(export, pd.DataFrame):
+        return export.copy()
+    return bh_utils.import_excel_files_to_dataframe(export, n_workers=n_workers, cache_folder=cache_folder)
+
+def _drop_rows_in_history(df_new, df_hist, ignore_columns):
+    """
+    This utility function removes the rows in df_new that are already stored in df_hist, e.g. if an export
+    is delivered twice. The rows are compared on all columns except ignore_columns.
+    Duplicated rows within df_new are kept.
+    """
+    subset = [column for column in df_new.columns if column not in ignore_columns and column in df_hist.columns]
+    if len(df_hist) == 0 or len(subset) == 0:
+        return df_new
+    hash_new = pd.util.hash_pandas_object(_apply_dtypes(df_new[subset].copy()), index=False)
+    hash_hist = pd.util.hash_pandas_object(_apply_dtypes(df_hist[subset].copy()), index=False)
+    return df_new[~hash_new.isin(hash_hist).to_numpy()]
+
+def _load_rows(store_folder, name, column, values, columns=None):
+    """
+    This utility function loads the stored rows of the dataset with the given name where column is in values.
+    The rows are filtered by pyarrow while reading, so the other rows are never converted to pandas.
+    Only the columns in the list columns are read (all columns if None). Returns None if the dataset does not exist.
+    """
+    if not os.path.exists(_dataset_path(store_folder, name)):
+        return None
+    values = pa.array([str(value) for value in values], type=pa.string())
+    return load_dataset(store_folder, name, columns=columns, filters=ds.field(column).isin(values))
+
+def _map_new_rows(data, store_folder, mapping, affected_accessions, verbose=False):
+    """
+    This utility function maps the new merged rows. Whether a rule in the mapping dictionary is applied depends
+    on all the unique descriptions in the data (see mapping_module._resolve_rules), so the unique descriptions of
+    the stored merged data are mapped together with the new rows. Stored rows whose mapping changes are returned
+    along with the new rows, so that they are rewritten as well.
+    """
+    stored = load_dataset(store_folder, 'merged', columns=['Accession Number', 'Beskrivelse', 'Mapped Procedures']) \
+             if os.path.exists(_dataset_path(store_folder, 'merged')) else None
+    if stored is None or 'Mapped Procedures' not in stored.columns:
+        return bh_map.map_procedures(data, mapping, verbose=verbose)
+
+    stored = stored[~stored['Accession Number'].isin(affected_accessions)]
+    descriptions = pd.DataFrame({'Beskrivelse': pd.concat([stored['Beskrivelse'].astype(object),
+                                                           data['Beskrivelse'].astype(object)]).dropna().unique()})
+    descriptions = bh_map.map_procedures(descriptions, mapping, verbose=verbose)
+    if descriptions is None:
+        return
+    table = pd.Series(descriptions['Mapped Procedures'].astype(str).to_numpy(), index=descriptions['Beskrivelse'])
+
+    # Reload the stored rows where the mapping has changed:
+    new_mapping = stored['Beskrivelse'].astype(object).map(table).fillna('Unmapped')
+    changed = stored.loc[new_mapping.to_numpy() != stored['Mapped Procedures'].astype(str).to_numpy(), 'Accession Number']
+    if len(changed) > 0:
+        if verbose:
+            print('The mapping has changed for {} stored accession numbers, these are updated.'.format(len(changed)))
+        data = pd.concat([data, load_dataset(store_folder, 'merged', filters=[('Accession Number', 'in', list(changed))])
+                                .drop('Mapped Procedures', axis=1)], ignore_index=True)
+
+    data['Mapped Procedures'] = pd.Categorical(data['Beskrivelse'].astype(object).map(table).fillna('Unmapped'))
+    cols = data.columns.tolist()
+    cols.insert(0, cols.pop(cols.index('Mapped Procedures')))
+    return data.reindex(columns=cols)
+
+def append_new_exports(store_folder, new_ids7, new_dt, mapping=None, verbose=False, manual_replace=False, n_workers=None, cache_folder=None):
+    """
+    This function adds new IDS7 and DoseTrack exports to the datasets 'ids7', 'dt' and 'merged' in the store folder.
+    new_ids7 and new_dt can be dataframes or folders with the new Excel files only.
+    If a mapping dictionary is given, the new merged rows are mapped with mapping_module.map_procedures, together with
+    the unique descriptions in the stored merged data, and stored rows whose mapping changes are updated.
+
+    The new IDS7 rows are filtered with remove_unnecessary_columns, filter_NaT, filter_cancelled, filter_phantom_etc
+    and check_accession_format. The stored IDS7 rows of all patients in the new IDS7 data, and of all patients with
+    accession numbers in the new DoseTrack data, are then reconciled together with the new rows, so that duplicated
+    accession numbers across months are found. Note that this requires the 'Pasient' column to use the same
+    anonymized ID for a patient in all exports. Without the 'Pasient' column, the accession number is used instead.
+    Finally the affected accession numbers are merged with merge_ids7_dt and upserted in the stored merged data.
+    The datasets are updated in the order 'merged', 'dt' and 'ids7'. If the function fails on the way (e.g. the disk is
+    full), it can be run again with the same exports, and the new rows are then added to all three datasets.
+    Returns the new merged rows.
+    """
+    df_ids7_new = _read_new_export(new_ids7, n_workers=n_workers, cache_folder=cache_folder)
+    df_dt_new = _read_new_export(new_dt, n_workers=n_workers, cache_folder=cache_folder)
+
+    # Run the filters from run_all_cleanup_filters_and_checks on the new IDS7 rows:
+    df_ids7_new = bh_utils.remove_unnecessary_columns(df_ids7_new, verbose=verbose)
+    df_ids7_new = bh_utils.filter_NaT(df_ids7_new, verbose=verbose)
+    df_ids7_new = bh_utils.filter_cancelled(df_ids7_new, verbose=verbose)
+    df_ids7_new = bh_utils.filter_phantom_etc(df_ids7_new, verbose=verbose)
+    df_ids7_new = bh_utils.check_accession_format(df_ids7_new, verbose=verbose)
+
+    if not bh_utils._check_for_column(df_ids7_new, 'IDS7', 'Henvisnings-ID') or \
+            not bh_utils._check_for_column(df_dt_new, 'DoseTrack', 'Accession Number'):
+        print('Without these columns, the new exports can not be added to the stored data.')
+        print('\n')
+        return None
+
+    # Convert the old Siemens PACS accession numbers in the new DoseTrack data, only in the rows with such numbers:
+    if bh_utils._mask_old_siemens_pacs_format(df_dt_new['Accession Number']).any():
+        df_dt_new = bh_utils._convert_old_siemens_pacs_accession_format(df_dt_new, verbose=verbose)
+
+    # Find the patients affected by the new exports, by reading only the key columns of the stored IDS7 data:
+    key_column = 'Pasient' if 'Pasient' in df_ids7_new.columns else 'Henvisnings-ID'
+    new_dt_accessions = pd.Index(df_dt_new['Accession Number'].dropna().unique())
+    ids7_keys = load_dataset(store_folder, 'ids7', columns=list(dict.fromkeys([key_column, 'Henvisnings-ID']))) \
+                if os.path.exists(_dataset_path(store_folder, 'ids7')) else None
+    if ids7_keys is None:
+        ids7_keys = df_ids7_new[list(dict.fromkeys([key_column, 'Henvisnings-ID']))].iloc[:0]
+    affected = pd.Index(df_ids7_new[key_column].dropna().unique()).union(
+        pd.Index(ids7_keys.loc[ids7_keys['Henvisnings-ID'].isin(new_dt_accessions), key_column].dropna().unique()))
+    if verbose:
+        print('{} new IDS7 rows and {} new DoseTrack rows, affecting {} values of "{}" in the history.'.format(
+            len(df_ids7_new), len(df_dt_new), len(affected), key_column))
+
+    # Load the stored IDS7 rows of the affected patients, and the stored DoseTrack rows of their accession numbers
+    # and of the new DoseTrack accession numbers. The accession numbers are only reconciled against these rows:
+    df_ids7_hist_affected = _load_rows(store_folder, 'ids7', key_column, affected)
+    if df_ids7_hist_affected is None:
+        df_ids7_hist_affected = df_ids7_new.iloc[:0]
+    dt_accessions = pd.Index(df_ids7_hist_affected['Henvisnings-ID'].dropna().unique()).union(
+        pd.Index(df_ids7_new['Henvisnings-ID'].dropna().unique())).union(new_dt_accessions)
+    df_dt_hist = _load_rows(store_folder, 'dt', 'Accession Number', dt_accessions)
+    if df_dt_hist is None:
+        df_dt_hist = df_dt_new.iloc[:0]
+
+    # Combine the history and the new data, without rows that are already stored:
+    flag_columns = ['Source_File', 'Henvisning_i_dt', 'Henvisning_i_ids7']
+    df_dt_new = _drop_rows_in_history(df_dt_new, df_dt_hist, flag_columns)
+    df_dt_all = pd.concat([df_dt_hist, df_dt_new], ignore_index=True)
+    # The stored accession number may have been overwritten by overwrite_duplicated_accession_numbers, so it is not compared:
+    df_ids7_new = _drop_rows_in_history(df_ids7_new, df_ids7_hist_affected, flag_columns + ['Henvisnings-ID'])
+    df_ids7_affected = pd.concat([df_ids7_hist_affected, df_ids7_new], ignore_index=True)
+    df_ids7_affected = df_ids7_affected.drop('Henvisning_i_dt', axis=1, errors='ignore')
+
+    # Reconcile the accession numbers of the affected patients against the DoseTrack data:
+    accessions_before = pd.Index(df_ids7_affected['Henvisnings-ID'].dropna().unique())
+    df_ids7_affected = bh_utils.check_accession_ids7_vs_dt(df_ids7_affected, df_dt_all, verbose=verbose)
+    df_ids7_affected = bh_utils.overwrite_duplicated_accession_numbers(df_ids7_affected, df_dt_all, verbose=verbose, manual_replace=manual_replace)
+
+    # Update the DoseTrack rows for the affected accession numbers against all the IDS7 data:
+    affected_accessions = accessions_before.union(pd.Index(df_ids7_affected['Henvisnings-ID'].dropna().unique())).union(new_dt_accessions)
+    all_ids7_accessions = pd.Index(ids7_keys.loc[~ids7_keys[key_column].isin(affected), 'Henvisnings-ID'].dropna().unique()).union(
+        pd.Index(df_ids7_affected['Henvisnings-ID'].dropna().unique()))
+    df_dt_affected = df_dt_all[df_dt_all['Accession Number'].isin(affected_accessions)].copy()
+    df_dt_affected = bh_utils.check_accession_dt_vs_ids7(df_dt_affected, pd.DataFrame({'Henvisnings-ID': all_ids7_accessions}), verbose=verbose)
+
+    # Merge the affected accession numbers:
+    data = bh_utils.merge_ids7_dt(df_ids7_affected, df_dt_affected, verbose=verbose)
+    if mapping is not None:
+        data = _map_new_rows(data, store_folder, mapping, affected_accessions, verbose=verbose)
+        if data is None:
+            return
+
+    # Store the result. The merged data is stored first, and the IDS7 data last: The new rows are recognized as already
+    # stored by their IDS7 and DoseTrack rows, so if a later step fails, a rerun with the same exports redoes all the steps:
+    upsert_dataset(data, store_folder, 'merged', 'Accession Number',
+                   keys=affected_accessions.union(pd.Index(data['Accession Number'].dropna())), verbose=verbose)
+    upsert_dataset(df_dt_affected, store_folder, 'dt', 'Accession Number', keys=affected_accessions, verbose=verbose)
+    upsert_dataset(df_ids7_affected, store_folder, 'ids7', key_column, keys=affected, verbose=verbose)
+    return data
+
+# The columns read from each input in merge_out_of_core: the key column, and the columns used by merge_ids7_dt and
+# the accession number checks. Columns that do not exist in an input are ignored.
+OUT_OF_CORE_COLUMNS = {'ids7': ['Henvisnings-ID', 'Beskrivelse', 'Pasient', 'Kjønn', 'Henvisning_i_dt'],
+                       'dt': ['Accession Number', 'Henvisning_i_ids7'] + list(bh_utils.DT_AGGREGATION_OPTIONAL.keys())}
+
+def _iter_source_chunks(source, columns, chunk_size):
+    """
+    This utility function reads an input of merge_out_of_core in chunks of at most chunk_size rows, with only the
+    columns in the list columns that exist. The input can be a dataframe, a parquet file, a folder with a parquet
+    dataset (e.g. the dataset 'ids7' or 'dt' in a store folder), a CSV or xlsx file, or a list of these.
+    Yields one dataframe per chunk.
+    """
+    if isinstance(source, (list, tuple)):
+        for item in source:
+            yield from _iter_source_chunks(item, columns, chunk_size)
+
+    elif isinstance(source, pd.DataFrame):
+        source = source[[column for column in columns if column in source.columns]]
+        for start in range(0, len(source), chunk_size):
+            yield source.iloc[start:start + chunk_size]
+
+    elif os.path.isdir(source):
+        dataset = ds.dataset(source, format='parquet', partitioning='hive')
+        existing = [column for column in columns if column in dataset.schema.names]
+        for batch in dataset.to_batches(columns=existing, batch_size=chunk_size):
+            yield batch.to_pandas()
+
+    elif str(source).endswith('.parquet'):
+        parquet_file = pq.ParquetFile(source)
+        existing = [column for column in columns if column in parquet_file.schema_arrow.names]
+        for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=existing):
+            yield batch.to_pandas()
+
+    else:
+        yield from bh_utils._iter_export_chunks(source, columns=columns, chunk_size=chunk_size)
+
+def _bucket_numbers(keys, n_buckets):
+    """
+    This utility function returns the bucket number (0 to n_buckets - 1) of each key, from a hash of the value.
+    The keys are hashed as Python objects, so the same value gets the same bucket whatever the dtype of the chunk.
+    """
+    hashes = pd.util.hash_pandas_object(pd.Series(keys.to_numpy(dtype=object)), index=False).to_numpy()
+    return (hashes % n_buckets).astype('int64')
+
+def _write_buckets(chunks, source, key_column, folder, n_buckets, convert_old_format=False):
+    """
+    This utility function splits each chunk of the source ('IDS7' or 'DoseTrack') by the bucket number of key_column,
+    and writes the rows of each bucket as a parquet file in the folder bucket_<number>. Rows without a key are dropped,
+    as in merge_ids7_dt.
+    If convert_old_format is True, the old Siemens PACS accession numbers are converted before hashing, so they end
+    up in the same bucket as the matching IDS7 accession numbers.
+    Returns the number of rows written and the columns of the chunks (None if there were no chunks).
+    """
+    n_rows = 0
+    columns = None
+    for i, chunk in enumerate(chunks):
+        if columns is None:
+            if not bh_utils._check_for_column(chunk, source, key_column):
+                return 0, None
+            columns = list(chunk.columns)
+        chunk = chunk[chunk[key_column].notna()]
+        if convert_old_format and bh_utils._mask_old_siemens_pacs_format(chunk[key_column]).any():
+            chunk = bh_utils._convert_old_siemens_pacs_accession_format(chunk.copy())
+        buckets = _bucket_numbers(chunk[key_column], n_buckets)
+        for bucket, rows in chunk.groupby(buckets, sort=False):
+            bucket_folder = os.path.join(folder, 'bucket_{:05d}'.format(bucket))
+            os.makedirs(bucket_folder, exist_ok=True)
+            rows.to_parquet(os.path.join(bucket_folder, 'part_{:06d}.parquet'.format(i)), index=False)
+        n_rows += len(chunk)
+    return n_rows, columns
+
+def _read_bucket(folder, bucket, columns):
+    """
+    This utility function reads all the parts of a bucket written by _write_buckets into one dataframe.
+    The parts are read one by one and concatenated, since the dtypes of the chunks can differ.
+    """
+    bucket_folder = os.path.join(folder, 'bucket_{:05d}'.format(bucket))
+    if not os.path.exists(bucket_folder):
+        return pd.DataFrame(columns=columns)
+    parts = [pd.read_parquet(os.path.join(bucket_folder, part)) for part in sorted(os.listdir(bucket_folder))]
+    return pd.concat(parts, ignore_index=True)
+
+def _to_arrow(df):
+    """
+    This utility function converts a dataframe with partition columns to a pyarrow table where all the category
+    columns are stored as dictionaries of strings with int32 indices, so that all the files written by
+    merge_out_of_core have the same schema, also for buckets where a column only has missing values.
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    fields = [pa.field(field.name, pa.dictionary(pa.int32(), pa.string())) if pa.types.is_dictionary(field.type) else field
+              for field in table.schema]
+    return table.cast(pa.schema(fields, metadata=table.schema.metadata))
+
+def merge_out_of_core(ids7_source, dt_source, store_folder, n_buckets=64, chunk_size=500_000, bucket_folder=None, verbose=False):
+    """
+    This function merges IDS7 and DoseTrack data as merge_ids7_dt does, without having all the data in memory,
+    and stores the result as the dataset 'merged' in the store folder (an existing dataset is replaced when the merge
+    has succeeded).
+    ids7_source and dt_source can be dataframes, parquet files, folders with parquet datasets (e.g. the datasets
+    'ids7' and 'dt' in a store folder), CSV or xlsx files, or lists of these. They are read in chunks of chunk_size
+    rows, and only the columns used in the merge are kept.
+
+    The rows are split into n_buckets buckets by a hash of the accession number, and written to parquet files in
+    a new temporary folder in bucket_folder (in the system's temporary folder if None), which is deleted afterwards.
+    Files left in bucket_folder by other runs are therefore never read. All the rows of an accession number are
+    then in the same bucket, so each bucket can be merged with merge_ids7_dt on its own, and the merged rows are
+    written to the dataset before the next bucket is read. The peak memory is therefore set by the size of a bucket:
+    choose n_buckets so that a bucket is a small part of the data.
+
+    The IDS7 data should have been cleaned with the filters in run_all_cleanup_filters_and_checks. If the columns
+    'Henvisning_i_dt' or 'Henvisning_i_ids7' are missing, they are set in each bucket with check_accession_ids7_vs_dt
+    and check_accession_dt_vs_ids7, which gives the same result as on the whole data. overwrite_duplicated_accession_numbers
+    compares the accession numbers of a patient, which can be in different buckets, so it must be run before.
+    The rows are sorted by accession number within each bucket, and not across the buckets as with merge_ids7_dt.
+    Returns the number of merged rows.
+    """
+    start = time.perf_counter()
+    path = _dataset_path(store_folder, 'merged')
+    # Each run writes the buckets to a new folder, so that files from an earlier run are not merged again:
+    if bucket_folder is not None:
+        os.makedirs(bucket_folder, exist_ok=True)
+    bucket_folder = tempfile.mkdtemp(prefix='merge_buckets_', dir=bucket_folder)
+    temp_path = None
+
+    try:
+        # Split both inputs into buckets on disk:
+        n_ids7, ids7_columns = _write_buckets(_iter_source_chunks(ids7_source, OUT_OF_CORE_COLUMNS['ids7'], chunk_size),
+                                              'IDS7', 'Henvisnings-ID', os.path.join(bucket_folder, 'ids7'), n_buckets)
+        n_dt, dt_columns = _write_buckets(_iter_source_chunks(dt_source, OUT_OF_CORE_COLUMNS['dt'], chunk_size),
+                                          'DoseTrack', 'Accession Number', os.path.join(bucket_folder, 'dt'), n_buckets, convert_old_format=True)
+        if ids7_columns is None or dt_columns is None or \
+                not bh_utils._check_for_column(pd.DataFrame(columns=ids7_columns), 'IDS7', 'Beskrivelse'):
+            print('Without these columns, the IDS7 and DoseTrack data can not be merged.')
+            print('\n')
+            return 0
+        if verbose:
+            print('Split {} IDS7 rows and {} DoseTrack rows into {} buckets in {:.1f} s.'.format(
+                n_ids7, n_dt, n_buckets, time.perf_counter() - start))
+
+        # Merge and store one bucket at a time, in a temporary folder which replaces the stored dataset at the end,
+        # so that the stored dataset is kept if the merge fails:
+        temp_path = _temporary_folder(path)
+        n_merged = 0
+        for bucket in range(n_buckets):
+            df_ids7 = _read_bucket(os.path.join(bucket_folder, 'ids7'), bucket, ids7_columns)
+            df_dt = _read_bucket(os.path.join(bucket_folder, 'dt'), bucket, dt_columns)
+            if len(df_ids7) == 0 and len(df_dt) == 0:
+                continue
+            if 'Henvisning_i_dt' not in df_ids7.columns:
+                df_ids7 = bh_utils.check_accession_ids7_vs_dt(df_ids7, df_dt)
+            if 'Henvisning_i_ids7' not in df_dt.columns:
+                df_dt = bh_utils.check_accession_dt_vs_ids7(df_dt, df_ids7)
+
+            data = bh_utils.merge_ids7_dt(df_ids7, df_dt)
+            if len(data) > 0:
+                pq.write_to_dataset(_to_arrow(_add_partition_columns(data, 'merged')), temp_path, partition_cols=PARTITION_COLUMNS)
+            n_merged += len(data)
+        _swap_folder(temp_path, path)
+    finally:
+        shutil.rmtree(bucket_folder, ignore_errors=True)
+        if temp_path is not None:
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+    if verbose:
+        print('Merged {} rows into the dataset "merged" in {:.1f} s.'.format(n_merged, time.perf_counter() - start))
+    return n_merged
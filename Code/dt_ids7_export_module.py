@@ -22,7 +22,9 @@ Pasient:    This is required for the functions aimed at detecting and correcting
 These functions require an export of the DoseTrack data with the column titles in the first row.
 It is usually a good idea right after the excel export to filter the excel file by using only the rows with ordinal = 1.
 This will greatly reduce the size of the excel file while still maintaining the procedure level data.
-For Acquisition level data, another python module should be created.
+Alternatively, read_dosetrack_acquisition_export reads the unfiltered acquisition level export (CSV or xlsx) in chunks
+and aggregates it to one row per accession number on the fly.
+Acquisition level data (one row per run) is analysed in acquisition_module.
 
 The following columns are required in the DoseTrack data:
 Accession Number
@@ -30,6 +32,17 @@ Accession Number
 
 The following functions are included in this module:
 
+-------------------------------- Importing the data: --------------------------------
+import_excel_files_to_dataframe:    Reads all Excel files in a folder tree in parallel into one dataframe,
+                                    optionally with a parquet cache and optimized dtypes.
+
+read_dosetrack_acquisition_export:  Streams a large acquisition level DoseTrack export (CSV or xlsx) in chunks, keeps the
+                                    rows with Ordinal = 1 and aggregates them per accession number, as merge_ids7_dt does.
+
+optimize_dtypes:            Converts low-cardinality text columns to category, accession numbers to pyarrow strings and
+                            downcasts the dose and time columns to float32, and reports the memory use before and after.
+-------------------------------------------------------------------------------------
+
 -------------------------------- Filtering the data: --------------------------------
 remove_unnecessary_columns: Which removes the a few unnessecary columns from the IDS7 dataframe:
                             Prioritet- og lesemerkeikon, Lagt til i demonstrasjon-ikon og Status.
@@ -42,7 +55,7 @@ filter_phantom_etc:         Removes rows representing non-human subjects: 'Henvi
 -------------------------------------------------------------------------------------
 
 -------------------------------- Checking the data: --------------------------------
-check_accession_format:     Checks if the accession number has a correct start and length.
+check_accession_format:     Checks if the accession number has a correct start and length (without regular expressions).
                             The currently allowed accession numbers are:
                             (NORRH|NRRH|NRAK|NIRH|NKRH|NKUL|NNRH|NRRA|NRUL)
 
@@ -51,6 +64,12 @@ check_accession_ids7_vs_dt: Checks whether the accession numbers in IDS7 are in
 
 check_accession_dt_vs_ids7: Checks whether the accession numbers in DoseTrack are in IDS7.
                             It will add a column to the DoseTrack dataframe called Henvisning_i_ids7 which is true or false, correspondigly.
+
+validate_accession_format:  Returns the number of invalid accession numbers per reason (missing, bad prefix, bad length).
+
+AccessionIndex:             Normalizes the accession numbers of IDS7 and DoseTrack once (old Siemens PACS format and
+                            format check) as shared integer codes, and answers membership in both directions,
+                            lists of unmatched accession numbers and join keys. Used by the two checks above and merge_ids7_dt.
 -------------------------------------------------------------------------------------
 
 --------------- Attempt to detect and correct errrors in the datasets: --------------
@@ -58,12 +77,13 @@ check_patents_with_multiple_bookings_on_same_time_with_different_accession:
                             
                             This function is used to report whether there are patients with multiple bookings on the
                             same time with different accession numbers. This can be used to explore the extent of possibly duplicates.
+                            Returns a dataframe of the suspect bookings.
 
 check_patents_with_multiple_bookings_on_same_day_with_different_accession:
 
                             This function is used to report whether there are patients with multiple bookings on the
                             same day (but not on the same time). This can be used to explore the extent of possibly duplicates with 
-                            slightly different booking times.
+                            slightly different booking times. Returns a dataframe of the suspect bookings.
 
 
 overwrite_duplicated_accession_numbers:     For a few patients having a procedure, there has been created two accession numbers in IDS7.
@@ -74,7 +94,12 @@ overwrite_duplicated_accession_numbers:     For a few patients having a procedur
                                             If only one of these are in dosetrack while the rest is not, 
                                             the accession number will be overwritten by the accession number used by dosetrack.
 
+CleanupPipeline:                            Runs the filters above in one pass with one combined mask, and reports the number
+                                            of rows removed by each filter.
+
 run_all_cleanup_filters_and_checks:         This function runs all the functions in this module in the correct order for conveniance.
+                                            parallel_module.run_partitioned_pipeline runs it and merge_ids7_dt on partitions
+                                            of the patients on several CPU cores.
 -------------------------------------------------------------------------------------
 
 --------- Funciton for merging IDS7 and DoseTrack dataframes: ----------
@@ -89,6 +114,7 @@ export_examination_codes_to_text_file:      This function generates a txt file w
                                             examination descriptions in a folder called Reports.
                                             These lists can be printed and shown to the department to promote discussion on which
                                             procedures are important, and which should not be reported on.
+                                            Optionally one CSV/parquet table with the frequencies of all labs is written instead.
                         
 delete_reports:                             A Utility function for easy deleting of all the reports in the report folder.
                                             If True is passed the Reports folder is also deleted.
@@ -98,6 +124,9 @@ delete_reports:                             A Utility function for easy deleting
 _concatenate_protocol(series):
     This function concatenates all the protocol information into a single string, for the merged dataframe.
 
+_join_sorted_groups(df, group_columns, value_column):
+    This function concatenates the values for each group of a sorted dataframe into a single string, in one pass.
+
 _check_for_column(data, source, column_name):
     This function checks if a column is in the dataframe and outputs a warning if it is not present.
 
@@ -111,9 +140,10 @@ _add_optional_columns(data, agg_dict, agg_dict_optional, source):
 
 import pandas as pd
 import numpy as np
-import re
 import os
 import glob
+import time
+import hashlib
 
 # Utility functions:
 def _concatenate_protocol(series):
@@ -123,6 +153,23 @@ def _concatenate_protocol(series):
     sort = series.sort_values()
     return ', '.join(sort.astype(str))
 
+def _join_sorted_groups(df, group_columns, value_column):
+    """
+    This function joins the values in value_column into one string, separated by a comma, for each group of
+    consecutive rows with the same values in group_columns. The dataframe must be sorted by group_columns, and the
+    values are joined in the order they appear, so sorting by value_column as well gives the same result as
+    _concatenate_protocol, but in one pass over the whole dataframe.
+    Returns a dataframe with the group columns and the joined values, with one row per group.
+    """
+    keys = df[group_columns]
+    # The comparison with the shifted first row gives <NA> for nullable dtypes, which also marks a new group:
+    new_group = keys.ne(keys.shift()).fillna(True).any(axis=1).to_numpy(dtype=bool)
+    starts = np.append(np.flatnonzero(new_group), len(df))
+    values = df[value_column].to_numpy(dtype=object).astype(str).tolist()
+    joined = keys.iloc[starts[:-1]].reset_index(drop=True)
+    joined[value_column] = [', '.join(values[a:b]) for a, b in zip(starts[:-1], starts[1:])]
+    return joined
+
 def _check_for_column(data, source, column_name):
     """
     This function checks if a column is in the dataframe.
@@ -182,35 +229,283 @@ def _add_optional_columns(data, agg_dict, agg_dict_optional, source, verbose=Fal
     return agg_dict
 
 
-def import_excel_files_to_dataframe(root_folder):
+def _read_excel_file(file_path, cache_folder=None):
+    """
+    This utility function reads one Excel file into a DataFrame.
+    If a cache folder is given, the DataFrame is stored as a parquet file named by a hash of the path,
+    modification time and size of the Excel file. The next time the same unchanged file is read,
+    the parquet file is used instead, which is much faster.
+    The parquet file is first written to a temporary file and then renamed, so an interrupted write never leaves
+    a broken cache file. A cache file that can not be read is deleted, and the Excel file is read instead.
+    Returns the DataFrame, the time used in seconds and whether the cache was used.
+    It is defined at module level so that it can be run in a separate process.
+    """
+    start = time.perf_counter()
+    cache_file = None
+    if cache_folder is not None:
+        stat = os.stat(file_path)
+        key = '{}|{}|{}'.format(os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
+        cache_file = os.path.join(cache_folder, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.parquet')
+        if os.path.exists(cache_file):
+            try:
+                return pd.read_parquet(cache_file), time.perf_counter() - start, True
+            except Exception as e:
+                print(f"Could not read the cache of {file_path}, reading the Excel file instead: {e}")
+                os.remove(cache_file)
+
+    df = pd.read_excel(file_path)
+    if cache_file is not None:
+        temp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+        try:
+            df.to_parquet(temp_file)
+            os.replace(temp_file, cache_file)
+        except Exception as e:
+            # Columns with mixed types can not be stored as parquet, the file is then read from Excel every time:
+            print(f"Could not cache {file_path}: {e}")
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+    return df, time.perf_counter() - start, False
+
+def _try_read_excel_file(file_path, cache_folder):
+    """
+    This utility function calls _read_excel_file and returns the exception instead of raising it.
+    """
+    try:
+        return _read_excel_file(file_path, cache_folder)
+    except Exception as e:
+        return e
+
+def _try_get_result(future):
+    """
+    This utility function returns the result of a future, or the exception instead of raising it.
+    """
+    try:
+        return future.result()
+    except Exception as e:
+        return e
+
+def import_excel_files_to_dataframe(root_folder, n_workers=None, cache_folder=None, optimize=False):
     """
     Imports all Excel files from a folder tree into one DataFrame.
+    The files are read in parallel in a pool of processes, as reading Excel files is slow and single threaded.
     
     Args:
         root_folder (str): Path to the root folder containing Excel files.
+        n_workers (int): Number of processes used to read the files. Default is the number of CPUs.
+                         With n_workers=1 the files are read one by one in this process.
+        cache_folder (str): Optional path to a folder where each file is stored as parquet after it has been read.
+                            Files that have not changed since the last import are read from this folder instead.
+        optimize (bool): If True, optimize_dtypes is run on the combined DataFrame to reduce the memory use.
         
     Returns:
         pd.DataFrame: Combined DataFrame with data from all Excel files.
     """
     from pathlib import Path
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Find all Excel files recursively:
+    file_paths = sorted(Path(root_folder).rglob("*.xlsx"))
+    if cache_folder is not None and not os.path.exists(cache_folder):
+        os.makedirs(cache_folder)
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = max(1, min(n_workers, len(file_paths)))
+
     # List to store individual DataFrames
     dataframes = []
+    start = time.perf_counter()
+    print(f"Reading {len(file_paths)} files with {n_workers} process(es)...")
 
-    # Traverse through the folder tree
-    for file_path in Path(root_folder).rglob("*.xlsx"):  # Find all Excel files recursively
-        try:
-            # Read Excel file into a DataFrame
-            print(f"Reading {file_path}...")
-            df = pd.read_excel(file_path)
+    if n_workers == 1:
+        results = (_try_read_excel_file(file_path, cache_folder) for file_path in file_paths)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=n_workers)
+        futures = [executor.submit(_read_excel_file, file_path, cache_folder) for file_path in file_paths]
+        results = (_try_get_result(future) for future in futures)
+
+    try:
+        # The results are collected in the order of the files, so that the combined DataFrame is always the same:
+        for file_path, result in zip(file_paths, results):
+            if isinstance(result, Exception):
+                print(f"Error reading {file_path}: {result}")
+                continue
+            df, seconds, from_cache = result
+            print(f"Read {file_path} in {seconds:.2f} s" + (" (from cache)" if from_cache else ""))
             df['Source_File'] = file_path.name  # Add a column to track the source file
             dataframes.append(df)  # Append to list
-        except Exception as e:
-            print(f"Error reading {file_path}: {e}")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    print(f"Read {len(dataframes)} files in {time.perf_counter() - start:.2f} s")
 
     # Combine all DataFrames into one
     combined_df = pd.concat(dataframes, ignore_index=True)
+    if optimize:
+        combined_df = optimize_dtypes(combined_df)
     return combined_df
 
+# Here users can list all optional DoseTrack columns that should be included in the merge, and how they are aggregated
+# per accession number. This is used by merge_ids7_dt and read_dosetrack_acquisition_export.
+DT_AGGREGATION_OPTIONAL = {'Study Date': 'first',
+                           'Age (Years)': 'first',
+                           'DAP Total (Gy*cm2)': 'sum',
+                           'CAK (mGy)': 'sum',
+                           'F+A Time (s)': 'sum',
+                           'Modality Room': 'first'}
+
+# The column in the acquisition level DoseTrack export numbering the irradiation events of each study.
+# The procedure level data (e.g. DAP Total) is repeated on every row, and is taken from the row with Ordinal = 1:
+ORDINAL_COLUMN = 'Ordinal'
+
+def _id_columns_to_str(df):
+    """
+    This utility function converts the values in the columns in ID_COLUMNS to strings, keeping the missing values.
+    """
+    for column in ID_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].map(lambda value: value if pd.isna(value) else str(value))
+    return df
+
+def _iter_export_chunks(file_path, columns=None, chunk_size=100_000, sep=',', decimal='.'):
+    """
+    This utility function reads a CSV or xlsx file in chunks of chunk_size rows, so that the whole file is never
+    in memory. The xlsx files are read row by row with openpyxl in read-only mode.
+    Only the columns in the list columns are kept (all columns if None). Columns that do not exist are ignored.
+    The columns in ID_COLUMNS are always read as strings, so that e.g. an old Siemens PACS accession number with a
+    leading zero is the same in every chunk, also in chunks where all the accession numbers look like numbers.
+    Yields one dataframe per chunk.
+    """
+    if str(file_path).endswith('.csv'):
+        usecols = None if columns is None else (lambda column: column in columns)
+        for chunk in pd.read_csv(file_path, usecols=usecols, chunksize=chunk_size, sep=sep, decimal=decimal,
+                                 dtype={column: str for column in ID_COLUMNS}):
+            yield chunk
+
+    elif str(file_path).endswith('.xlsx'):
+        from openpyxl import load_workbook
+        workbook = load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                return
+            keep = [i for i, column in enumerate(header) if columns is None or column in columns]
+            names = [header[i] for i in keep]
+            chunk = []
+            for row in rows:
+                chunk.append([row[i] if i < len(row) else None for i in keep])
+                if len(chunk) == chunk_size:
+                    yield _id_columns_to_str(pd.DataFrame(chunk, columns=names))
+                    chunk = []
+            if chunk:
+                yield _id_columns_to_str(pd.DataFrame(chunk, columns=names))
+        finally:
+            workbook.close()
+
+    else:
+        raise ValueError('Unknown file type, only .csv and .xlsx files can be read: ' + str(file_path))
+
+def read_dosetrack_acquisition_export(file_path, chunk_size=100_000, sep=',', decimal='.', verbose=True):
+    """
+    This function reads a large acquisition level DoseTrack export (CSV or xlsx) without filtering it in Excel first.
+    The file is read in chunks of chunk_size rows. In each chunk only the rows with Ordinal = 1 are kept, and these
+    are aggregated per 'Accession Number' as in merge_ids7_dt (DT_AGGREGATION_OPTIONAL: sum of DAP, CAK and F+A Time,
+    first value of the other columns). The partial results of the chunks are then combined, so the memory use
+    depends on the number of accession numbers and not on the number of acquisitions.
+    sep and decimal are passed to pandas.read_csv for CSV files.
+    Returns a dataframe with one row per accession number, which can be used in place of the procedure level export.
+    """
+    columns = ['Accession Number', ORDINAL_COLUMN] + list(DT_AGGREGATION_OPTIONAL.keys())
+    start = time.perf_counter()
+    partials = []
+    n_rows = 0
+    agg_dict = None
+    for chunk in _iter_export_chunks(file_path, columns=columns, chunk_size=chunk_size, sep=sep, decimal=decimal):
+        n_rows += len(chunk)
+        if agg_dict is None:
+            # Check the columns on the first chunk:
+            if not _check_for_column(chunk, 'DoseTrack', 'Accession Number'):
+                print('Without this column, the acquisitions can not be aggregated per procedure.')
+                print('\n')
+                return None
+            if not _check_for_column(chunk, 'DoseTrack', ORDINAL_COLUMN):
+                print('All rows are treated as procedure level rows, which gives too high doses if this is an acquisition level export.')
+                print('\n')
+            agg_dict = _add_optional_columns(chunk, {}, DT_AGGREGATION_OPTIONAL, 'DoseTrack', verbose=verbose)
+
+        if ORDINAL_COLUMN in chunk.columns:
+            chunk = chunk[pd.to_numeric(chunk[ORDINAL_COLUMN], errors='coerce') == 1]
+        if 'Study Date' in chunk.columns:
+            chunk['Study Date'] = pd.to_datetime(chunk['Study Date'])
+        for column, function in agg_dict.items():
+            if function == 'sum':
+                chunk[column] = pd.to_numeric(chunk[column], errors='coerce')
+        partials.append(chunk.groupby('Accession Number', sort=False).agg(agg_dict))
+
+    if agg_dict is None:
+        print('WARNING: The file ' + str(file_path) + ' is empty.')
+        return None
+
+    # Combine the chunks, the sum of the sums is the sum and the first of the first values is the first value:
+    df_dt = pd.concat(partials).groupby(level=0, sort=False).agg(agg_dict).reset_index()
+    if verbose:
+        print('Read {} acquisition rows from {} into {} accession numbers in {:.2f} s.'.format(n_rows, file_path, len(df_dt), time.perf_counter() - start))
+    return df_dt
+
+# The columns with accession numbers and patient IDs, which have (almost) only unique values:
+ID_COLUMNS = ['Henvisnings-ID', 'Accession Number', 'Pasient']
+
+# The dose and time columns, which do not need more than float32 precision:
+FLOAT32_COLUMNS = ['DAP Total (Gy*cm2)', 'CAK (mGy)', 'F+A Time (s)', 'Age (Years)']
+
+def _memory_usage(df):
+    """
+    This utility function returns the memory use of each column in the dataframe in MB.
+    """
+    return df.memory_usage(deep=True, index=False) / 1024**2
+
+def optimize_dtypes(df, max_category_fraction=0.5, verbose=True, return_report=False):
+    """
+    This function reduces the memory use of an IDS7 or DoseTrack dataframe by changing the dtypes of the columns:
+    The accession numbers and patient IDs (ID_COLUMNS) are stored as pyarrow strings.
+    Other text columns with at most max_category_fraction unique values per row, e.g. 'Beskrivelse', 
+    'Rom/modalitet (RIS)', 'Modality Room', 'Kjønn' and 'Avbrutt', are stored as category.
+    The dose and time columns (FLOAT32_COLUMNS) are downcast to float32.
+    If verbose is True, a report of the memory use of each column before and after is printed.
+    Returns the dataframe, and the report as a dataframe if return_report is True.
+    """
+    memory_before = _memory_usage(df)
+    dtypes_before = df.dtypes.astype(str)
+    df = df.copy()
+
+    for column in df.columns:
+        if pd.api.types.is_object_dtype(df[column]) or pd.api.types.is_string_dtype(df[column]):
+            if isinstance(df[column].dtype, pd.CategoricalDtype):
+                continue
+            # Columns with other values than strings (e.g. numbers in a text column) are left as they are:
+            if pd.api.types.infer_dtype(df[column], skipna=True) != 'string':
+                continue
+            if column in ID_COLUMNS:
+                df[column] = df[column].astype('string[pyarrow]')
+            elif df[column].nunique() <= max_category_fraction * len(df):
+                df[column] = df[column].astype('category')
+        elif column in FLOAT32_COLUMNS and pd.api.types.is_float_dtype(df[column]):
+            df[column] = df[column].astype('float32')
+
+    memory_after = _memory_usage(df)
+    report = pd.DataFrame({'Dtype before': dtypes_before, 'Dtype after': df.dtypes.astype(str),
+                           'Memory before (MB)': memory_before, 'Memory after (MB)': memory_after})
+    if verbose:
+        print(report.round(2).to_string())
+        print('Total memory use reduced from {:.1f} MB to {:.1f} MB.'.format(memory_before.sum(), memory_after.sum()))
+        print('\n')
+
+    if return_report:
+        return df, report
+    return df
 
 # Functions for filtering the IDS7 dataframe:
 def remove_unnecessary_columns(df_ids7, verbose=False):
@@ -237,6 +532,88 @@ def remove_unnecessary_columns(df_ids7, verbose=False):
     
     return df_ids7
 
+# The masks of the rows to keep for each filter, used both by the filter functions and by CleanupPipeline:
+def _mask_NaT(df_ids7):
+    """
+    This utility function returns True for the rows with a value in the column 'Bestilt dato og tidspunkt'.
+    """
+    return df_ids7['Bestilt dato og tidspunkt'].notnull()
+
+def _mask_cancelled(df_ids7):
+    """
+    This utility function returns True for the rows that have not been cancelled.
+    """
+    return df_ids7['Avbrutt'] != 'Avbrutt'
+
+def _mask_phantom_etc(df_ids7):
+    """
+    This utility function returns True for the rows that do not represent non-human subjects.
+    """
+    return df_ids7['Henvisningskategori (RIS)'] != 'X Fantom/objekt/dyr/test'
+
+def _mask_accession_format(df_ids7):
+    """
+    This utility function returns True for the rows where the accession number has a correct start and length.
+    """
+    is_missing, bad_prefix, bad_length = _accession_format_flags(df_ids7['Henvisnings-ID'])
+    return pd.Series(~(is_missing | bad_prefix | bad_length), index=df_ids7.index)
+
+# The allowed starts of the accession numbers, and the allowed lengths (16 characters, MUAH_ numbers have 12):
+VALID_ACCESSION_PREFIXES = ['NORRH', 'NRRH', 'NKRH', 'NIRH', 'NNRH', 'NRUL', 'NKUL', 'NRRA', 'NRAK', 'NLVO', 'MUAH_']
+VALID_ACCESSION_LENGTHS = [16, 12]
+
+def _accession_format_flags(accessions):
+    """
+    This utility function checks the format of the accession numbers without regular expressions, using the
+    pyarrow compute kernels on the Arrow string array: The first characters are cut out once for each length of the
+    allowed prefixes and looked up in the set of allowed prefixes, and the lengths are calculated once.
+    Values that are not strings are treated as missing.
+    Returns three boolean arrays: missing, bad prefix and bad length (both False for missing values).
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    accessions = pd.Series(accessions)
+    if pd.api.types.infer_dtype(accessions, skipna=True) not in ('string', 'empty'):
+        accessions = accessions.astype(object).where(accessions.map(lambda value: isinstance(value, str)), None)
+    array = pa.array(accessions, type=pa.string(), from_pandas=True)
+
+    is_missing = pc.is_null(array)
+    good_prefix = pa.array(np.zeros(len(array), dtype=bool))
+    for length in sorted(set(len(prefix) for prefix in VALID_ACCESSION_PREFIXES)):
+        prefixes = pa.array([prefix for prefix in VALID_ACCESSION_PREFIXES if len(prefix) == length])
+        starts = pc.utf8_slice_codeunits(array, 0, length)
+        good_prefix = pc.or_(good_prefix, pc.fill_null(pc.is_in(starts, value_set=prefixes), False))
+    good_length = pc.fill_null(pc.is_in(pc.utf8_length(array), value_set=pa.array(VALID_ACCESSION_LENGTHS, type=pa.int32())), False)
+
+    is_missing = is_missing.to_numpy(zero_copy_only=False)
+    bad_prefix = ~good_prefix.to_numpy(zero_copy_only=False) & ~is_missing
+    bad_length = ~good_length.to_numpy(zero_copy_only=False) & ~is_missing
+    return is_missing, bad_prefix, bad_length
+
+def validate_accession_format(accessions):
+    """
+    This function checks the format of the accession numbers as check_accession_format does, and returns the
+    number of invalid rows for each reason as a dataframe, with the columns:
+    Reason:             'Missing', 'Bad prefix', 'Bad length' or 'Bad prefix and length'.
+    Rows:               The number of rows.
+    Unique:             The number of unique accession numbers.
+    Examples:           Up to five of the accession numbers.
+    accessions can be a series (e.g. df_ids7['Henvisnings-ID']) or a list.
+    """
+    accessions = pd.Series(accessions).reset_index(drop=True)
+    is_missing, bad_prefix, bad_length = _accession_format_flags(accessions)
+    reasons = {'Missing': is_missing,
+               'Bad prefix': bad_prefix & ~bad_length,
+               'Bad length': bad_length & ~bad_prefix,
+               'Bad prefix and length': bad_prefix & bad_length}
+    breakdown = []
+    for reason, mask in reasons.items():
+        invalid = accessions[mask]
+        breakdown.append({'Reason': reason, 'Rows': int(mask.sum()), 'Unique': int(invalid.nunique()),
+                          'Examples': list(invalid.dropna().drop_duplicates().head(5))})
+    return pd.DataFrame(breakdown, columns=['Reason', 'Rows', 'Unique', 'Examples'])
+
 def filter_NaT(df_ids7, verbose=False):
     """
     This function removes row with NaT in the column 'Bestilt dato og tidspunkt'
@@ -254,7 +631,7 @@ def filter_NaT(df_ids7, verbose=False):
     if verbose:
         print('Number of rows with NaT in the column "Bestilt dato og tidspunkt": {}'.format(sum(df_ids7['Bestilt dato og tidspunkt'].isnull())))
 
-    df_ids7 = df_ids7[df_ids7['Bestilt dato og tidspunkt'].notnull()]
+    df_ids7 = df_ids7[_mask_NaT(df_ids7)]
     return df_ids7
 
 def filter_cancelled(df_ids7, verbose=False):
@@ -274,7 +651,7 @@ def filter_cancelled(df_ids7, verbose=False):
     if _check_for_column(df_ids7, 'IDS7', 'Avbrutt'):
         if verbose:
             print('Number of cancelled procedures: {}'.format(sum(df_ids7['Avbrutt'] == 'Avbrutt')))
-        df_ids7 = df_ids7[df_ids7['Avbrutt'] != 'Avbrutt']
+        df_ids7 = df_ids7[_mask_cancelled(df_ids7)]
         return df_ids7
 
 def filter_phantom_etc(df_ids7, verbose=False):
@@ -295,18 +672,18 @@ def filter_phantom_etc(df_ids7, verbose=False):
     if verbose:
         print('Number of non-human subjects: {}'.format(sum(df_ids7['Henvisningskategori (RIS)'] == 'X Fantom/objekt/dyr/test')))
 
-    df_ids7 = df_ids7[df_ids7['Henvisningskategori (RIS)'] != 'X Fantom/objekt/dyr/test']
+    df_ids7 = df_ids7[_mask_phantom_etc(df_ids7)]
     return df_ids7
 
 # Functions for checking the IDS7 and DoseTrack dataframes:
 def check_accession_format(df_ids7, verbose=False):
     """
     This function checks if the accession number has a correct start and length.
-    The currently allowed accession numbers are:
-    (NORRH|NRRH|NRAK|NIRH|NKRH|NKUL|NNRH|NRRA|NRUL)
-    Additionally the length of the accession number must be 16 characters.
-    If verbose is True, the function will print the number of invalid accession numbers
-    and the invalid accession numbers.
+    The currently allowed starts of the accession numbers are in VALID_ACCESSION_PREFIXES:
+    (NORRH|NRRH|NKRH|NIRH|NNRH|NRUL|NKUL|NRRA|NRAK|NLVO|MUAH_)
+    Additionally the length of the accession number must be 16 characters (12 for MUAH_ numbers).
+    If verbose is True, the function will print the number of invalid accession numbers,
+    the invalid accession numbers and the number of invalid accession numbers per reason.
     """
     # Stop execution if the dataframe contains the column 'Fødselsnummer':
     if _check_for_fnr(df_ids7):
@@ -318,18 +695,14 @@ def check_accession_format(df_ids7, verbose=False):
         print('\n')
         return df_ids7
     
-    valid_formats = r'^(NORRH|NRRH|NKRH|NIRH|NNRH|NRUL|NKUL|NRRA|NRAK|NLVO|MUAH_)'
-    patten = re.compile(valid_formats)
-
-    # HenvinsingsID must have the correct start and length of 16 characters (MUAH_ numbers have 12):
-    is_valid_format = (df_ids7['Henvisnings-ID'].str.match(patten)) &  \
-                      ((df_ids7['Henvisnings-ID'].str.len() == 16) | (df_ids7['Henvisnings-ID'].str.len() == 12))
+    is_valid_format = _mask_accession_format(df_ids7)
 
     if verbose:
         print('Number of rows with invalid accession number: {}'.format(sum(~is_valid_format)))
         # Print the invalid accession numbers:
         if sum(~is_valid_format) > 0:
             print(df_ids7[~is_valid_format]['Henvisnings-ID'])
+            print(validate_accession_format(df_ids7.loc[~is_valid_format, 'Henvisnings-ID']).to_string(index=False))
     
     return df_ids7[is_valid_format]
 
@@ -341,22 +714,135 @@ def _convert_old_siemens_pacs_accession_format(df_dt, verbose=False):
     In the new PACS these have been converted to the new format by attaching "MUAH_" in front of the number.
     This function will convert the old format to the new format.
     """
+    old_format = _mask_old_siemens_pacs_format(df_dt['Accession Number'])
     if verbose:
-        print('{} entries was found matching the old siemens PACS format (7 characters long with only numbers.)' .format(sum(df_dt['Accession Number'].str.match(r'^[0-9]{7}$'))))
+        print('{} entries was found matching the old siemens PACS format (7 characters long with only numbers.)' .format(old_format.sum()))
         print('These will be converted to the new Sectra PACS format by adding "MUAH_" in front of the number.')
 
     # Convert any entries of the df_dt['Accession Number'] that are 7 characters long and only contains numbers:
-    df_dt.loc[df_dt['Accession Number'].str.match(r'^[0-9]{7}$'), 'Accession Number'] = 'MUAH_' + \
-    df_dt.loc[df_dt['Accession Number'].str.match(r'^[0-9]{7}$'), 'Accession Number']
+    converted = 'MUAH_' + df_dt.loc[old_format, 'Accession Number'].astype(str)
+    if isinstance(df_dt['Accession Number'].dtype, pd.CategoricalDtype):
+        new_categories = pd.Index(converted.unique()).difference(df_dt['Accession Number'].cat.categories)
+        df_dt['Accession Number'] = df_dt['Accession Number'].cat.add_categories(new_categories)
+    df_dt.loc[old_format, 'Accession Number'] = converted
     return df_dt
 
-def check_accession_ids7_vs_dt(df_ids7, df_dt, verbose=False):
+def _mask_old_siemens_pacs_format(accessions):
+    """
+    This utility function returns a boolean array which is True for the old Siemens PACS accession numbers
+    (7 characters long with only numbers). Accession numbers that are not strings are never in the old format.
+    """
+    if not (pd.api.types.is_object_dtype(accessions) or pd.api.types.is_string_dtype(accessions)):
+        return np.zeros(len(accessions), dtype=bool)
+    return accessions.str.match(r'^[0-9]{7}$').to_numpy(dtype=bool, na_value=False)
+
+class AccessionIndex:
+    """
+    This class normalizes the accession numbers of IDS7 ('Henvisnings-ID') and DoseTrack ('Accession Number') once,
+    so that they can be reconciled without building new sets or running the same regular expressions again:
+    The old Siemens PACS accession numbers in DoseTrack are converted to the MUAH_ format (unless convert_old_format
+    is False), and all the accession numbers are stored as integer codes into one list of unique accession numbers
+    (categories), which is shared by both sources. The membership in IDS7 and DoseTrack, and whether the format is
+    valid (as in check_accession_format), is stored once per unique accession number.
+    Each lookup is then an array lookup by code, or a hash lookup for accession numbers given as values.
+
+    It is used by check_accession_ids7_vs_dt, check_accession_dt_vs_ids7 and merge_ids7_dt, and can be built once
+    and passed to these functions. It must then be built from the same (or unchanged) dataframes.
+
+    Example:
+        index = AccessionIndex(df_ids7['Henvisnings-ID'], df_dt['Accession Number'])
+        index.unmatched_ids7()          # Accession numbers in IDS7 that are not in DoseTrack
+        index.in_dt(['NRRH000000000001'])
+    """
+
+    def __init__(self, ids7_accessions, dt_accessions, convert_old_format=True):
+        ids7_accessions = pd.Series(ids7_accessions).reset_index(drop=True)
+        dt_accessions = pd.Series(dt_accessions).reset_index(drop=True)
+
+        # Convert the old Siemens PACS accession numbers in DoseTrack, with one pass of the regular expression:
+        old_format = _mask_old_siemens_pacs_format(dt_accessions) if convert_old_format else np.zeros(len(dt_accessions), dtype=bool)
+        self.n_converted = int(old_format.sum())
+        if self.n_converted > 0:
+            dt_accessions = dt_accessions.copy()
+            dt_accessions[old_format] = 'MUAH_' + dt_accessions[old_format]
+        self.dt_accessions = dt_accessions
+
+        # One code per unique accession number in both sources, missing accession numbers get the code -1:
+        codes, categories = pd.factorize(pd.concat([ids7_accessions, dt_accessions], ignore_index=True))
+        self.categories = pd.Index(categories)
+        self.ids7_codes = codes[:len(ids7_accessions)]
+        self.dt_codes = codes[len(ids7_accessions):]
+
+        # The lookup arrays have one extra element at the end, which is returned for the code -1:
+        self._in_ids7 = np.zeros(len(categories) + 1, dtype=bool)
+        self._in_ids7[self.ids7_codes[self.ids7_codes >= 0]] = True
+        self._in_dt = np.zeros(len(categories) + 1, dtype=bool)
+        self._in_dt[self.dt_codes[self.dt_codes >= 0]] = True
+        self._valid_format = None
+
+    def codes(self, accessions):
+        """
+        This function returns the integer codes of the accession numbers, -1 for accession numbers not in the index.
+        """
+        return self.categories.get_indexer(pd.Series(accessions))
+
+    def as_categorical(self, source):
+        """
+        This function returns the accession numbers of source ('ids7' or 'dt', with the old format converted)
+        as a categorical with the shared categories.
+        """
+        codes = self.ids7_codes if source == 'ids7' else self.dt_codes
+        return pd.Categorical.from_codes(codes, categories=self.categories)
+
+    def in_dt(self, accessions=None):
+        """
+        This function returns a boolean array which is True for the accession numbers that are in DoseTrack.
+        Default is the accession numbers in IDS7 the index was built from, in the same order.
+        """
+        codes = self.ids7_codes if accessions is None else self.codes(accessions)
+        return self._in_dt[codes]
+
+    def in_ids7(self, accessions=None):
+        """
+        This function returns a boolean array which is True for the accession numbers that are in IDS7.
+        Default is the accession numbers in DoseTrack the index was built from, in the same order.
+        """
+        codes = self.dt_codes if accessions is None else self.codes(accessions)
+        return self._in_ids7[codes]
+
+    def unmatched_ids7(self):
+        """
+        This function returns the unique accession numbers in IDS7 that are not in DoseTrack.
+        """
+        return self.categories[self._in_ids7[:-1] & ~self._in_dt[:-1]].to_numpy()
+
+    def unmatched_dt(self):
+        """
+        This function returns the unique accession numbers in DoseTrack that are not in IDS7.
+        """
+        return self.categories[self._in_dt[:-1] & ~self._in_ids7[:-1]].to_numpy()
+
+    def valid_format(self, accessions=None):
+        """
+        This function returns a boolean array which is True for the accession numbers with a valid format, as in
+        check_accession_format. The format is only checked once per unique accession number.
+        Default is the accession numbers in IDS7 the index was built from, in the same order.
+        """
+        if self._valid_format is None:
+            valid = _mask_accession_format(pd.DataFrame({'Henvisnings-ID': self.categories}))
+            self._valid_format = np.append(np.asarray(valid, dtype=bool), False)
+        codes = self.ids7_codes if accessions is None else self.codes(accessions)
+        return self._valid_format[codes]
+
+def check_accession_ids7_vs_dt(df_ids7, df_dt, verbose=False, index=None):
     """
     This function check whether the accession numbers in IDS7 are in DoseTrack.
     It will add a column to the ids7 dataframe called Henvisning_i_dt which is 
     True if the accession number is in DoseTrack and False otherwise.
+    Old Siemens PACS accession numbers in DoseTrack are converted to the MUAH_ format in df_dt.
     If verbose is True, the function will print the number of accession numbers in IDS7
     and the number of accession numbers in IDS7 not in DoseTrack.
+    An AccessionIndex built from the same dataframes can be passed as index, otherwise it is built here.
     """
     # Stop execution if the dataframe contains the column 'Fødselsnummer':
     if _check_for_fnr(df_ids7):
@@ -373,12 +859,18 @@ def check_accession_ids7_vs_dt(df_ids7, df_dt, verbose=False):
         print('\n')
         return df_ids7
     
-    # Check if the column 'Accession Number' contains the old Siemens PACS accession numbers (7 digits long and only numbers):
-    # If any such numbers are found, convert them to the new format:
-    if sum(df_dt['Accession Number'].str.match(r'^[0-9]{7}$')) > 0:
+    # Convert the old Siemens PACS accession numbers (7 digits long and only numbers) to the new format,
+    # only in the rows with such numbers:
+    if _mask_old_siemens_pacs_format(df_dt['Accession Number']).any():
         df_dt = _convert_old_siemens_pacs_accession_format(df_dt, verbose=verbose)
 
-    df_ids7['Henvisning_i_dt'] = df_ids7['Henvisnings-ID'].isin(df_dt['Accession Number'].values)
+    if index is None:
+        index = AccessionIndex(df_ids7['Henvisnings-ID'], df_dt['Accession Number'], convert_old_format=False)
+        in_dt = index.in_dt()
+    else:
+        in_dt = index.in_dt(df_ids7['Henvisnings-ID'])
+
+    df_ids7['Henvisning_i_dt'] = in_dt
     
     if verbose:
         print('Number of accession numbers in IDS7: {}'.format(len(df_ids7['Henvisnings-ID'].drop_duplicates())))
@@ -386,13 +878,14 @@ def check_accession_ids7_vs_dt(df_ids7, df_dt, verbose=False):
 
     return df_ids7
 
-def check_accession_dt_vs_ids7(df_dt, df_ids7, verbose=False):
+def check_accession_dt_vs_ids7(df_dt, df_ids7, verbose=False, index=None):
     """
     This function check whether the accession numbers in DoseTrack are in IDS7.
     It will add a column to the DoseTrack dataframe called Henvisning_i_ids7 which is 
     True if the accession number is in IDS7 and False otherwise.
     If verbose is True, the function will print the number of accession numbers in DoseTrack
     and the number of accession numbers in DoseTrack not in IDS7.
+    An AccessionIndex built from the same dataframes can be passed as index, otherwise it is built here.
     """
     # Stop execution if the dataframe contains the column 'Fødselsnummer':
     if _check_for_fnr(df_ids7):
@@ -409,7 +902,11 @@ def check_accession_dt_vs_ids7(df_dt, df_ids7, verbose=False):
         print('\n')
         return df_ids7
     
-    df_dt['Henvisning_i_ids7'] = df_dt['Accession Number'].isin(df_ids7['Henvisnings-ID'].values)
+    if index is None:
+        index = AccessionIndex(df_ids7['Henvisnings-ID'], df_dt['Accession Number'], convert_old_format=False)
+        df_dt['Henvisning_i_ids7'] = index.in_ids7()
+    else:
+        df_dt['Henvisning_i_ids7'] = index.in_ids7(df_dt['Accession Number'])
     
     if verbose:
         print('Number of accession numbers in DoseTrack: {}'.format(len(df_dt['Accession Number'].drop_duplicates())))
@@ -418,7 +915,16 @@ def check_accession_dt_vs_ids7(df_dt, df_ids7, verbose=False):
     return df_dt
 
 # Functions for attempting to detect and correct errrors in the datasets:
-def check_patents_with_multiple_bookings_on_same_time_with_different_accession(df_ids7):
+def _print_multiple_accessions(suspects, time_column):
+    """
+    This utility function prints one message per patient and booking time/day in the dataframe of suspect groups.
+    """
+    for (patient, booking), group in suspects.groupby(['Pasient', time_column], sort=False):
+        print('Patient: ' + str(patient) + ' has multiple accession numbers at ' + str(booking) + ':')
+        print(group['Henvisnings-ID'].drop_duplicates().tolist())
+        print('')
+
+def check_patents_with_multiple_bookings_on_same_time_with_different_accession(df_ids7, verbose=True):
     """
     This function is used to report whether there are patients with multiple bookings on the
     same time with different accession numbers. This is useful in order to check whether there is a large 
@@ -427,6 +933,8 @@ def check_patents_with_multiple_bookings_on_same_time_with_different_accession(d
     Many of these were cancelled procedusres, and should be removed in data filtration.
     Others were infact the same procedure. These shoudl have their accession number changed to the one
     reported in the dosetrack data.
+    Returns a dataframe with one row per patient, booking time and accession number for the suspect bookings,
+    along with the number of accession numbers at that booking time. If verbose is True, the suspects are printed.
     """
     # Stop execution if the dataframe contains the column 'Fødselsnummer':
     if _check_for_fnr(df_ids7):
@@ -451,28 +959,20 @@ def check_patents_with_multiple_bookings_on_same_time_with_different_accession(d
         print('\n')
         return
     
-    # Make a list of all patients with multiple bookings on the same day with different accession numbers:
-    patient_list = df_ids7['Pasient'].drop_duplicates()
-    for patient in patient_list:
-        # Get the booking times for this patient:
-        booking_times = df_ids7[df_ids7['Pasient'] == patient]['Bestilt dato og tidspunkt']
-        # Sort the booking times:
-        booking_times = booking_times.sort_values()
-        # if there is more than one booking:
-        if len(booking_times) > 1:
-            # loop through all bookings:
-            for i in range(len(booking_times)-1):
-                # Check if the booking times are on the same day but different time with different accesstion numbers:
-                if (booking_times.iloc[i] == booking_times.iloc[i+1]):
-                    # Get the accession numbers:
-                    acc_no = df_ids7[(df_ids7['Pasient'] == patient) & (df_ids7['Bestilt dato og tidspunkt'] == booking_times.iloc[i])]['Henvisnings-ID'].drop_duplicates()
-                    # Check if there are multiple accession numbers:
-                    if len(acc_no) > 1:
-                        print('Patient: ' + str(patient) + ' has multiple accession numbers at ' + str(booking_times.iloc[i]) + ':')
-                        print(acc_no)
-                        print('')
-
-def check_patents_with_multiple_bookings_on_same_day_with_different_accession(df_ids7):
+    # Count the number of different accession numbers for each patient and booking time in one groupby:
+    bookings = df_ids7[['Pasient', 'Bestilt dato og tidspunkt', 'Henvisnings-ID']].drop_duplicates()
+    n_accessions = bookings.groupby(['Pasient', 'Bestilt dato og tidspunkt'])['Henvisnings-ID'].transform('nunique')
+
+    # Keep the bookings with more than one accession number at the same time:
+    suspects = bookings[n_accessions > 1].assign(**{'Number of accessions': n_accessions[n_accessions > 1]})
+    suspects = suspects.sort_values(by=['Pasient', 'Bestilt dato og tidspunkt', 'Henvisnings-ID']).reset_index(drop=True)
+
+    if verbose:
+        _print_multiple_accessions(suspects, 'Bestilt dato og tidspunkt')
+
+    return suspects
+
+def check_patents_with_multiple_bookings_on_same_day_with_different_accession(df_ids7, verbose=True):
     """
     This function is used to report whether there are patients with multiple bookings on the
     same day (not on the same time, as they are included in the data curation) with
@@ -480,6 +980,8 @@ def check_patents_with_multiple_bookings_on_same_day_with_different_accession(df
     number of patients with multiple rows of data that must be merged.
     On an earlier run with 4000 lines from the PACS only two cases was found.
     Both cases included cancelled procedures.
+    Returns a dataframe with one row per patient, booking day, booking time and accession number for the suspect
+    bookings, along with the number of accession numbers that day. If verbose is True, the suspects are printed.
     """
     # Stop execution if the dataframe contains the column 'Fødselsnummer':
     if _check_for_fnr(df_ids7):
@@ -503,28 +1005,55 @@ def check_patents_with_multiple_bookings_on_same_day_with_different_accession(df
         print('\n')
         return 
 
-    # Make a list of all patients with multiple bookings on the same day with different accession numbers:
-    patient_list = df_ids7['Pasient'].drop_duplicates()
-    for patient in patient_list:
-        # Get the booking times for this patient:
-        booking_times = df_ids7[df_ids7['Pasient'] == patient]['Bestilt dato og tidspunkt']
-        # Sort the booking times:
-        booking_times = booking_times.sort_values()
-        # if there is more than one booking:
-        if len(booking_times) > 1:
-            # loop through all bookings:
-            for i in range(len(booking_times)-1):
-                # Check if the booking times are on the same day but different time with different accesstion numbers:
-                if (booking_times.iloc[i].date() == booking_times.iloc[i+1].date()) & (booking_times.iloc[i].time() != booking_times.iloc[i+1].time()):
-                    # Get the accession numbers:
-                    acc_no = df_ids7[(df_ids7['Pasient'] == patient) & (df_ids7['Bestilt dato og tidspunkt'] == booking_times.iloc[i])]['Henvisnings-ID'].drop_duplicates()
-                    # Check if there are multiple accession numbers:
-                    if len(acc_no) > 1:
-                        print('Patient: ' + str(patient) + ' has multiple accession numbers at ' + str(booking_times.iloc[i].date()) + ':')
-                        print(acc_no)
-                        print('')
-
-def overwrite_duplicated_accession_numbers(df_ids7, df_dt, verbose=False, manual_replace=False):
+    # Count the number of different booking times and accession numbers for each patient and booking day in one groupby:
+    bookings = df_ids7[['Pasient', 'Bestilt dato og tidspunkt', 'Henvisnings-ID']].drop_duplicates()
+    bookings.insert(1, 'Bestilt dato', bookings['Bestilt dato og tidspunkt'].dt.date)
+    grouped = bookings.groupby(['Pasient', 'Bestilt dato'])
+    n_times = grouped['Bestilt dato og tidspunkt'].transform('nunique')
+    n_accessions = grouped['Henvisnings-ID'].transform('nunique')
+
+    # Keep the days with bookings at different times with different accession numbers:
+    is_suspect = (n_times > 1) & (n_accessions > 1)
+    suspects = bookings[is_suspect].assign(**{'Number of accessions': n_accessions[is_suspect]})
+    suspects = suspects.sort_values(by=['Pasient', 'Bestilt dato og tidspunkt', 'Henvisnings-ID']).reset_index(drop=True)
+
+    if verbose:
+        _print_multiple_accessions(suspects, 'Bestilt dato')
+
+    return suspects
+
+def _find_duplicated_accession_groups(df_ids7):
+    """
+    This utility function finds all patients and booking times with several accession numbers,
+    where some of the accession numbers are in DoseTrack and some are not (column: 'Henvisning_i_dt').
+    The status of each accession number is taken from its first row, and all groups are found in one groupby.
+    Returns a dataframe (queue) with one row per patient and booking time, sorted by the order of the patients in
+    the IDS7 data and the booking time, with the columns:
+    Pasient, Bestilt dato og tidspunkt, Henvisnings-ID (all accession numbers), In_dt, Not_in_dt and Ambiguous.
+    A group is ambiguous if more than one of the accession numbers are in DoseTrack.
+    """
+    # One row per accession number per patient and booking time:
+    accessions = df_ids7.drop_duplicates(subset=['Pasient', 'Bestilt dato og tidspunkt', 'Henvisnings-ID'])
+    accessions = accessions[['Pasient', 'Bestilt dato og tidspunkt', 'Henvisnings-ID', 'Henvisning_i_dt']]
+    accessions = accessions.assign(Patient_order=pd.factorize(accessions['Pasient'])[0])
+
+    # Count the accession numbers, and the accession numbers in DoseTrack, for each patient and booking time:
+    grouped = accessions.groupby(['Pasient', 'Bestilt dato og tidspunkt'])
+    n_accessions = grouped['Henvisnings-ID'].transform('size')
+    n_in_dt = grouped['Henvisning_i_dt'].transform('sum')
+    accessions = accessions[(n_accessions > 1) & (n_in_dt > 0) & (n_in_dt < n_accessions)]
+
+    # Make one row per patient and booking time:
+    in_dt = accessions['Henvisning_i_dt'] == True
+    queue = accessions.groupby(['Pasient', 'Bestilt dato og tidspunkt'], sort=False).agg(
+        **{'Henvisnings-ID': ('Henvisnings-ID', list), 'Patient_order': ('Patient_order', 'first')})
+    queue['In_dt'] = accessions[in_dt].groupby(['Pasient', 'Bestilt dato og tidspunkt'], sort=False)['Henvisnings-ID'].agg(list)
+    queue['Not_in_dt'] = accessions[~in_dt].groupby(['Pasient', 'Bestilt dato og tidspunkt'], sort=False)['Henvisnings-ID'].agg(list)
+    queue['Ambiguous'] = [len(acc) > 1 for acc in queue['In_dt']]
+    queue = queue.reset_index().sort_values(by=['Patient_order', 'Bestilt dato og tidspunkt'])
+    return queue.drop('Patient_order', axis=1).reset_index(drop=True)
+
+def overwrite_duplicated_accession_numbers(df_ids7, df_dt, verbose=False, manual_replace=False, index=None):
     """
     For a few patients having a procedure, there has been created two accession numbers in IDS7.
     DoseTrack will only use one of these if the patient only got one procedure.
@@ -532,6 +1061,9 @@ def overwrite_duplicated_accession_numbers(df_ids7, df_dt, verbose=False, manual
     If only one of these are in dosetrack while the rest is not, the accession number will be overwritten by the accession number
     used by dosetrack. If both or non of the accesssion numbers are in used, they remain untouched.
     After the accession numbers have been overwritten the function check_accession_ids7_vs_dt is run from this function.
+    An AccessionIndex of the data can be passed as index, and is then used by check_accession_ids7_vs_dt.
+    The accession numbers are only overwritten with accession numbers in DoseTrack, so the index can still be used
+    for the membership in DoseTrack afterwards, but not for the membership in IDS7.
     """
     # Stop execution if the dataframe contains the column 'Fødselsnummer':
     if _check_for_fnr(df_ids7):
@@ -561,92 +1093,84 @@ def overwrite_duplicated_accession_numbers(df_ids7, df_dt, verbose=False, manual
         # If not, run the function check_accession_ids7_vs_dt:
         if verbose:
             print('The column Henvisning_i_dt does not exist. Running check_accession_ids7_vs_dt')
-        df_ids7 = check_accession_ids7_vs_dt(df_ids7, df_dt, verbose=verbose)
+        df_ids7 = check_accession_ids7_vs_dt(df_ids7, df_dt, verbose=verbose, index=index)
 
-    # Go through all the patients in the IDS7 data:
-    patient_list = df_ids7['Pasient'].unique()
+    # Find all the patients and booking times with several accession numbers, where some are in DoseTrack and some are not:
+    queue = _find_duplicated_accession_groups(df_ids7)
     status_changed = False
-    for patient in patient_list:
-        # Go through all the individual booking times for this patient:
-        booking_times = sorted(df_ids7[df_ids7['Pasient'] == patient]['Bestilt dato og tidspunkt'].unique())
-        for time in booking_times:
-            # Get the accession number for this patient at this booking time:
-            acc_nr = df_ids7[(df_ids7['Pasient'] == patient) & (df_ids7['Bestilt dato og tidspunkt'] == time)]['Henvisnings-ID'].unique()
-            # Check if there is more than one accession number for this patient at this time:
-            if len(acc_nr) > 1:
-                # Make a pandas series with accession numbers as index and true/false as values:
-                acc_nr_in_dt = pd.Series(index=acc_nr, data = np.nan)
-                # Go through all the accession numbers for this patient at this time:
-                for acc in acc_nr:
-                    # Check if the accession number is in the DoseTrack data:
-                    acc_nr_in_dt[acc] = df_ids7[(df_ids7['Pasient'] == patient) & (df_ids7['Bestilt dato og tidspunkt'] == time) & \
-                                                (df_ids7['Henvisnings-ID'] == acc)]['Henvisning_i_dt'].values[0]
-                # Check if there are both true and false values:
-                if acc_nr_in_dt.nunique() > 1:
-                    # Warn the user that there might be ambigous data regarding this procedure if there are several true and at least one false:
-                    if len(acc_nr_in_dt[acc_nr_in_dt == True]) > 1 and len(acc_nr_in_dt[acc_nr_in_dt == False]) > 0:
-                        print('WARNING: there are two or more accessions with data in dosetrack and at least one without.')
-                        print('Please investigate patient: ' + str(patient) + ', time: ' + str(time) + ', accession numbers: ' + str(acc_nr))
-                        # Loop to help the user manually enter the accession number that should be used:
-                        if manual_replace:
-                            while True:
-                                # Get the user to enter the accession number that should be used:
-                                print('\n')
-                                print('Please enter the accession number that should be used:')
-                                # List the accession numbers without data in dosetrack along with descriptions:
-                                print('Accession numbers without data in dosetrack:')
-                                for acc in acc_nr_in_dt[acc_nr_in_dt == False].index:
-                                    print(acc + ', Beskrivelse: ')
-                                    for beskrivelse in df_ids7[(df_ids7['Pasient'] == patient) & (df_ids7['Bestilt dato og tidspunkt'] == time) & \
-                                                (df_ids7['Henvisnings-ID'] == acc)]['Beskrivelse']:
-                                        print(beskrivelse)
-                                # List the accession numbers with data in dosetrack along with descriptions:
-                                print('\n')
-                                print('Accession numbers with data in dosetrack:')
-                                for acc in acc_nr_in_dt[acc_nr_in_dt == True].index:
-                                    print(acc + ', Beskrivelse: ')
-                                    for beskrivelse in df_ids7[(df_ids7['Pasient'] == patient) & (df_ids7['Bestilt dato og tidspunkt'] == time) & \
-                                                (df_ids7['Henvisnings-ID'] == acc)]['Beskrivelse']:
-                                        print(beskrivelse)                                   
-                                manual_input = input()
-                                # Check if the accession number is in the list of accession numbers for this patient at this time with data in dosetrack:
-                                if manual_input in acc_nr_in_dt[acc_nr_in_dt == True].index:
-                                    # Insert the manually entered accession number into all the rows for the same patient and booking with no dosetrack data:
-                                    df_ids7.loc[(df_ids7['Pasient'] == patient) & \
-                                                (df_ids7['Bestilt dato og tidspunkt'] == time) & \
-                                                (df_ids7['Henvisning_i_dt'] == False) \
-                                                , 'Henvisnings-ID'] = manual_input
-                                    status_changed = True
-                                    print('Inserted accession number: ' + str(manual_input) + ' for patient: ' + str(patient) + ', time: ' + str(time) + ' for elements not in dosetrack.')
-                                    break
-                                print('WARNING!!! The accession number you entered is not in the list of accession numbers with data in dosetrack.')
-                        else:
-                            print('Switch the manual_replace flag to True to enable manual accession number replacement.')
-                    else:
-                        # Insert the accession number which is included in the DoseTrack data into all the rows for the same 
-                        # patient and booking with no dosetrack data:
-                        df_ids7.loc[(df_ids7['Pasient'] == patient) & \
-                                    (df_ids7['Bestilt dato og tidspunkt'] == time) & \
-                                    (df_ids7['Henvisning_i_dt'] == False) \
-                                    , 'Henvisnings-ID'] = acc_nr_in_dt[acc_nr_in_dt == True].index[0]
+
+    # Go through the queue in the order of the patients in the IDS7 data and the booking times:
+    # The columns are renamed to identifiers, so that they can be used as attributes of each group:
+    groups = queue.rename(columns={'Bestilt dato og tidspunkt': 'Booking_time', 'Henvisnings-ID': 'Accessions'})
+    for group in groups.itertuples(index=False):
+        patient, time, acc_nr = group.Pasient, group.Booking_time, np.array(group.Accessions, dtype=object)
+        # Warn the user that there might be ambigous data regarding this procedure if there are several true and at least one false:
+        if group.Ambiguous:
+            print('WARNING: there are two or more accessions with data in dosetrack and at least one without.')
+            print('Please investigate patient: ' + str(patient) + ', time: ' + str(time) + ', accession numbers: ' + str(acc_nr))
+            # Loop to help the user manually enter the accession number that should be used:
+            if manual_replace:
+                is_group = (df_ids7['Pasient'] == patient) & (df_ids7['Bestilt dato og tidspunkt'] == time)
+                while True:
+                    # Get the user to enter the accession number that should be used:
+                    print('\n')
+                    print('Please enter the accession number that should be used:')
+                    # List the accession numbers without data in dosetrack along with descriptions:
+                    print('Accession numbers without data in dosetrack:')
+                    for acc in group.Not_in_dt:
+                        print(acc + ', Beskrivelse: ')
+                        for beskrivelse in df_ids7[is_group & (df_ids7['Henvisnings-ID'] == acc)]['Beskrivelse']:
+                            print(beskrivelse)
+                    # List the accession numbers with data in dosetrack along with descriptions:
+                    print('\n')
+                    print('Accession numbers with data in dosetrack:')
+                    for acc in group.In_dt:
+                        print(acc + ', Beskrivelse: ')
+                        for beskrivelse in df_ids7[is_group & (df_ids7['Henvisnings-ID'] == acc)]['Beskrivelse']:
+                            print(beskrivelse)                                   
+                    manual_input = input()
+                    # Check if the accession number is in the list of accession numbers for this patient at this time with data in dosetrack:
+                    if manual_input in group.In_dt:
+                        # Insert the manually entered accession number into all the rows for the same patient and booking with no dosetrack data:
+                        df_ids7.loc[is_group & (df_ids7['Henvisning_i_dt'] == False), 'Henvisnings-ID'] = manual_input
                         status_changed = True
-                        print('Inserted accession number: ' + str(acc_nr_in_dt[acc_nr_in_dt == True].index[0]) + \
-                            ' for patient: ' + str(patient) + ', time: ' + str(time) + ', accession numbers: ' + str(acc_nr))
+                        print('Inserted accession number: ' + str(manual_input) + ' for patient: ' + str(patient) + ', time: ' + str(time) + ' for elements not in dosetrack.')
+                        break
+                    print('WARNING!!! The accession number you entered is not in the list of accession numbers with data in dosetrack.')
+            else:
+                print('Switch the manual_replace flag to True to enable manual accession number replacement.')
+        else:
+            print('Inserted accession number: ' + str(group.In_dt[0]) + \
+                ' for patient: ' + str(patient) + ', time: ' + str(time) + ', accession numbers: ' + str(acc_nr))
+
+    # Insert the accession number which is included in the DoseTrack data into all the rows for the same 
+    # patient and booking with no dosetrack data, for all the unambiguous groups at once:
+    resolved = queue[~queue['Ambiguous']]
+    if len(resolved) > 0:
+        replacement = pd.Series([acc[0] for acc in resolved['In_dt']],
+                                index=pd.MultiIndex.from_frame(resolved[['Pasient', 'Bestilt dato og tidspunkt']]))
+        replacement = replacement.reindex(pd.MultiIndex.from_frame(df_ids7[['Pasient', 'Bestilt dato og tidspunkt']])).to_numpy()
+        is_replaced = pd.notna(replacement) & (df_ids7['Henvisning_i_dt'] == False).to_numpy()
+        df_ids7.loc[is_replaced, 'Henvisnings-ID'] = replacement[is_replaced]
+        status_changed = True
+
     if status_changed:
         # Run the function check_accession_ids7_vs_dt again to update the column Henvisning_i_dt:
         if verbose:
             print('The accession numbers have been changed. Running check_accession_ids7_vs_dt')
-        df_ids7 = check_accession_ids7_vs_dt(df_ids7, df_dt, verbose=verbose)
+        df_ids7 = check_accession_ids7_vs_dt(df_ids7, df_dt, verbose=verbose, index=index)
 
     return df_ids7
 
 # Funciton for merging IDS7 and DoseTrack dataframes:
-def merge_ids7_dt(df_ids7, df_dt, verbose=False):
+def merge_ids7_dt(df_ids7, df_dt, verbose=False, index=None):
     """ 
     This function merged the data from IDS7 and DoseTrack based on accession number.
     In the process of preparing the merge of the IDS7 data, all the procedure descriptions for the same 
     accession number are concatenated into one string.
     For the DoseTrack data, the sum of the DAP, CAK and F+A Time are calculated for each accession number.
+    If an AccessionIndex is passed as index, the data is merged on the integer codes of the accession numbers
+    instead of the strings.
     """
     # Stop execution if the dataframe contains the column 'Fødselsnummer':
     if _check_for_fnr(df_ids7):
@@ -670,9 +1194,8 @@ def merge_ids7_dt(df_ids7, df_dt, verbose=False):
         print('\n')
         return False
 
-    # Prepare the manditory IDS7 data for merge:
-    agg_dict_ids7 = {'Henvisnings-ID': 'first', 
-                     'Beskrivelse': _concatenate_protocol}
+    # Prepare the manditory IDS7 data for merge (the descriptions are concatenated separately below):
+    agg_dict_ids7 = {'Henvisnings-ID': 'first'}
     
     # Herer users can list all optional columns that should be included in the merge. If these do not exist in the data they are ignored.
     # prepare the optional IDS7 data for merge:
@@ -685,25 +1208,35 @@ def merge_ids7_dt(df_ids7, df_dt, verbose=False):
     # Prepare the manditory DoseTrack data for merge:
     agg_dict_dt = {'Accession Number': 'first'}
     
-    # Herer users can list all optional columns that should be included in the merge. If these do not exist in the data they are ignored.
-    # prepare the optional DoseTrack data for merge:
-    agg_dict_dt_optional = {'Study Date': 'first',
-                            'Age (Years)': 'first',
-                            'DAP Total (Gy*cm2)': 'sum',
-                            'CAK (mGy)': 'sum',
-                            'F+A Time (s)': 'sum',
-                            'Modality Room': 'first'}
-    
-    agg_dict_dt = _add_optional_columns(df_dt, agg_dict_dt, agg_dict_dt_optional, 'DoseTrack', verbose=verbose)
+    # The optional DoseTrack columns are listed in DT_AGGREGATION_OPTIONAL. If these do not exist in the data they are ignored.
+    agg_dict_dt = _add_optional_columns(df_dt, agg_dict_dt, DT_AGGREGATION_OPTIONAL, 'DoseTrack', verbose=verbose)
 
     
-    df_ids7_to_merge = df_ids7[df_ids7['Henvisning_i_dt'] == True].groupby('Henvisnings-ID', as_index = False).agg(agg_dict_ids7)
+    df_ids7 = df_ids7[df_ids7['Henvisning_i_dt'] == True]
+    df_ids7_to_merge = df_ids7.groupby('Henvisnings-ID', as_index = False).agg(agg_dict_ids7)
+
+    # Concatenate the sorted descriptions for each accession number, by sorting the whole dataframe once:
+    df_protocols = df_ids7[['Henvisnings-ID', 'Beskrivelse']].dropna(subset=['Henvisnings-ID'])
+    df_protocols = _join_sorted_groups(df_protocols.sort_values(['Henvisnings-ID', 'Beskrivelse']), ['Henvisnings-ID'], 'Beskrivelse')
+    protocols = df_protocols.set_index('Henvisnings-ID')['Beskrivelse']
+    df_ids7_to_merge.insert(1, 'Beskrivelse', protocols.reindex(df_ids7_to_merge['Henvisnings-ID']).to_numpy())
 
     # Prepare the DoseTrack data for merge:
     df_dt_to_merge = df_dt[df_dt['Henvisning_i_ids7'] == True].groupby('Accession Number', as_index = False).agg(agg_dict_dt)
     
     # Merge the IDS7 and DoseTrack data:
-    data = pd.merge(df_ids7_to_merge, df_dt_to_merge, how='outer', left_on='Henvisnings-ID', right_on='Accession Number')
+    ids7_codes = index.codes(df_ids7_to_merge['Henvisnings-ID']) if index is not None else None
+    dt_codes = index.codes(df_dt_to_merge['Accession Number']) if index is not None else None
+    if index is not None and (ids7_codes >= 0).all() and (dt_codes >= 0).all():
+        data = pd.merge(df_ids7_to_merge.assign(_code=ids7_codes), df_dt_to_merge.assign(_code=dt_codes), how='outer', on='_code')
+        # Sort the rows by accession number, as the merge on the strings does:
+        rank = np.empty(len(index.categories), dtype=np.int64)
+        rank[index.categories.argsort()] = np.arange(len(index.categories))
+        data = data.iloc[np.argsort(rank[data['_code'].to_numpy()], kind='stable')].drop(columns='_code').reset_index(drop=True)
+    else:
+        if index is not None:
+            print('WARNING: Some accession numbers are not in the index, the data is merged on the accession numbers instead.')
+        data = pd.merge(df_ids7_to_merge, df_dt_to_merge, how='outer', left_on='Henvisnings-ID', right_on='Accession Number')
     
     # Drop the redundant column:
     data.drop('Henvisnings-ID', axis=1, inplace=True)
@@ -713,35 +1246,140 @@ def merge_ids7_dt(df_ids7, df_dt, verbose=False):
 
     return data
 
+# The row filters of the cleanup, in the order they are applied: the column they need, the mask of the rows to keep,
+# the message for the number of removed rows and the message if the column is missing.
+CLEANUP_FILTERS = {'filter_NaT': ('Bestilt dato og tidspunkt', _mask_NaT,
+                                  'Number of rows with NaT in the column "Bestilt dato og tidspunkt": {}',
+                                  ['Without this column, we cannot remove rows with NaT in the column "Bestilt dato og tidspunkt".']),
+                   'filter_cancelled': ('Avbrutt', _mask_cancelled,
+                                        'Number of cancelled procedures: {}',
+                                        ['Without this column, we cannot remove cancelled procedures.']),
+                   'filter_phantom_etc': ('Henvisningskategori (RIS)', _mask_phantom_etc,
+                                          'Number of non-human subjects: {}',
+                                          ['Without this column, we cannot remove non-human subjects, such as phantoms, animals or other test acquisitions.',
+                                           'This could potentially lead to reduced data quality.']),
+                   'check_accession_format': ('Henvisnings-ID', _mask_accession_format,
+                                              'Number of rows with invalid accession number: {}',
+                                              ['Without this column, we cannot check the accession number format, or merge IDS7 with DoseTrack data.'])}
+
+class CleanupPipeline:
+    """
+    This class runs remove_unnecessary_columns and the row filters in CLEANUP_FILTERS (filter_NaT, filter_cancelled,
+    filter_phantom_etc and check_accession_format) on the IDS7 dataframe in one pass.
+    The check for 'Fødselsnummer' and the column checks are done once, the masks of all the filters are combined
+    into one, and the dataframe is only copied once when the combined mask is applied.
+    The result is the same as running the filter functions one after the other.
+    After run, the attribute report is a dataframe with one row per filter and the columns:
+    Filter, Applied (False if the column is missing), Rows flagged (by this filter alone),
+    Rows removed (not already removed by an earlier filter) and Rows left.
+
+    Example:
+        pipeline = CleanupPipeline()
+        df_ids7 = pipeline.run(df_ids7, verbose=True)
+        pipeline.report
+    """
+
+    def __init__(self, filters=None):
+        """
+        filters is a list of the names of the filters to use, in the order of CLEANUP_FILTERS. Default is all filters.
+        """
+        if filters is None:
+            filters = list(CLEANUP_FILTERS.keys())
+        for name in filters:
+            if name not in CLEANUP_FILTERS:
+                print('WARNING: Unknown filter "' + name + '" is ignored. The filters are: ' + ', '.join(CLEANUP_FILTERS.keys()))
+        self.filters = [name for name in CLEANUP_FILTERS.keys() if name in filters]
+        self.report = None
+
+    def run(self, df_ids7, verbose=False):
+        """
+        This function runs the pipeline on the IDS7 dataframe and returns the filtered dataframe.
+        """
+        # Stop execution if the dataframe contains the column 'Fødselsnummer':
+        if _check_for_fnr(df_ids7):
+            return df_ids7
+
+        df_ids7 = remove_unnecessary_columns(df_ids7, verbose=verbose)
+        keep = np.ones(len(df_ids7), dtype=bool)
+        report = []
+        for name in self.filters:
+            column, mask_function, count_message, missing_message = CLEANUP_FILTERS[name]
+            if not _check_for_column(df_ids7, 'IDS7', column):
+                for line in missing_message:
+                    print(line)
+                print('\n')
+                report.append({'Filter': name, 'Applied': False, 'Rows flagged': 0, 'Rows removed': 0, 'Rows left': int(keep.sum())})
+                continue
+
+            mask = mask_function(df_ids7).to_numpy(dtype=bool, na_value=False)
+            removed = keep & ~mask
+            keep &= mask
+            if verbose:
+                print(count_message.format(removed.sum()))
+                # Print the invalid accession numbers:
+                if name == 'check_accession_format' and removed.sum() > 0:
+                    print(df_ids7[removed]['Henvisnings-ID'])
+                    print(validate_accession_format(df_ids7.loc[removed, 'Henvisnings-ID']).to_string(index=False))
+            report.append({'Filter': name, 'Applied': True, 'Rows flagged': int((~mask).sum()),
+                           'Rows removed': int(removed.sum()), 'Rows left': int(keep.sum())})
+
+        self.report = pd.DataFrame(report, columns=['Filter', 'Applied', 'Rows flagged', 'Rows removed', 'Rows left'])
+        if verbose:
+            print(self.report.to_string(index=False))
+            print('\n')
+        return df_ids7[keep]
+
 # Utility function to run all filters and checks:
-def run_all_cleanup_filters_and_checks(df_ids7, df_dt, verbose=False, manual_replace=False):
+def run_all_cleanup_filters_and_checks(df_ids7, df_dt, verbose=False, manual_replace=False, return_report=False, return_index=False):
     """
     This utilityfunction runs the following funcions:
-    filter_NaT
-    remove_unnecessary_columns
-    filter_cancelled
-    filter_phantom_etc
-    check_accession_format
+    remove_unnecessary_columns, filter_NaT, filter_cancelled, filter_phantom_etc and check_accession_format 
+    (in one pass with CleanupPipeline)
     check_accession_ids7_vs_dt
     overwrite_duplicated_accession_numbers
+    check_accession_dt_vs_ids7
+    The old Siemens PACS accession numbers in df_dt are converted first, and one AccessionIndex is then built and
+    shared by the checks. It is only built again if overwrite_duplicated_accession_numbers changes any accession numbers.
+    If return_report is True, the report from CleanupPipeline with the number of rows removed by each filter is also returned.
+    If return_index is True, the AccessionIndex is also returned (last), so that it can be passed to merge_ids7_dt.
     """
-    df_ids7 = remove_unnecessary_columns(df_ids7, verbose=verbose)
-    df_ids7 = filter_NaT(df_ids7, verbose=verbose)
-    df_ids7 = filter_cancelled(df_ids7, verbose=verbose)
-    df_ids7 = filter_phantom_etc(df_ids7, verbose=verbose)
-    df_ids7 = check_accession_format(df_ids7, verbose=verbose)
-    df_ids7 = check_accession_ids7_vs_dt(df_ids7, df_dt, verbose=verbose)
-    df_ids7 = overwrite_duplicated_accession_numbers(df_ids7, df_dt, verbose=verbose, manual_replace=manual_replace)
-    df_dt   = check_accession_dt_vs_ids7(df_dt, df_ids7, verbose=verbose)
-
-    return df_ids7
+    pipeline = CleanupPipeline()
+    df_ids7 = pipeline.run(df_ids7, verbose=verbose)
+
+    index = None
+    if 'Henvisnings-ID' in df_ids7.columns and 'Accession Number' in df_dt.columns:
+        if _mask_old_siemens_pacs_format(df_dt['Accession Number']).any():
+            df_dt = _convert_old_siemens_pacs_accession_format(df_dt, verbose=verbose)
+        index = AccessionIndex(df_ids7['Henvisnings-ID'], df_dt['Accession Number'], convert_old_format=False)
+
+    df_ids7 = check_accession_ids7_vs_dt(df_ids7, df_dt, verbose=verbose, index=index)
+    accessions_before = df_ids7['Henvisnings-ID'].copy() if index is not None else None
+    df_ids7 = overwrite_duplicated_accession_numbers(df_ids7, df_dt, verbose=verbose, manual_replace=manual_replace, index=index)
+
+    # The membership in IDS7 changes if any accession numbers have been overwritten:
+    if index is not None and not df_ids7['Henvisnings-ID'].equals(accessions_before):
+        index = AccessionIndex(df_ids7['Henvisnings-ID'], df_dt['Accession Number'], convert_old_format=False)
+    df_dt   = check_accession_dt_vs_ids7(df_dt, df_ids7, verbose=verbose, index=index)
+
+    result = (df_ids7,)
+    if return_report:
+        result += (pipeline.report,)
+    if return_index:
+        result += (index,)
+    return result[0] if len(result) == 1 else result
 
 # Functions for exporting the data:
-def export_examination_codes_to_text_file(df_data, laboratory=None):
+def export_examination_codes_to_text_file(df_data, laboratory=None, output=None):
     """
     This function exports the examination codes for all laboratories (if no laboratory argument is given),
     or for a specific laboratory (if the laboratory argument is given).
     The input is the dataframe with the IDS7 data and the name of the lab as a string.
+    The unique codes ('Beskrivelse') of each accession number are sorted and joined into one string, and the number
+    of accession numbers with each combination of codes is counted, for all labs in one pass.
+    By default one text file per lab is written to the Reports folder. If output is given, one table with the
+    columns lab, 'Codes' and 'n' for all labs is written to this file instead, as CSV or parquet depending on the
+    file extension (.csv or .parquet).
+    Returns the table with the number of accession numbers for each combination of codes per lab.
     """
 
     # The following two statements enables the function to work with both the IDS7 and the merged data.
@@ -774,8 +1412,6 @@ def export_examination_codes_to_text_file(df_data, laboratory=None):
         print('\n')
         return
     
-    # Iterate through all the labs in the dataset:
-    
     # Filter the dataset to only include the the given lab is lab is not None:
     if laboratory is not None:
         df_data = df_data[df_data[lab_col] == laboratory]
@@ -783,38 +1419,36 @@ def export_examination_codes_to_text_file(df_data, laboratory=None):
             print('No rows with the given lab: ' + laboratory)
             return
 
-    for lab in df_data[lab_col].unique():
-        df_lab = df_data[df_data[lab_col] == lab]
-        # Exit function with an error if there are no rows with the given lab:
-        if len(df_lab) == 0:
-            print('No rows with the given lab: ' + lab)
-            return
-
-        # Make an pandas series with an index of the accession numbers that store the codes:
-        codes = pd.Series(index = df_lab[accession_col].unique())
-        for accession_no in codes.index:
-            procedure = df_lab[df_lab[accession_col] == accession_no]['Beskrivelse'].unique()
-            procedure.sort()
-            # Merge all the codes into one string:
-            code = ''
-            for i in procedure:
-                code += i + ', '
-            # Remove the last comma and space:
-            code = code[:-2]
-            # Store the code in the series:
-            codes[accession_no] = code
-
-        # Make a list of unique codes:
-        unique_codes = codes.unique()
-        # Sort the list:
-        unique_codes.sort()
-        # Export the list to a text file in the Reports folder:
-        if not os.path.exists('Reports'):
-                os.makedirs('Reports')
+    # Keep the unique codes per lab and accession number, sorted so that they are joined in alphabetical order:
+    df_codes = df_data[[lab_col, accession_col, 'Beskrivelse']].dropna().drop_duplicates()
+    df_codes = df_codes.astype(str).sort_values([lab_col, accession_col, 'Beskrivelse'], ignore_index=True)
+
+    # Join the codes of each lab and accession number:
+    codes = _join_sorted_groups(df_codes, [lab_col, accession_col], 'Beskrivelse').rename(columns={'Beskrivelse': 'Codes'})
+
+    # Count the number of accession numbers with each combination of codes per lab:
+    df_freq = codes.value_counts([lab_col, 'Codes']).rename('n').reset_index()
+    df_freq = df_freq.sort_values([lab_col, 'Codes'], ignore_index=True)
+
+    if output is not None:
+        if os.path.dirname(output) and not os.path.exists(os.path.dirname(output)):
+            os.makedirs(os.path.dirname(output))
+        if output.endswith('.csv'):
+            df_freq.to_csv(output, index=False)
+        elif output.endswith('.parquet'):
+            df_freq.to_parquet(output, index=False)
+        else:
+            print('WARNING: Unknown file extension for ' + output + '. Use .csv or .parquet.')
+        return df_freq
+
+    # Export the list for each lab to a text file in the Reports folder:
+    if not os.path.exists('Reports'):
+            os.makedirs('Reports')
+    for lab, df_lab in df_freq.groupby(lab_col, sort=False):
         with open('Reports/Examination_codes_' + lab + '.txt', 'w') as f:
             # Write (n=number of procedures) before each code:
-            for code in unique_codes:
-                f.write('(n = ' + str(sum(codes == code)) + ') ' + code + '\n')
+            f.writelines('(n = ' + df_lab['n'].astype(str) + ') ' + df_lab['Codes'] + '\n')
+    return df_freq
 
 def delete_reports(delete_folder=False):
     """
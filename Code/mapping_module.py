@@ -2,6 +2,172 @@
 This module contains functions for mapping the description content (column: 'Beskrivelse') to a new column (column: 'Mapped Procedures').
 """
 
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import numpy as np
+import pandas as pd
+
+# Utility functions:
+def _split_criteria(key):
+    """
+    This utility function separates a key from the mapping dictionary into a list of inclusion criteria
+    and a list of exclusion criteria. The criteria are separated by ' & ' and exclusion criteria start with '~'.
+    """
+    key_list = key.split(' & ')
+    inclusion_criteria = [x for x in key_list if not x.startswith('~')]
+    exclusion_criteria = [x[1:] for x in key_list if x.startswith('~')]
+    return inclusion_criteria, exclusion_criteria
+
+def _compile_mapping(mapping):
+    """
+    This utility function compiles the mapping dictionary into a list of rules.
+    Every distinct criteria (lower case) is given an index in a list of search terms, so that each substring
+    only has to be searched for once, no matter how many keys it is used in.
+    Each rule is a tuple of (key, value, inclusion_criteria, exclusion_criteria, inclusion_index, exclusion_index).
+    """
+    terms = {}
+    rules = []
+    for key, value in mapping.items():
+        inclusion_criteria, exclusion_criteria = _split_criteria(key)
+        inclusion_index = [terms.setdefault(x.lower(), len(terms)) for x in inclusion_criteria]
+        exclusion_index = [terms.setdefault(x.lower(), len(terms)) for x in exclusion_criteria]
+        rules.append((key, value, inclusion_criteria, exclusion_criteria, inclusion_index, exclusion_index))
+    return list(terms), rules
+
+def _match_rules(descriptions, terms, rules):
+    """
+    This utility function evaluates all the compiled rules against a list of unique descriptions in one pass.
+    Each description is lower cased once and checked for every search term, giving a boolean term matrix
+    (descriptions x terms). The rules are then evaluated as column operations on this matrix.
+    Returns a boolean matrix (descriptions x rules) which is True where a rule targets a description.
+    """
+    lowered = [str(description).lower() for description in descriptions]
+    term_matrix = np.array([[term in description for term in terms] for description in lowered], dtype=bool)
+    term_matrix = term_matrix.reshape(len(lowered), len(terms))
+
+    rule_matrix = np.zeros((len(lowered), len(rules)), dtype=bool)
+    for i, (_, _, _, _, inclusion_index, exclusion_index) in enumerate(rules):
+        # All inclusion criteria must be present and none of the exclusion criteria:
+        rule_matrix[:, i] = term_matrix[:, inclusion_index].all(axis=1) & ~term_matrix[:, exclusion_index].any(axis=1)
+    return rule_matrix
+
+def _mapping_hash(mapping):
+    """
+    This utility function returns a hash of the mapping dictionary.
+    The order of the keys is included, as the rules are applied in the order of the dictionary.
+    """
+    return hashlib.sha256(json.dumps(list(mapping.items()), ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def _match_rules_cached(descriptions, terms, rules, mapping, cache_path, cache_size=100000, verbose=False):
+    """
+    This utility function works like _match_rules, but looks up the result for each description in an SQLite
+    cache first. Only descriptions that have not been seen with the current mapping dictionary are evaluated.
+    The cache is keyed by the hash of the mapping dictionary and the description, so any change to the mapping
+    dictionary will automatically give a new set of entries. The cache holds at most cache_size entries,
+    and the least recently used entries are removed first.
+
+    Note that the cache stores which rules target a description, not the mapped procedure. Whether a rule is
+    applied depends on the other descriptions in the data (see _resolve_rules), so this is resolved every time.
+    """
+    rule_hash = _mapping_hash(mapping)
+    keys = [str(description) for description in descriptions]
+    rule_matrix = np.zeros((len(keys), len(rules)), dtype=bool)
+
+    if os.path.dirname(cache_path) and not os.path.exists(os.path.dirname(cache_path)):
+        os.makedirs(os.path.dirname(cache_path))
+
+    connection = sqlite3.connect(cache_path)
+    try:
+        connection.execute('CREATE TABLE IF NOT EXISTS mapping_cache (rule_hash TEXT, description TEXT, matches BLOB, '
+                           'last_used REAL, PRIMARY KEY (rule_hash, description))')
+        connection.execute('CREATE INDEX IF NOT EXISTS mapping_cache_last_used ON mapping_cache (last_used)')
+
+        # Look up the descriptions through a temporary table, to avoid one query per description:
+        connection.execute('CREATE TEMP TABLE lookup (description TEXT PRIMARY KEY)')
+        connection.executemany('INSERT OR IGNORE INTO lookup VALUES (?)', ((key,) for key in keys))
+        cached = dict(connection.execute('SELECT m.description, m.matches FROM mapping_cache m JOIN lookup l '
+                                         'ON m.description = l.description WHERE m.rule_hash = ?', (rule_hash,)))
+
+        hit = np.array([key in cached for key in keys], dtype=bool)
+        for i in np.flatnonzero(hit):
+            rule_matrix[i] = np.unpackbits(np.frombuffer(cached[keys[i]], dtype=np.uint8), count=len(rules)).astype(bool)
+
+        # Evaluate the descriptions not in the cache:
+        if (~hit).any():
+            rule_matrix[~hit] = _match_rules(descriptions[~hit], terms, rules)
+
+        if verbose:
+            print('Mapping cache: {} of {} unique descriptions found, {} evaluated.'.format(hit.sum(), len(keys), (~hit).sum()))
+
+        # Store the new descriptions and mark all the used descriptions as recently used:
+        now = time.time()
+        connection.executemany('INSERT OR REPLACE INTO mapping_cache VALUES (?, ?, ?, ?)',
+                               ((rule_hash, keys[i], np.packbits(rule_matrix[i]).tobytes(), now) for i in np.flatnonzero(~hit)))
+        connection.execute('UPDATE mapping_cache SET last_used = ? WHERE rule_hash = ? AND description IN '
+                           '(SELECT description FROM lookup)', (now, rule_hash))
+
+        # Remove the least recently used entries if the cache is too large:
+        n_entries = connection.execute('SELECT COUNT(*) FROM mapping_cache').fetchone()[0]
+        if n_entries > cache_size:
+            connection.execute('DELETE FROM mapping_cache WHERE rowid IN '
+                               '(SELECT rowid FROM mapping_cache ORDER BY last_used LIMIT ?)', (n_entries - cache_size,))
+        connection.execute('DROP TABLE lookup')
+        connection.commit()
+    finally:
+        connection.close()
+
+    return rule_matrix
+
+def _resolve_rules(descriptions, rules, rule_matrix, verbose=False):
+    """
+    This utility function applies the rules in the order of the mapping dictionary to the unique descriptions.
+    It gives the same warnings as _perform_mapping: If a rule does not target any description, or if a rule
+    targets descriptions that are already mapped to a different value, the rule is not applied.
+    Returns an array with the mapped procedure for each unique description.
+    """
+    mapped = np.full(len(descriptions), 'Unmapped', dtype=object)
+    for i, (key, value, inclusion_criteria, exclusion_criteria, _, _) in enumerate(rules):
+        if verbose:
+            print(f'{key} -> {value}')
+        target = rule_matrix[:, i]
+
+        # Check if no procedures were targeted by the mapping:
+        if not target.any():
+            print('WARNING! No procedures were targeted by this mapping!')
+            print('\n')
+            continue
+
+        # Check if the mapping target is already mapped with a different value and give a warning and information if it is:
+        already_mapped = target & (mapped != 'Unmapped')
+        if (already_mapped & (mapped != value)).any():
+            print('\n')
+            print('-'*30)
+            print('\n')
+            print('WARNING! Some or all mapping targets are already mapped!')
+            print('\n')
+            print('The current inclusion criteria are: ' + ' & '.join(inclusion_criteria))
+            print('The current exclusion criteria are: ' + ' & '.join(exclusion_criteria))
+            print('\n')
+            print('The following procedures are already mapped:')
+            print('\n')
+            for item, mapped_value in zip(descriptions[already_mapped], mapped[already_mapped]):
+                if mapped_value != value:
+                    print(f'{item}   --->   {mapped_value}')
+            print('\n')
+
+            print('Please check the mapping dictionary and refine it to avoid mapping the same procedure twice.')
+            print('\n')
+            print('-'*30)
+            print('\n')
+            continue
+
+        # Map the procedures:
+        mapped[target] = value
+    return mapped
+
 def _perform_mapping(df_data, key, value):
     """
     This utility function performs the mapping according to the following rules:
@@ -22,9 +188,7 @@ def _perform_mapping(df_data, key, value):
             return False
 
     # Get the inclusion and exclusion criteria:
-    key_list = key.split(' & ')
-    inclusion_criteria = [x for x in key_list if not x.startswith('~')]
-    exclusion_criteria = [x[1:] for x in key_list if x.startswith('~')]
+    inclusion_criteria, exclusion_criteria = _split_criteria(key)
 
     # Check df_data's 'Beskrivelse' column for substrings of all the inclusion and exclusion criteria:
     # 'Mapping Target' is set to True if all inclusion criteria are present and no exclusion criteria are present:
@@ -77,20 +241,30 @@ def _perform_mapping(df_data, key, value):
 
     return df_data
 
-def map_procedures(df_data, mapping, verbose=False):
+def map_procedures(df_data, mapping, verbose=False, compiled=True, cache_path=None, cache_size=100000):
     """
     This function checks the relevant columns for the presence of the characters '&' and '~', which is used for mapping.
     It also initializes the 'Mapped Procedures' column and moves it to the front.
-    Finally the mapping dictionary is passed line by line to the _perform_mapping function.
+    By default the mapping dictionary is compiled and evaluated once per unique description, and the result is
+    projected back on to the rows as a pandas Categorical. If compiled is False, the mapping dictionary is passed
+    line by line to the _perform_mapping function, which evaluates every row and gives a column of strings.
+    Both give the same mapping and the same warnings.
+    If cache_path is given (e.g. 'Cache/mapping_cache.sqlite'), the compiled path stores the result for each
+    description in an SQLite file, so that reruns only evaluate descriptions not seen with the current mapping
+    dictionary. The cache keeps at most cache_size descriptions.
     """
-        # Check the 'Beskrivelse' column for the following characters '&', '~':
-    if sum(df_data['Beskrivelse'].str.contains('&')) > 0:
+    # Factorize the 'Beskrivelse' column, so that each unique description is only evaluated once:
+    codes, descriptions = pd.factorize(df_data['Beskrivelse'])
+    descriptions = np.asarray(descriptions, dtype=object)
+
+    # Check the 'Beskrivelse' column for the following characters '&', '~':
+    if any('&' in str(description) for description in descriptions):
         print('WARNING! The "Beskrivelse" column contains the character "&".')
         print('This character is used to separate criteria for identifying procedures.')
         print('We need to find another separator character.')
         return
     
-    if sum(df_data['Beskrivelse'].str.contains('~')) > 0:
+    if any('~' in str(description) for description in descriptions):
         print('WARNING! The "Beskrivelse" column contains the character "~".')
         print('This character is used to exclude criteria for identifying procedures.')
         print('We need to find another separator character.')
@@ -108,9 +282,23 @@ def map_procedures(df_data, mapping, verbose=False):
     if verbose:
         print('Mapping procedures...\n')
 
+    if compiled:
+        terms, rules = _compile_mapping(mapping)
+        if cache_path is not None:
+            rule_matrix = _match_rules_cached(descriptions, terms, rules, mapping, cache_path, cache_size=cache_size, verbose=verbose)
+        else:
+            rule_matrix = _match_rules(descriptions, terms, rules)
+        mapped = _resolve_rules(descriptions, rules, rule_matrix, verbose=verbose)
+        # Project the result back on to the rows as a categorical. Missing descriptions have the code -1,
+        # which picks the 'Unmapped' element appended at the end.
+        # The categories are sorted, so that sorting on 'Mapped Procedures' gives the same order as for strings:
+        categories, mapped_codes = np.unique(np.append(mapped, 'Unmapped').astype(str), return_inverse=True)
+        df_data['Mapped Procedures'] = pd.Categorical.from_codes(mapped_codes[codes], categories=categories)
+        return df_data
+
     for key, value in mapping.items():
         if verbose:
             print(f'{key} -> {value}')
         df_data = _perform_mapping(df_data, key, value)
 
-    return df_data
\ No newline at end of file
+    return df_data
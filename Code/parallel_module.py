@@ -0,0 +1,184 @@
+"""
+This module contains a runner for the cleanup, the accession number checks and the merge of the IDS7 and DoseTrack
+data on several CPU cores. Everything in dt_ids7_export_module works on one patient or one accession number at a time,
+so the data can be split into partitions that are processed independently in a pool of processes:
+
+The IDS7 rows are put in a partition by a hash of 'Pasient' (or of the accession number, if the column or the value
+is missing), so that all the bookings of a patient are in the same partition, as overwrite_duplicated_accession_numbers
+requires. All the rows of an accession number follow the partition of its first IDS7 row, and the DoseTrack rows follow
+the partition of their accession number (DoseTrack accession numbers not in IDS7 are put in a partition by a hash of
+the accession number). The old Siemens PACS accession numbers in DoseTrack are converted before the partitioning.
+
+Each partition is then run through run_all_cleanup_filters_and_checks and merge_ids7_dt. The results are put back
+together in the original order of the rows (and for the merged data sorted by accession number, as merge_ids7_dt does),
+so the result is the same for any number of partitions and processes. The procedures are mapped with
+mapping_module.map_procedures once on the combined data, since whether a rule in the mapping dictionary is applied
+depends on all the unique descriptions. The mapping is done on the unique descriptions and is fast in any case.
+The text printed by each partition (e.g. the accession numbers that have been overwritten) is printed afterwards,
+in the order of the partitions.
+
+The result is the same as run_all_cleanup_filters_and_checks followed by merge_ids7_dt, as long as an accession number
+is only used for one patient. An accession number used for several patients is kept with the first of them.
+The benchmark of the scaling with the number of processes is benchmark_module.benchmark_partitioned_pipeline.
+
+-------------------------------- Functions: --------------------------------
+partition_exports:          Returns the partition number of each row in the IDS7 and DoseTrack dataframes.
+
+run_partitioned_pipeline:   Runs the cleanup, the checks, the merge and optionally the mapping of the procedures on
+                            the partitions in a pool of processes, and returns the cleaned IDS7 data, the DoseTrack
+                            data and the merged data.
+-------------------------------------------------------------------------------------
+"""
+
+import io
+import os
+import time
+import contextlib
+import numpy as np
+import pandas as pd
+import dt_ids7_export_module as bh_utils
+import mapping_module as bh_map
+
+def _hash_partitions(keys, n_partitions):
+    """
+    This utility function returns the partition number (0 to n_partitions - 1) of each key, from a hash of the value.
+    """
+    hashes = pd.util.hash_pandas_object(pd.Series(np.asarray(keys, dtype=object)), index=False).to_numpy()
+    return (hashes % n_partitions).astype(np.int64)
+
+def partition_exports(df_ids7, df_dt, n_partitions):
+    """
+    This function returns two arrays with the partition number of each row in df_ids7 and df_dt.
+    The IDS7 rows are partitioned by a hash of 'Pasient', or of 'Henvisnings-ID' where 'Pasient' is missing.
+    All the IDS7 rows of an accession number are then given the partition of its first row, and the DoseTrack rows
+    the partition of their accession number. DoseTrack accession numbers not in IDS7 are partitioned by a hash of the
+    accession number. The old Siemens PACS accession numbers must be converted in df_dt first.
+    """
+    accessions = df_ids7['Henvisnings-ID'].to_numpy(dtype=object)
+    if 'Pasient' in df_ids7.columns:
+        patients = df_ids7['Pasient'].to_numpy(dtype=object)
+        keys = np.where(pd.isna(patients), accessions, patients)
+    else:
+        keys = accessions
+    ids7_partitions = _hash_partitions(keys, n_partitions)
+
+    # All the rows of an accession number get the partition of its first row:
+    codes, unique_accessions = pd.factorize(df_ids7['Henvisnings-ID'])
+    has_accession = codes >= 0
+    first_row = np.full(len(unique_accessions), len(codes), dtype=np.int64)
+    np.minimum.at(first_row, codes[has_accession], np.flatnonzero(has_accession))
+    accession_partitions = ids7_partitions[first_row]
+    ids7_partitions[has_accession] = accession_partitions[codes[has_accession]]
+
+    # The DoseTrack rows follow the partition of the accession number in IDS7:
+    dt_codes = pd.Index(unique_accessions).get_indexer(df_dt['Accession Number'])
+    dt_partitions = _hash_partitions(df_dt['Accession Number'], n_partitions)
+    in_ids7 = dt_codes >= 0
+    dt_partitions[in_ids7] = accession_partitions[dt_codes[in_ids7]]
+    return ids7_partitions, dt_partitions
+
+def _run_partition(df_ids7, df_dt):
+    """
+    This utility function runs run_all_cleanup_filters_and_checks and merge_ids7_dt on one partition.
+    The printed text is captured, so that it can be printed in the order of the partitions.
+    Returns the cleaned IDS7 data, the DoseTrack data, the merged data, the cleanup report, the printed text
+    and the time in seconds.
+    """
+    start = time.perf_counter()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        df_ids7, report, index = bh_utils.run_all_cleanup_filters_and_checks(df_ids7, df_dt, return_report=True, return_index=True)
+        data = bh_utils.merge_ids7_dt(df_ids7, df_dt, index=index)
+    return df_ids7, df_dt, data, report, output.getvalue(), time.perf_counter() - start
+
+def _restore_order(parts, index):
+    """
+    This utility function concatenates the dataframes of the partitions, which are indexed by the position of each
+    row in the original dataframe, sorts the rows by this position and restores the original index.
+    """
+    df = pd.concat(parts).sort_index(kind='stable')
+    return df.set_axis(index[df.index.to_numpy(dtype=np.int64)])
+
+def _combine_reports(reports):
+    """
+    This utility function adds up the cleanup reports of the partitions into one report.
+    """
+    report = pd.concat(reports, ignore_index=True)
+    return report.groupby('Filter', sort=False, as_index=False).agg(
+        {'Applied': 'all', 'Rows flagged': 'sum', 'Rows removed': 'sum', 'Rows left': 'sum'})
+
+def run_partitioned_pipeline(df_ids7, df_dt, mapping=None, n_partitions=None, n_workers=None, verbose=False, return_report=False):
+    """
+    This function runs run_all_cleanup_filters_and_checks and merge_ids7_dt on partitions of the IDS7 and DoseTrack data
+    (see partition_exports) in a pool of n_workers processes (default is the number of CPUs), and maps the procedures
+    with the mapping dictionary if it is given. n_partitions is the number of partitions (default is n_workers).
+    With n_workers=1 the partitions are run one by one in this process.
+    The ambiguous duplicated accession numbers are only reported, as they can not be replaced manually in a process pool.
+    df_ids7 and df_dt are not changed.
+    Returns the cleaned IDS7 data, the DoseTrack data (with the column 'Henvisning_i_ids7') and the merged data,
+    and the combined cleanup report (as from CleanupPipeline) if return_report is True.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Stop execution if the dataframe contains the column 'Fødselsnummer':
+    if bh_utils._check_for_fnr(df_ids7):
+        return None
+
+    if not bh_utils._check_for_column(df_ids7, 'IDS7', 'Henvisnings-ID') or \
+            not bh_utils._check_for_column(df_dt, 'DoseTrack', 'Accession Number'):
+        print('Without these columns, the data can not be partitioned by accession number.')
+        print('\n')
+        return None
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if n_partitions is None:
+        n_partitions = n_workers
+    n_workers = max(1, min(n_workers, n_partitions))
+    start = time.perf_counter()
+
+    # Convert the old Siemens PACS accession numbers before partitioning, as check_accession_ids7_vs_dt would:
+    df_dt = df_dt.copy()
+    if bh_utils._mask_old_siemens_pacs_format(df_dt['Accession Number']).any():
+        df_dt = bh_utils._convert_old_siemens_pacs_accession_format(df_dt, verbose=verbose)
+
+    ids7_partitions, dt_partitions = partition_exports(df_ids7, df_dt, n_partitions)
+    ids7_rows = [np.flatnonzero(ids7_partitions == i) for i in range(n_partitions)]
+    dt_rows = [np.flatnonzero(dt_partitions == i) for i in range(n_partitions)]
+    # The rows are numbered by their position, so that the original order can be restored:
+    partitions = [(df_ids7.iloc[ids7_rows[i]].set_axis(ids7_rows[i]), df_dt.iloc[dt_rows[i]].set_axis(dt_rows[i]))
+                  for i in range(n_partitions)]
+    if verbose:
+        print('Split {} IDS7 rows and {} DoseTrack rows into {} partitions, run with {} process(es).'.format(
+            len(df_ids7), len(df_dt), n_partitions, n_workers))
+
+    if n_workers == 1:
+        results = [_run_partition(*partition) for partition in partitions]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_run_partition, *zip(*partitions)))
+
+    # Print the text from the partitions in the order of the partitions:
+    for i, (_, _, _, _, output, seconds) in enumerate(results):
+        if verbose:
+            print('Partition {}: {} IDS7 rows, {} DoseTrack rows in {:.2f} s.'.format(i, len(ids7_rows[i]), len(dt_rows[i]), seconds))
+        if output.strip():
+            print(output, end='')
+
+    # Put the rows back in the original order, with the original index:
+    df_ids7_clean = _restore_order([result[0] for result in results], df_ids7.index)
+    df_dt_checked = _restore_order([result[1] for result in results], df_dt.index)
+    # Empty partitions are left out, as their merged dataframes have no dtypes:
+    merged = [result[2] for result in results if len(result[2]) > 0]
+    data = pd.concat(merged if len(merged) > 0 else [results[0][2]], ignore_index=True)
+    data = data.sort_values('Accession Number', kind='stable').reset_index(drop=True)
+
+    if mapping is not None:
+        data = bh_map.map_procedures(data, mapping, verbose=verbose)
+
+    if verbose:
+        print('Cleaned, checked and merged the data into {} rows in {:.2f} s.'.format(len(data), time.perf_counter() - start))
+
+    if return_report:
+        return df_ids7_clean, df_dt_checked, data, _combine_reports([result[3] for result in results])
+    return df_ids7_clean, df_dt_checked, data
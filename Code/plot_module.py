@@ -3,57 +3,122 @@ import seaborn as sns
 import os
 import glob
 import matplotlib.pyplot as plt
+import json
+import time
+import hashlib
+import numpy as np
+import pandas as pd
 import reporting_module as bh_report
+from concurrent.futures import ProcessPoolExecutor
 
 # This module contains functions for performing the various common plots.
 
+def _calc_box_summary(data, by, metric='DAP Total (Gy*cm2)', y_max=None, whis=1.5, max_fliers=1000):
+    """
+    This function calculates everything needed to draw a boxplot of the metric per group in the column by, in
+    one grouped pass over the data, so that the plot does not need the row-level data.
+    The columns are:
+    n:                  The number of observations in the group (also those with a missing metric).
+    q1, med, q3:        The 25th, 50th and 75th percentile.
+    whislo, whishi:     The most extreme values within whis times the IQR from the box (as in seaborn and matplotlib).
+    max:                The maximum value.
+    n_above:            The number of values above y_max (0 if y_max is None).
+    fliers:             The values outside the whiskers, sorted. If there are more than max_fliers, an evenly spaced
+                        selection of max_fliers of them (including the most extreme) is kept.
+    The groups are sorted by the column by.
+    """
+    n_obs = data.groupby(by, observed=True).size()
+    # Rows without a group are left out, as in the groupby above:
+    values = data.loc[data[metric].notna() & data[by].notna(), [by, metric]]
+    # Work on integer codes for the groups, so that the values of each group can be looked up with an array:
+    codes, labels = pd.factorize(values[by], sort=True)
+    metric_values = values[metric].to_numpy(dtype=float)
+    grouped = pd.Series(metric_values).groupby(codes)
+
+    summary = pd.DataFrame({'q1': grouped.quantile(0.25), 'med': grouped.quantile(0.5), 'q3': grouped.quantile(0.75),
+                            'max': grouped.max()})
+    iqr = (summary['q3'] - summary['q1']).to_numpy()
+    lower = summary['q1'].to_numpy() - whis * iqr
+    upper = summary['q3'].to_numpy() + whis * iqr
+    inside = (metric_values >= lower[codes]) & (metric_values <= upper[codes])
+
+    grouped_inside = pd.Series(metric_values[inside]).groupby(codes[inside])
+    summary['whislo'] = grouped_inside.min()
+    summary['whishi'] = grouped_inside.max()
+    if y_max is None:
+        summary['n_above'] = 0
+    else:
+        summary['n_above'] = np.bincount(codes, weights=metric_values > y_max, minlength=len(labels)).astype(int)
+
+    # Keep the sorted outliers per group, at most max_fliers of them:
+    fliers = [[] for _ in range(len(labels))]
+    order = np.lexsort((metric_values[~inside], codes[~inside]))
+    flier_codes = codes[~inside][order]
+    flier_values = metric_values[~inside][order]
+    bounds = np.searchsorted(flier_codes, np.arange(len(labels) + 1))
+    for code in range(len(labels)):
+        group_fliers = flier_values[bounds[code]:bounds[code + 1]]
+        if len(group_fliers) > max_fliers:
+            group_fliers = group_fliers[np.linspace(0, len(group_fliers) - 1, max_fliers).round().astype(int)]
+        fliers[code] = list(group_fliers)
+    summary['fliers'] = fliers
+
+    summary.index = pd.Index(labels, name=by)
+    summary.insert(0, 'n', n_obs.reindex(summary.index).to_numpy())
+    return summary
+
+def _draw_box_summary(ax, summary):
+    """
+    This function draws one box per row in the summary from _calc_box_summary on the axis, with the seaborn colors.
+    """
+    stats = []
+    for label, row in summary.iterrows():
+        stats.append({'label': str(label), 'med': row['med'], 'q1': row['q1'], 'q3': row['q3'],
+                      'whislo': row['whislo'], 'whishi': row['whishi'], 'fliers': np.array(row['fliers'])})
+    boxes = ax.bxp(stats, positions=range(len(stats)), widths=0.8, patch_artist=True,
+                   medianprops=dict(color='black'), flierprops=dict(marker='d', markerfacecolor='gray', markeredgecolor='gray'))
+    for box, color in zip(boxes['boxes'], sns.color_palette(n_colors=len(stats))):
+        box.set_facecolor(color)
+    return
+
+def _annotate_box_summary(ax, summary, y_max, fontsize=10, rotation=0, labelrotation=0):
+    """
+    This function puts an annotation with the maximum value and the number of observations above y_max on top
+    of each box that does not fit in the plot area, and adds the number of observations to the x-ticklabels.
+    All the values are taken from the summary from _calc_box_summary.
+    """
+    for i, (label, row) in enumerate(summary.iterrows()):
+        if row['max'] > y_max:
+            ax.annotate('Maks = ' + str(round(row['max'], 1)) + '\n' + 'n$_{(>'+ str(y_max) + ')}$ = ' + str(int(row['n_above'])), xy=(i, y_max), \
+                        xytext=(i, y_max + y_max/20), ha='center', va='bottom', fontsize=fontsize , arrowprops=dict(facecolor='black', shrink=0.05), rotation=rotation)
+
+    labels = [str(label) + '\n' +'(' + 'n = ' + str(int(row['n'])) + ')' for label, row in summary.iterrows()]
+    _ = ax.set_xticks(range(len(labels)), labels, rotation=labelrotation)
+    return
+
 def plot_representative_dose_by_procedure(data, y_max=20, save=False):
     """
     This function will create a boxplot with whiskers.
     The line in the middle will represent the median.
     The box will represent the interquartile range (IQR) of the data.
-    The whiskers will represent the 2.5th to 97.5th percentile.
+    The whiskers will represent the most extreme values within 1.5 IQR from the box.
     The dots will represent the outliers.
-    There will be one box per procedure
+    There will be one box per procedure.
+    The boxes and the annotations are drawn from a summary calculated in one pass over the data.
     """
 
-    # Create a dataframe with the data for the procedure:
-    data = data.sort_values(by=['Mapped Procedures'])
-    
-    # Make a boxplot:
     fig, ax = plt.subplots(figsize=(15, 10))
-    sns.boxplot(x='Mapped Procedures', y='DAP Total (Gy*cm2)', data=data, ax=ax)
-    
     # Reduce the range of the y-axis:
-    if y_max > 0:
-        ax.set_ylim([0, y_max])
-    else:
+    limit_y = y_max > 0
+    if not limit_y:
         y_max = data['DAP Total (Gy*cm2)'].max()
 
-    # add an annotation to the top of the axis with the maximum value and number of observations outside the plot area:
-    list_max = []
-    list_n_outside = []
-    for xtick in ax.get_xticklabels():
-        list_max.append(data[data['Mapped Procedures'] == xtick.get_text()]['DAP Total (Gy*cm2)'].max())
-        list_n_outside.append(data[data['Mapped Procedures'] == xtick.get_text()]['DAP Total (Gy*cm2)'].gt(y_max).sum())
-        
-    # Put an annotation on the axis:
-    for i, xtick in enumerate(ax.get_xticklabels()):
-        if list_max[i] > y_max:
-            ax.annotate('Maks = ' + str(round(list_max[i], 1)) + '\n' + 'n$_{(>'+ str(y_max) + ')}$ = ' + str(list_n_outside[i]), xy=(i, y_max), \
-                        xytext=(i, y_max + y_max/20), ha='center', va='bottom', fontsize=10 , arrowprops=dict(facecolor='black', shrink=0.05), rotation=90)
-
-
-    # Add a different string to each x-ticklabel:
-    labels = []
-    for i, xtick in enumerate(ax.get_xticklabels()):
-        n_obs = len(data[data['Mapped Procedures'] == xtick.get_text()])
-        labels.append(xtick.get_text() + '\n' +'(' + 'n = ' + str(n_obs) + ')')
-    _ = ax.set_xticklabels(labels, rotation=90)
-
-
-
-
+    # Make a boxplot with annotations from the summary:
+    summary = _calc_box_summary(data, 'Mapped Procedures', y_max=y_max)
+    _draw_box_summary(ax, summary)
+    if limit_y:
+        ax.set_ylim([0, y_max])
+    _annotate_box_summary(ax, summary, y_max, fontsize=10, rotation=90, labelrotation=90)
 
     # Add a title:
     _ = plt.suptitle('Overview Procedures', fontsize=30, y=1.07)
@@ -76,60 +141,52 @@ def plot_representative_dose_by_procedure(data, y_max=20, save=False):
     if save:
         if not os.path.exists('Figures'):
             os.makedirs('Figures')
-        # if the procedure contains a forward slash, replace it with a dash:
-        procedure = procedure.replace('/', '-')
         fig.savefig('Figures/oversikt.png', bbox_inches='tight')
     return
 
 
-def plot_representative_dose(data, procedure, y_max=20, save=False):
+def plot_representative_dose(data, procedure, y_max=20, save=False, verbose=True, figure_folder='Figures'):
     """
     This function will create a boxplot with whiskers.
     The line in the middle will represent the median.
     The box will represent the interquartile range (IQR) of the data.
-    The whiskers will represent the 2.5th to 97.5th percentile.
+    The whiskers will represent the most extreme values within 1.5 IQR from the box.
     The dots will represent the outliers.
     There will be one box per room that has performed the procedure.
+    If verbose is False, the summary of the doses is not printed.
+    If save is True, the figure is saved as a png file in figure_folder.
+    """
+    _plot_representative_dose(data, procedure, y_max=y_max, save=save, verbose=verbose, figure_folder=figure_folder)
+    return
+
+def _plot_representative_dose(data, procedure, y_max=20, save=False, verbose=True, figure_folder='Figures'):
+    """
+    This utility function draws the figure of plot_representative_dose.
+    The boxes and the annotations are drawn from a summary calculated in one pass over the data.
+    Returns the figure, so that render_procedure_plots can close it.
     """
 
-    # Create a dataframe with the data for the procedure: .str.contains
+    # Create a dataframe with the data for the procedure:
     data = data[data['Mapped Procedures'] == procedure]
-    data = data.sort_values(by=['Modality Room'])
     
-    # Make a boxplot:
     fig, ax = plt.subplots(figsize=(15, 10))
-    sns.boxplot(x='Modality Room', y='DAP Total (Gy*cm2)', data=data, ax=ax)
-    print('Reporting doses for ' + procedure + ':')
-    print('\n')
-    bh_report.print_summary(data[data['Mapped Procedures'] == procedure], True)
-    print('\n')
-    bh_report.print_summary_per_lab(data[data['Mapped Procedures'] == procedure], True)
+    if verbose:
+        print('Reporting doses for ' + procedure + ':')
+        print('\n')
+        bh_report.print_summary(data, True)
+        print('\n')
+        bh_report.print_summary_per_lab(data, True)
     # Reduce the range of the y-axis:
-    if y_max > 0:
-        ax.set_ylim([0, y_max])
-    else:
+    limit_y = y_max > 0
+    if not limit_y:
         y_max = data['DAP Total (Gy*cm2)'].max()
 
-    # add an annotation to the top of the axis with the maximum value and number of observations outside the plot area:
-    list_max = []
-    list_n_outside = []
-    for xtick in ax.get_xticklabels():
-        list_max.append(data[data['Modality Room'] == xtick.get_text()]['DAP Total (Gy*cm2)'].max())
-        list_n_outside.append(data[data['Modality Room'] == xtick.get_text()]['DAP Total (Gy*cm2)'].gt(y_max).sum())
-        
-    # Put an annotation on the axis:
-    for i, xtick in enumerate(ax.get_xticklabels()):
-        if list_max[i] > y_max:
-            ax.annotate('Maks = ' + str(round(list_max[i], 1)) + '\n' + 'n$_{(>'+ str(y_max) + ')}$ = ' + str(list_n_outside[i]), xy=(i, y_max), \
-                        xytext=(i, y_max + y_max/20), ha='center', va='bottom', fontsize=12 , arrowprops=dict(facecolor='black', shrink=0.05))
-
-
-    # Add a different string to each x-ticklabel:
-    labels = []
-    for i, xtick in enumerate(ax.get_xticklabels()):
-        n_obs = len(data[data['Modality Room'] == xtick.get_text()])
-        labels.append(xtick.get_text() + '\n' +'(' + 'n = ' + str(n_obs) + ')')
-    _ = ax.set_xticklabels(labels)
+    # Make a boxplot with annotations from the summary:
+    summary = _calc_box_summary(data, 'Modality Room', y_max=y_max)
+    _draw_box_summary(ax, summary)
+    if limit_y:
+        ax.set_ylim([0, y_max])
+    _annotate_box_summary(ax, summary, y_max, fontsize=12)
 
     # Add a title:
     _ = plt.suptitle(procedure, fontsize=30, y=1.04)
@@ -146,16 +203,112 @@ def plot_representative_dose(data, procedure, y_max=20, save=False):
 
     # Increase the font size of the x-ticklabels:
     _ = ax.tick_params(labelsize=15)   
-    print('-'*50)
-    print('\n')
+    if verbose:
+        print('-'*50)
+        print('\n')
 
     if save:
-        if not os.path.exists('Figures'):
-            os.makedirs('Figures')
-        # if the procedure contains a forward slash, replace it with a dash:
-        procedure = procedure.replace('/', '-')
-        fig.savefig('Figures/' + procedure + '.png', bbox_inches='tight')
-    return
+        if not os.path.exists(figure_folder):
+            os.makedirs(figure_folder)
+        fig.savefig(_figure_path(figure_folder, procedure), bbox_inches='tight')
+    return fig
+
+def _figure_path(figure_folder, procedure):
+    """
+    This utility function returns the path of the png file for a procedure.
+    If the procedure contains a forward slash, it is replaced with a dash.
+    """
+    return os.path.join(figure_folder, procedure.replace('/', '-') + '.png')
+
+def _data_hash(data, y_max):
+    """
+    This utility function returns a hash of the data used in a figure and the y_max of the figure.
+    It is used to skip figures that have not changed since the last time they were rendered.
+    """
+    hasher = hashlib.sha256(repr(y_max).encode())
+    hasher.update(','.join(data.columns).encode())
+    hasher.update(pd.util.hash_pandas_object(data, index=False).values.tobytes())
+    return hasher.hexdigest()
+
+def _init_render_worker():
+    """
+    This utility function is run once in each worker process and switches matplotlib to the non-interactive
+    Agg backend, since the figures are only saved to file.
+    """
+    plt.switch_backend('Agg')
+
+def _render_procedure(data, procedure, y_max, figure_folder):
+    """
+    This utility function renders and saves the figure for one procedure, and closes it to free the memory.
+    Returns the procedure and the time used in seconds.
+    """
+    start = time.perf_counter()
+    fig = _plot_representative_dose(data, procedure, y_max=y_max, save=True, verbose=False, figure_folder=figure_folder)
+    plt.close(fig)
+    return procedure, time.perf_counter() - start
+
+def render_procedure_plots(data, procedures=None, y_max=20, figure_folder='Figures', n_workers=None, force=False, verbose=True):
+    """
+    This function renders the figure from plot_representative_dose for each procedure and saves them in figure_folder.
+    The default procedures are all mapped procedures except 'Unmapped'.
+    The figures are rendered in n_workers processes (default is the number of CPUs) with the Agg backend,
+    and each figure is closed after it is saved.
+    A hash of the data for each figure is stored in the file '.render_hashes.json' in figure_folder, and figures
+    whose data (and y_max) have not changed since the last render are skipped, unless force is True.
+    Returns a dataframe with the status of each procedure ('Rendered' or 'Unchanged') and the time used.
+    """
+    if procedures is None:
+        procedures = sorted(p for p in data['Mapped Procedures'].dropna().unique() if p != 'Unmapped')
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if not os.path.exists(figure_folder):
+        os.makedirs(figure_folder)
+
+    hash_file = os.path.join(figure_folder, '.render_hashes.json')
+    hashes = {}
+    if os.path.exists(hash_file):
+        with open(hash_file) as f:
+            hashes = json.load(f)
+
+    # Only the columns used in the figure are sent to the worker processes:
+    data = data[['Mapped Procedures', 'Modality Room', 'DAP Total (Gy*cm2)']]
+    groups = {procedure: group for procedure, group in data.groupby('Mapped Procedures', observed=True, sort=False)}
+
+    results = []
+    jobs = []
+    for procedure in procedures:
+        if procedure not in groups:
+            print('WARNING: No data for the procedure ' + procedure + '.')
+            continue
+        data_hash = _data_hash(groups[procedure], y_max)
+        if not force and hashes.get(procedure) == data_hash and os.path.exists(_figure_path(figure_folder, procedure)):
+            results.append({'Procedure': procedure, 'Status': 'Unchanged', 'Time (s)': 0.0})
+            continue
+        hashes[procedure] = data_hash
+        jobs.append(procedure)
+
+    if n_workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_render_worker) as executor:
+            futures = [executor.submit(_render_procedure, groups[procedure], procedure, y_max, figure_folder) for procedure in jobs]
+            rendered = [future.result() for future in futures]
+    else:
+        rendered = [_render_procedure(groups[procedure], procedure, y_max, figure_folder) for procedure in jobs]
+
+    for procedure, seconds in rendered:
+        results.append({'Procedure': procedure, 'Status': 'Rendered', 'Time (s)': seconds})
+        if verbose:
+            print('Rendered ' + procedure + ' in ' + str(round(seconds, 2)) + ' s.')
+
+    with open(hash_file, 'w') as f:
+        json.dump(hashes, f, indent=1)
+
+    # Report the procedures in the same order as they were given:
+    order = {procedure: i for i, procedure in enumerate(procedures)}
+    results.sort(key=lambda result: order[result['Procedure']])
+
+    if verbose:
+        print(str(len(rendered)) + ' figures rendered, ' + str(len(results) - len(rendered)) + ' unchanged figures skipped.')
+    return pd.DataFrame(results, columns=['Procedure', 'Status', 'Time (s)'])
 
 # This function will delete all plots in the Figures folder.
 def delete_all_plots(delete_folder=False):
@@ -0,0 +1,234 @@
+"""
+This module contains functions for measuring where the time and memory goes in a full analysis run.
+Each measured stage records the wall time, the CPU time, the peak memory and the number of rows in and out.
+Stages can be nested (e.g. run_all_cleanup_filters_and_checks calls check_accession_ids7_vs_dt), and the depth
+of each stage is recorded so that the profile can be shown as a tree.
+
+The peak memory is measured with tracemalloc, which tracks the memory allocated by Python and NumPy (and thereby
+pandas), but not memory allocated directly by pyarrow. Tracking the memory slows down pure Python code, so tracing is
+only on while a stage runs (unless it was already on), and it can be turned off with enable_memory_tracking(False). The CPU time is the CPU time of this process, so work done in a
+process pool is only included in the wall time.
+
+-------------------------------- Measuring: --------------------------------
+stage:                  Context manager that measures the code in the with block as one stage.
+                        Example:
+                            with bh_profile.stage('Import', rows_in=0) as record:
+                                df = ...
+                                record['Rows out'] = len(df)
+
+profiled:               Decorator that measures every call to a function as one stage. The rows in is the length of
+                        the first dataframe argument, and the rows out the length of the returned dataframe.
+
+instrument_modules:     Wraps all the public functions in dt_ids7_export_module, mapping_module, reporting_module and
+                        plot_module (or the given modules) with profiled, so a whole run is measured without changing
+                        the analysis scripts. uninstrument_modules restores the original functions.
+-------------------------------------------------------------------------------------
+
+-------------------------------- The profile: --------------------------------
+get_profile:            Returns the recorded stages as a dataframe.
+print_profile:          Prints the recorded stages as a table, indented by depth.
+save_profile:           Saves the recorded stages as a JSON file.
+reset_profile:          Deletes the recorded stages.
+-------------------------------------------------------------------------------------
+"""
+
+import os
+import json
+import time
+import inspect
+import functools
+import tracemalloc
+import contextlib
+import pandas as pd
+
+# The recorded stages, in the order they were started, and the stack of the stages that are running:
+_records = []
+_running = []
+_settings = {'track_memory': True, 'started_tracing': False}
+
+# The modules wrapped by instrument_modules, and the original functions:
+DEFAULT_MODULES = ['dt_ids7_export_module', 'mapping_module', 'reporting_module', 'plot_module']
+_originals = {}
+
+def enable_memory_tracking(track_memory=True):
+    """
+    This function turns the measurement of the peak memory on or off for the following stages.
+    Turning it off also stops tracemalloc, if it was started by stage.
+    """
+    _settings['track_memory'] = track_memory
+    if not track_memory:
+        _stop_tracing()
+    return
+
+def _stop_tracing():
+    """
+    This utility function stops tracemalloc if it was started by stage, since tracing slows down all allocations.
+    Tracing started by someone else is left running.
+    """
+    if _settings['started_tracing']:
+        _settings['started_tracing'] = False
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+def _count_rows(value):
+    """
+    This utility function returns the number of rows of a dataframe or series, or of the first dataframe in a
+    tuple or list (e.g. a function returning a dataframe and a report). Returns None for other values.
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        for item in value:
+            if isinstance(item, pd.DataFrame):
+                return len(item)
+    return None
+
+@contextlib.contextmanager
+def stage(name, rows_in=None):
+    """
+    This context manager measures the code in the with block as one stage called name.
+    It yields the record of the stage (a dictionary), so that 'Rows in' and 'Rows out' can be set in the block.
+    The record is added to the profile also if the block raises an exception, with 'Error' set to the exception.
+    """
+    record = {'Stage': name, 'Depth': len(_running), 'Wall time (s)': None, 'CPU time (s)': None,
+              'Peak memory (MB)': None, 'Rows in': rows_in, 'Rows out': None, 'Error': None}
+    _records.append(record)
+
+    track_memory = _settings['track_memory']
+    if track_memory:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _settings['started_tracing'] = True
+        current, peak = tracemalloc.get_traced_memory()
+        # The peak so far belongs to the running stages, before it is reset for this stage:
+        for running in _running:
+            running['_peak'] = max(running['_peak'], peak)
+        tracemalloc.reset_peak()
+        record['_start_memory'] = current
+        record['_peak'] = current
+    _running.append(record)
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield record
+    except BaseException as e:
+        record['Error'] = repr(e)
+        raise
+    finally:
+        record['Wall time (s)'] = time.perf_counter() - wall_start
+        record['CPU time (s)'] = time.process_time() - cpu_start
+        _running.pop()
+        if track_memory and tracemalloc.is_tracing():
+            _, peak = tracemalloc.get_traced_memory()
+            record['_peak'] = max(record['_peak'], peak)
+            record['Peak memory (MB)'] = (record['_peak'] - record['_start_memory']) / 1024**2
+            for running in _running:
+                running['_peak'] = max(running['_peak'], record['_peak'])
+        record.pop('_peak', None)
+        record.pop('_start_memory', None)
+        # Stop tracing when the outermost stage is done:
+        if len(_running) == 0:
+            _stop_tracing()
+
+def profiled(function=None, name=None):
+    """
+    This decorator measures every call to the function as one stage, named by the module and the function name
+    unless name is given. It can be used both as @profiled and as @profiled(name='...').
+    """
+    if function is None:
+        return functools.partial(profiled, name=name)
+    stage_name = name if name is not None else function.__module__ + '.' + function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        rows_in = None
+        for value in list(args) + list(kwargs.values()):
+            if isinstance(value, pd.DataFrame):
+                rows_in = len(value)
+                break
+        with stage(stage_name, rows_in=rows_in) as record:
+            result = function(*args, **kwargs)
+            record['Rows out'] = _count_rows(result)
+        return result
+    return wrapper
+
+def instrument_modules(modules=None):
+    """
+    This function wraps all the public functions (not starting with _) defined in the modules with profiled.
+    modules is a list of module names or modules, default is DEFAULT_MODULES.
+    The functions are replaced in the modules, so calls between the functions in the modules are measured as well,
+    as nested stages. Returns the names of the wrapped functions.
+    """
+    import importlib
+    if modules is None:
+        modules = DEFAULT_MODULES
+
+    wrapped = []
+    for module in modules:
+        if isinstance(module, str):
+            module = importlib.import_module(module)
+        for attribute, value in list(vars(module).items()):
+            if attribute.startswith('_') or not inspect.isfunction(value) or value.__module__ != module.__name__:
+                continue
+            key = (module.__name__, attribute)
+            if key in _originals:
+                continue
+            _originals[key] = value
+            setattr(module, attribute, profiled(value))
+            wrapped.append(module.__name__ + '.' + attribute)
+    return wrapped
+
+def uninstrument_modules():
+    """
+    This function restores the original functions in the modules wrapped by instrument_modules.
+    """
+    import importlib
+    for (module_name, attribute), function in _originals.items():
+        setattr(importlib.import_module(module_name), attribute, function)
+    _originals.clear()
+    return
+
+def reset_profile():
+    """
+    This function deletes all the recorded stages.
+    """
+    _records.clear()
+    return
+
+def get_profile():
+    """
+    This function returns the recorded stages as a dataframe, with one row per stage in the order they started.
+    """
+    profile = pd.DataFrame(_records, columns=['Stage', 'Depth', 'Wall time (s)', 'CPU time (s)', 'Peak memory (MB)',
+                                              'Rows in', 'Rows out', 'Error'])
+    return profile.astype({'Depth': 'int64', 'Wall time (s)': 'float64', 'CPU time (s)': 'float64',
+                           'Peak memory (MB)': 'float64', 'Rows in': 'Int64', 'Rows out': 'Int64'})
+
+def print_profile(max_depth=None):
+    """
+    This function prints the recorded stages as a table, with the names indented by the depth of the stage.
+    Stages deeper than max_depth are not printed.
+    """
+    profile = get_profile()
+    if max_depth is not None:
+        profile = profile[profile['Depth'] <= max_depth]
+    profile['Stage'] = ['  ' * depth + name for depth, name in zip(profile['Depth'], profile['Stage'])]
+    width = profile['Stage'].str.len().max() if len(profile) > 0 else 0
+    print(profile.drop(columns=['Depth']).to_string(index=False, justify='left', na_rep='',
+                                                    formatters={'Stage': lambda name: name.ljust(width)},
+                                                    float_format=lambda x: '{:.3f}'.format(x)))
+    return
+
+def save_profile(file_path):
+    """
+    This function saves the recorded stages as a JSON file, as a list with one object per stage.
+    """
+    folder = os.path.dirname(file_path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    profile = get_profile()
+    profile = profile.astype(object).where(profile.notna(), None)
+    with open(file_path, 'w') as f:
+        json.dump(profile.to_dict(orient='records'), f, indent=1, default=str)
+    return
@@ -0,0 +1,246 @@
+"""
+This module contains a lazy query builder over the datasets stored with dataset_module (by default the merged
+IDS7/DoseTrack data). A query is built step by step, and nothing is read before collect is called:
+
+    data = (bh_query.query(store_folder)
+            .procedures(['Caput Embolisering'])
+            .labs(['RRH_XA1', 'RRH_XA2'])
+            .dates('2020-01-01', '2024-12-31')
+            .select(['DAP Total (Gy*cm2)', 'CAK (mGy)'])
+            .collect())
+
+The filters are passed on to pyarrow as one expression. Filters on the date and the lab also select the partitions
+(Year, Month and Room), so only the parquet files of the matching months and labs are opened, and the other filters
+skip the row groups that can not match. Only the selected columns (and the columns needed to group) are read.
+explain shows which files a query will read, and how large a part of the dataset that is.
+
+-------------------------------- Functions: --------------------------------
+query:              Starts a new query over a dataset in the store folder.
+
+DoseQuery:          The query builder. Each method returns a new query, so a query can be reused as a base:
+                    procedures, labs, dates, age, sex:  Filters on the common columns.
+                    where:                              Filters on any column, e.g. where('F+A Time (s)', '>', 600).
+                    select:                             The columns to return.
+                    group_by:                           Groups the rows and aggregates the selected columns.
+                    explain:                            Returns the files and bytes the query will read.
+                    collect:                            Reads the data and returns a dataframe.
+-------------------------------------------------------------------------------------
+"""
+
+import os
+import copy
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import dataset_module as bh_data
+
+# The columns used by the filters on the merged data:
+PROCEDURE_COLUMN = 'Mapped Procedures'
+AGE_COLUMN = 'Age (Years)'
+SEX_COLUMN = 'Kjønn'
+
+# The operators that can be used in where:
+_OPERATORS = {'==': lambda field, value: field == value,
+              '!=': lambda field, value: field != value,
+              '<': lambda field, value: field < value,
+              '<=': lambda field, value: field <= value,
+              '>': lambda field, value: field > value,
+              '>=': lambda field, value: field >= value,
+              'in': lambda field, value: field.isin(list(value)),
+              'not in': lambda field, value: ~field.isin(list(value))}
+
+def _as_list(values):
+    """
+    This utility function returns a single value as a list with one element.
+    """
+    if isinstance(values, (list, tuple, set, pd.Index, pd.Series)):
+        return list(values)
+    return [values]
+
+class DoseQuery:
+    """
+    This class is a lazy query over one dataset ('ids7', 'dt' or 'merged') in the store folder of dataset_module.
+    The methods return new queries with one more step, and the data is only read when collect is called.
+    """
+
+    def __init__(self, store_folder, name='merged'):
+        self.store_folder = store_folder
+        self.name = name
+        self._row_filters = []
+        self._partition_filters = []
+        self._columns = None
+        self._group_by = None
+        self._aggregations = None
+
+    def _with(self, row_filter=None, partition_filter=None):
+        """
+        This utility function returns a copy of the query with one more row filter and/or partition filter.
+        """
+        new = copy.copy(self)
+        new._row_filters = self._row_filters + ([row_filter] if row_filter is not None else [])
+        new._partition_filters = self._partition_filters + ([partition_filter] if partition_filter is not None else [])
+        return new
+
+    def where(self, column, operator, value):
+        """
+        This function filters the rows on any column, with the operators ==, !=, <, <=, >, >=, in and not in.
+        """
+        if operator not in _OPERATORS:
+            print('WARNING: Unknown operator "' + str(operator) + '". Use one of: ' + ', '.join(_OPERATORS.keys()))
+            return self
+        return self._with(row_filter=_OPERATORS[operator](ds.field(column), value))
+
+    def procedures(self, procedures):
+        """
+        This function keeps the rows with the given mapped procedure(s).
+        """
+        return self.where(PROCEDURE_COLUMN, 'in', _as_list(procedures))
+
+    def labs(self, labs):
+        """
+        This function keeps the rows from the given lab(s). For the datasets partitioned by lab, only the
+        partitions of these labs are read.
+        """
+        labs = _as_list(labs)
+        room_column = bh_data.DATASETS[self.name]['room']
+        if room_column is None:
+            return self.where('Rom/modalitet (RIS)', 'in', labs)
+        return self._with(row_filter=ds.field(room_column).isin(labs), partition_filter=ds.field('Room').isin(labs))
+
+    def dates(self, start=None, end=None):
+        """
+        This function keeps the rows with a date from start to end (both included, as dates or strings).
+        A date without a time as end includes the whole day. Only the partitions of the months in the range are read.
+        """
+        date_column = bh_data.DATASETS[self.name]['date']
+        query = self
+        if start is not None:
+            start = pd.Timestamp(start)
+            query = query._with(row_filter=ds.field(date_column) >= pa.scalar(start.to_pydatetime()),
+                                partition_filter=(ds.field('Year') > start.year) |
+                                                 ((ds.field('Year') == start.year) & (ds.field('Month') >= start.month)))
+        if end is not None:
+            end = pd.Timestamp(end)
+            if end == end.normalize():
+                row_filter = ds.field(date_column) < pa.scalar((end + pd.Timedelta(days=1)).to_pydatetime())
+            else:
+                row_filter = ds.field(date_column) <= pa.scalar(end.to_pydatetime())
+            query = query._with(row_filter=row_filter,
+                                partition_filter=(ds.field('Year') < end.year) |
+                                                 ((ds.field('Year') == end.year) & (ds.field('Month') <= end.month)))
+        return query
+
+    def age(self, min_age=None, max_age=None):
+        """
+        This function keeps the rows with an age from min_age to max_age (both included).
+        """
+        query = self
+        if min_age is not None:
+            query = query.where(AGE_COLUMN, '>=', min_age)
+        if max_age is not None:
+            query = query.where(AGE_COLUMN, '<=', max_age)
+        return query
+
+    def sex(self, sex):
+        """
+        This function keeps the rows with the given value(s) in the column 'Kjønn', e.g. 'K' or 'M'.
+        """
+        return self.where(SEX_COLUMN, 'in', _as_list(sex))
+
+    def select(self, columns):
+        """
+        This function selects the columns to return. Only these columns are read from the files.
+        """
+        new = copy.copy(self)
+        new._columns = _as_list(columns)
+        return new
+
+    def group_by(self, by, aggregations=('count', 'median')):
+        """
+        This function groups the rows by the column(s) in by, and aggregates the selected columns with the
+        aggregations (any aggregation that pandas accepts, e.g. 'count', 'median', 'mean' or a function).
+        """
+        new = copy.copy(self)
+        new._group_by = _as_list(by)
+        new._aggregations = list(aggregations)
+        return new
+
+    def _dataset(self):
+        """
+        This utility function opens the dataset, without reading any data. Returns None if it does not exist.
+        """
+        if not bh_data._check_dataset_name(self.name):
+            return None
+        path = bh_data._dataset_path(self.store_folder, self.name)
+        if not os.path.exists(path):
+            print('WARNING: The dataset "' + self.name + '" does not exist in ' + str(self.store_folder))
+            return None
+        return ds.dataset(path, format='parquet', partitioning='hive')
+
+    def _expression(self, filters):
+        """
+        This utility function combines the filters into one expression (None if there are no filters).
+        """
+        expression = None
+        for expression_filter in filters:
+            expression = expression_filter if expression is None else expression & expression_filter
+        return expression
+
+    def _read_columns(self, dataset):
+        """
+        This utility function returns the columns to read: the selected columns and the columns to group by,
+        or all the columns except the partition columns.
+        """
+        if self._columns is None:
+            return [name for name in dataset.schema.names if name not in bh_data.PARTITION_COLUMNS]
+        columns = list(self._group_by or []) + [column for column in self._columns if column not in (self._group_by or [])]
+        return columns
+
+    def explain(self):
+        """
+        This function returns a dictionary with the files the query will read after the partitions have been
+        selected, their size in bytes, and the size of the whole dataset. Nothing is read from the files.
+        """
+        dataset = self._dataset()
+        if dataset is None:
+            return None
+        partition_filter = self._expression(self._partition_filters)
+        files = [fragment.path for fragment in dataset.get_fragments(filter=partition_filter)]
+        bytes_read = sum(os.path.getsize(path) for path in files)
+        bytes_total = sum(os.path.getsize(path) for path in dataset.files)
+        return {'Files': files, 'Number of files': len(files), 'Number of files in dataset': len(dataset.files),
+                'Bytes': bytes_read, 'Bytes in dataset': bytes_total,
+                'Fraction': bytes_read / bytes_total if bytes_total > 0 else 0.0,
+                'Filter': str(self._expression(self._partition_filters + self._row_filters))}
+
+    def collect(self):
+        """
+        This function runs the query: only the selected partitions and columns are read, the rows are filtered
+        by pyarrow while reading, and the result is grouped and aggregated if group_by has been used.
+        Returns a dataframe.
+        """
+        dataset = self._dataset()
+        if dataset is None:
+            return None
+        columns = self._read_columns(dataset)
+        missing = [column for column in columns if column not in dataset.schema.names]
+        if missing:
+            print('WARNING: The columns ' + ', '.join(missing) + ' do not exist in the dataset "' + self.name + '".')
+            columns = [column for column in columns if column not in missing]
+
+        table = dataset.to_table(columns=columns, filter=self._expression(self._partition_filters + self._row_filters))
+        df = table.to_pandas()
+        if self._group_by is None:
+            return df
+
+        metrics = [column for column in df.columns if column not in self._group_by]
+        if self._columns is None:
+            # Without select, only the numeric columns are aggregated:
+            metrics = [column for column in metrics if pd.api.types.is_numeric_dtype(df[column])]
+        return df.groupby(self._group_by, observed=True)[metrics].agg(self._aggregations)
+
+def query(store_folder, name='merged'):
+    """
+    This function starts a new query over the dataset with the given name ('ids7', 'dt' or 'merged') in the store folder.
+    """
+    return DoseQuery(store_folder, name=name)
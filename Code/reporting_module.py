@@ -1,24 +1,60 @@
 # This module contains utility function to report various properties of the data.
 
+import os
+import numpy as np
 import pandas as pd
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 
-def _calc_ci(data_vector, ci = 95, n = 10000):
+def _calc_ci(data_vector, ci = 95, n = 10000, seed = None, method = 'bootstrap', chunk_size = 2_000_000):
     """
     This function calculated the confidence interval of the median of the data_vector.
-    The default number of bootstrap samples is 1000.
+    Missing values are ignored.
+    With method = 'bootstrap' (default) n bootstrap samples are drawn at once as a matrix of indices, in chunks of
+    at most chunk_size elements to limit the memory use, and the medians of all samples are found in one operation.
+    Pass seed to get the same confidence interval every time.
+    With method = 'exact' the distribution free confidence interval of the median is calculated from the order
+    statistics of the data, using the binomial distribution. This needs no resampling.
     """
-    # Create an empty list to store the medians of the bootstrap samples:
-    medians = []
-    # Create a for loop to create the bootstrap samples:
-    for i in range(n):
-        # Create a bootstrap sample:
-        sample = data_vector.sample(frac=1, replace=True)
-        # Calculate the median of the bootstrap sample:
-        medians.append(sample.median())
-    # Create a pandas series of the medians:
-    ci = pd.Series(medians)
-    # Return the median and the confidence interval:
-    return ci.quantile(0.025), ci.quantile(0.975)
+    values = np.asarray(pd.Series(data_vector).dropna(), dtype=float)
+    if len(values) == 0:
+        return np.nan, np.nan
+    alpha = (100 - ci) / 100
+
+    if method == 'exact':
+        return _calc_ci_exact(values, alpha)
+
+    # Draw the bootstrap samples in chunks of rows of the index matrix.
+    # As the values are sorted, the median of a sample is given by the middle indices of the sample,
+    # so only the indices have to be partitioned:
+    values = np.sort(values)
+    m = len(values)
+    rng = np.random.default_rng(seed)
+    rows_per_chunk = max(1, chunk_size // m)
+    medians = np.empty(n)
+    for start in range(0, n, rows_per_chunk):
+        stop = min(n, start + rows_per_chunk)
+        index = np.partition(rng.integers(0, m, size=(stop - start, m), dtype=np.int32), [(m - 1) // 2, m // 2], axis=1)
+        medians[start:stop] = (values[index[:, (m - 1) // 2]] + values[index[:, m // 2]]) / 2
+    # Return the confidence interval:
+    return np.quantile(medians, alpha / 2), np.quantile(medians, 1 - alpha / 2)
+
+def _calc_ci_exact(values, alpha):
+    """
+    This function calculates the confidence interval of the median from the order statistics.
+    The number of values below the median follows a binomial distribution with p = 0.5, so the interval
+    between the r-th smallest and the r-th largest value covers the median with a probability of at least 1 - alpha,
+    when r is the largest number where P(B <= r - 1) <= alpha / 2. For very small samples (n < 6 for a 95% CI)
+    no such r exists, and the range of the data is returned.
+    """
+    values = np.sort(values)
+    m = len(values)
+    # The binomial distribution B(m, 0.5), calculated in log space to avoid underflow for large m:
+    k = np.arange(m)
+    log_pmf = np.concatenate(([0.0], np.cumsum(np.log((m - k) / (k + 1))))) - m * np.log(2)
+    cdf = np.cumsum(np.exp(log_pmf))
+    r = max(1, np.searchsorted(cdf, alpha / 2, side='right'))
+    return values[r - 1], values[m - r]
 
 def _format_min_sec(data_vector):
     """
@@ -36,107 +72,170 @@ def _format_min_sec(data_vector):
     return minutes, seconds
 
 
-def print_obs_per_lab(data):
-    for lab in data['Modality Room'].unique():
-        print(lab + ': n = ' + str(len(data[data['Modality Room'] == lab])))
+def calc_statistics(data, metrics, by=None, ci=False, ci_level=95, n_bootstrap=10000, seed=None, method='bootstrap', sort=True, n_workers=1):
+    """
+    This function calculates the summary statistics of the metric columns for each group in one groupby.
+    metrics is a column name or a list of column names, e.g. ['DAP Total (Gy*cm2)', 'CAK (mGy)'].
+    by is a column name or a list of column names to group by, e.g. 'Modality Room' or ['Mapped Procedures', 'Modality Room'].
+    If by is None, the statistics are calculated for all the data, in one row named 'All'.
+    The groups are sorted, unless sort is False, which keeps the order of the groups in the data.
+    Returns a dataframe with one row per group, and the columns (metric, statistic) where the statistics are:
+    n (number of rows in the group), median, q25, q75, min, max, and if ci is True, ci_lower and ci_upper,
+    the confidence interval of the median (see _calc_ci).
+    With n_workers > 1 the confidence intervals of the groups are calculated in parallel in a pool of processes.
+    """
+    if isinstance(metrics, str):
+        metrics = [metrics]
+    if by is None:
+        by = pd.Series('All', index=data.index, name='Group')
 
-def print_median_dap_per_lab(data):
-    for lab in data['Modality Room'].unique():
-        print(lab + ': DAP = ' + str(round(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'].median(), 1)) + ' Gy*cm2')
-
-def print_summary_per_lab(data, ci = False):
-    data = data.sort_values(by=['Modality Room'])
-    for lab in data['Modality Room'].unique():
-        if ci:
-            lci, uci = _calc_ci(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'])
-        print(lab + ': n = {:4}'.format(len(data[data['Modality Room'] == lab])) + \
-              ', DAP: Median - ' + str(round(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'].median(), 2)) + ' (Gy*cm2),' + \
-              (' 95% CI: [' + str(round(lci, 2)) + ' - ' + str(round(uci, 2)) + ']' if ci else '') + \
-              # 25 th percentile:
-              ' IQR [' + str(round(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'].quantile(0.25), 2)) + \
-              ' - ' + str(round(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'].quantile(0.75), 2)) + '], ' + \
-              'Range (' + str(round(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'].min(), 2)) + \
-              ' - ' + str(round(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'].max(), 2)) + ').')
-
-def print_summary_per_lab_inc_cak(data, ci = False):
-    data = data.sort_values(by=['Modality Room'])
-    for lab in data['Modality Room'].unique():
-        if ci:
-            lci, uci = _calc_ci(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'])
-        print(lab + ': n = {:4}'.format(len(data[data['Modality Room'] == lab])) + \
-              ', DAP: Median - ' + str(round(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'].median(), 2)) + ' (Gy*cm2),' + \
-              (' 95% CI: [' + str(round(lci, 2)) + ' - ' + str(round(uci, 2)) + ']' if ci else '') + \
-              # 25 th percentile:
-              ' IQR [' + str(round(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'].quantile(0.25), 2)) + \
-              ' - ' + str(round(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'].quantile(0.75), 2)) + '], ' + \
-              'Range (' + str(round(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'].min(), 2)) + \
-              ' - ' + str(round(data[data['Modality Room'] == lab]['DAP Total (Gy*cm2)'].max(), 2)) + ').')
-        if ci:
-            lci_cak, uci_cak = _calc_ci(data[data['Modality Room'] == lab]['CAK (mGy)'])
-        print(lab + ': n = {:4}'.format(len(data[data['Modality Room'] == lab])) + \
-              ', CAK: Median - ' + str(round(data[data['Modality Room'] == lab]['CAK (mGy)'].median(), 2)) + ' (mGy),' + \
-              (' 95% CI: [' + str(round(lci_cak, 2)) + ' - ' + str(round(uci_cak, 2)) + ']' if ci else '') + \
-              # 25 th percentile:
-              ' IQR [' + str(round(data[data['Modality Room'] == lab]['CAK (mGy)'].quantile(0.25), 2)) + \
-              ' - ' + str(round(data[data['Modality Room'] == lab]['CAK (mGy)'].quantile(0.75), 2)) + '], ' + \
-              'Range (' + str(round(data[data['Modality Room'] == lab]['CAK (mGy)'].min(), 2)) + \
-              ' - ' + str(round(data[data['Modality Room'] == lab]['CAK (mGy)'].max(), 2)) + ').')
-
-def print_summary(data, ci = False):
-    if ci:
-        lci, uci = _calc_ci(data['DAP Total (Gy*cm2)'])
+    grouped = data.groupby(by, sort=sort, observed=True)
+    size = grouped.size()
+    q25 = grouped[metrics].quantile(0.25)
+    q75 = grouped[metrics].quantile(0.75)
+    aggregated = grouped[metrics].agg(['median', 'min', 'max'])
 
-    print('Alle: n = {:4}'.format(len(data)) + ', DAP: Median - ' + str(round(data['DAP Total (Gy*cm2)'].median(), 1)) + ',' +\
-            (' 95% CI: [' + str(round(lci, 2)) + ' - ' + str(round(uci, 2)) + ']' if ci else '') + \
-            # 25 th percentile:
-            ' IQR [' + str(round(data['DAP Total (Gy*cm2)'].quantile(0.25), 1)) + \
-            ' - ' + str(round(data['DAP Total (Gy*cm2)'].quantile(0.75), 1)) + '], ' + \
-            'Range (' + str(round(data['DAP Total (Gy*cm2)'].min(), 1)) + \
-            ' - ' + str(round(data['DAP Total (Gy*cm2)'].max(), 1)) + ').')
+    statistics = {}
+    for metric in metrics:
+        statistics[(metric, 'n')] = size
+        statistics[(metric, 'median')] = aggregated[(metric, 'median')]
+        statistics[(metric, 'q25')] = q25[metric]
+        statistics[(metric, 'q75')] = q75[metric]
+        statistics[(metric, 'min')] = aggregated[(metric, 'min')]
+        statistics[(metric, 'max')] = aggregated[(metric, 'max')]
 
-def report_exposure_time_all(data, ci = False):
     if ci:
-        lci, uci = _calc_ci(data['F+A Time (s)'])
-    
-    median_min, median_sec = _format_min_sec(data['F+A Time (s)'].median())
-    
+        # Calculate the confidence interval for all metrics and groups, in parallel if n_workers > 1:
+        keys = list(grouped.indices.keys())
+        samples = [data[metric].to_numpy()[grouped.indices[key]] for metric in metrics for key in keys]
+        calc_ci = partial(_calc_ci, ci=ci_level, n=n_bootstrap, seed=seed, method=method)
+        if n_workers > 1 and len(samples) > 1:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                intervals = list(executor.map(calc_ci, samples))
+        else:
+            intervals = [calc_ci(sample) for sample in samples]
+
+        for i, metric in enumerate(metrics):
+            metric_intervals = pd.DataFrame(intervals[i * len(keys):(i + 1) * len(keys)], columns=['ci_lower', 'ci_upper'],
+                                            index=pd.Index(keys, tupleize_cols=True)).reindex(size.index)
+            statistics[(metric, 'ci_lower')] = metric_intervals['ci_lower']
+            statistics[(metric, 'ci_upper')] = metric_intervals['ci_upper']
+
+    statistics = pd.DataFrame(statistics, index=size.index)
+    statistics.columns = pd.MultiIndex.from_tuples(statistics.columns, names=['Metric', 'Statistic'])
+    return statistics
+
+def _format_summary(name, stats, metric, label, unit, decimals=2, ci=False):
+    """
+    This function formats one row of statistics from calc_statistics for one metric as a line of text.
+    """
+    s = stats[metric]
+    return name + ': n = {:4}'.format(int(s['n'])) + \
+           ', ' + label + ': Median - ' + str(round(s['median'], decimals)) + unit + ',' + \
+           (' 95% CI: [' + str(round(s['ci_lower'], 2)) + ' - ' + str(round(s['ci_upper'], 2)) + ']' if ci else '') + \
+           ' IQR [' + str(round(s['q25'], decimals)) + ' - ' + str(round(s['q75'], decimals)) + '], ' + \
+           'Range (' + str(round(s['min'], decimals)) + ' - ' + str(round(s['max'], decimals)) + ').'
+
+def _format_exposure_time(name, stats, ci=False):
+    """
+    This function formats one row of statistics from calc_statistics for the exposure time as a line of text,
+    with the times in minutes and seconds.
+    """
+    s = stats['F+A Time (s)']
+    median_min, median_sec = _format_min_sec(s['median'])
     if ci:
-        lci_min, lci_sec = _format_min_sec(lci)
-        uci_min, uci_sec = _format_min_sec(uci)
-    
-    lIQR_min, lIQR_sec = _format_min_sec(data['F+A Time (s)'].quantile(0.25))
-    uIQR_min, uIQR_sec = _format_min_sec(data['F+A Time (s)'].quantile(0.75))
-    lrange_min, lrange_sec = _format_min_sec(data['F+A Time (s)'].min())
-    urange_min, urange_sec = _format_min_sec(data['F+A Time (s)'].max())
-
-    print('All '+ ': n = {:4}'.format(len(data)) + \
-        ', Exposure time: Median - ' + median_min + ':' + median_sec + ' (min:s),' + \
-        (' 95% CI: [' + lci_min + ':' + lci_sec + ' - ' + uci_min + ':' + uci_sec + ']' if ci else '') + \
-        # 25 th percentile:
-        ' IQR [' + lIQR_min + ':' + lIQR_sec + ' - ' + uIQR_min + ':' + uIQR_sec + '], ' + \
-        'Range (' + lrange_min + ':' + lrange_sec + ' - '  + urange_min + ':' + urange_sec + ').')
-
-def report_exposure_time_per_lab(data, ci = False):
-    data = data.sort_values(by=['Modality Room'])
-    
-    for lab in data['Modality Room'].unique():
-        if ci:
-            lci, uci = _calc_ci(data[data['Modality Room'] == lab]['F+A Time (s)'])
-        
-        median_min, median_sec = _format_min_sec(data[data['Modality Room'] == lab]['F+A Time (s)'].median())
-        
-        if ci:
-            lci_min, lci_sec = _format_min_sec(lci)
-            uci_min, uci_sec = _format_min_sec(uci)
-        
-        lIQR_min, lIQR_sec = _format_min_sec(data[data['Modality Room'] == lab]['F+A Time (s)'].quantile(0.25))
-        uIQR_min, uIQR_sec = _format_min_sec(data[data['Modality Room'] == lab]['F+A Time (s)'].quantile(0.75))
-        lrange_min, lrange_sec = _format_min_sec(data[data['Modality Room'] == lab]['F+A Time (s)'].min())
-        urange_min, urange_sec = _format_min_sec(data[data['Modality Room'] == lab]['F+A Time (s)'].max())
-
-        print(lab + ': n = {:4}'.format(len(data[data['Modality Room'] == lab])) + \
+        lci_min, lci_sec = _format_min_sec(s['ci_lower'])
+        uci_min, uci_sec = _format_min_sec(s['ci_upper'])
+    lIQR_min, lIQR_sec = _format_min_sec(s['q25'])
+    uIQR_min, uIQR_sec = _format_min_sec(s['q75'])
+    lrange_min, lrange_sec = _format_min_sec(s['min'])
+    urange_min, urange_sec = _format_min_sec(s['max'])
+
+    return name + ': n = {:4}'.format(int(s['n'])) + \
         ', Exposure time: Median - ' + median_min + ':' + median_sec + ' (min:s),' + \
         (' 95% CI: [' + lci_min + ':' + lci_sec + ' - ' + uci_min + ':' + uci_sec + ']' if ci else '') + \
-        # 25 th percentile:
         ' IQR [' + lIQR_min + ':' + lIQR_sec + ' - ' + uIQR_min + ':' + uIQR_sec + '], ' + \
-        'Range (' + lrange_min + ':' + lrange_sec + ' - '  + urange_min + ':' + urange_sec + ').')
\ No newline at end of file
+        'Range (' + lrange_min + ':' + lrange_sec + ' - '  + urange_min + ':' + urange_sec + ').'
+
+def print_obs_per_lab(data):
+    for lab, n in data.groupby('Modality Room', sort=False, observed=True).size().items():
+        print(lab + ': n = ' + str(n))
+
+def print_median_dap_per_lab(data):
+    stats = calc_statistics(data, 'DAP Total (Gy*cm2)', by='Modality Room', sort=False)
+    for lab, s in stats.iterrows():
+        print(lab + ': DAP = ' + str(round(s[('DAP Total (Gy*cm2)', 'median')], 1)) + ' Gy*cm2')
+
+def print_summary_per_lab(data, ci = False, seed = None):
+    stats = calc_statistics(data, 'DAP Total (Gy*cm2)', by='Modality Room', ci=ci, seed=seed)
+    for lab, s in stats.iterrows():
+        print(_format_summary(lab, s, 'DAP Total (Gy*cm2)', 'DAP', ' (Gy*cm2)', ci=ci))
+
+def print_summary_per_lab_inc_cak(data, ci = False, seed = None):
+    stats = calc_statistics(data, ['DAP Total (Gy*cm2)', 'CAK (mGy)'], by='Modality Room', ci=ci, seed=seed)
+    for lab, s in stats.iterrows():
+        print(_format_summary(lab, s, 'DAP Total (Gy*cm2)', 'DAP', ' (Gy*cm2)', ci=ci))
+        print(_format_summary(lab, s, 'CAK (mGy)', 'CAK', ' (mGy)', ci=ci))
+
+def print_summary(data, ci = False, seed = None):
+    stats = calc_statistics(data, 'DAP Total (Gy*cm2)', ci=ci, seed=seed)
+    print(_format_summary('Alle', stats.iloc[0], 'DAP Total (Gy*cm2)', 'DAP', '', decimals=1, ci=ci))
+
+def report_exposure_time_all(data, ci = False, seed = None):
+    stats = calc_statistics(data, 'F+A Time (s)', ci=ci, seed=seed)
+    print(_format_exposure_time('All ', stats.iloc[0], ci=ci))
+
+def report_exposure_time_per_lab(data, ci = False, seed = None):
+    stats = calc_statistics(data, 'F+A Time (s)', by='Modality Room', ci=ci, seed=seed)
+    for lab, s in stats.iterrows():
+        print(_format_exposure_time(lab, s, ci=ci))
+
+def build_drl_table(data, metrics=None, procedures=None, include_all_labs=True, ci=True, ci_level=95, n_bootstrap=10000,
+                    seed=None, method='bootstrap', n_workers=None, output=None):
+    """
+    This function builds a table for local diagnostic reference levels (DRL) for all procedures and labs at once.
+    The statistics (n, median, IQR, range and the confidence interval of the median) are calculated with
+    calc_statistics for each combination of 'Mapped Procedures' and 'Modality Room'. If include_all_labs is True,
+    a row with all labs together (Modality Room = 'Alle') is added for each procedure.
+    The default metrics are 'DAP Total (Gy*cm2)', 'CAK (mGy)' and 'F+A Time (s)', if they exist in the data.
+    The default procedures are all mapped procedures except 'Unmapped'.
+    The confidence intervals are calculated in parallel in n_workers processes (default is the number of CPUs).
+    If output is given, the table is written to this file, as CSV, parquet or Excel depending on the file
+    extension (.csv, .parquet or .xlsx).
+    Returns the table with one row per procedure and lab, and the columns (metric, statistic).
+    """
+    if metrics is None:
+        metrics = [metric for metric in ['DAP Total (Gy*cm2)', 'CAK (mGy)', 'F+A Time (s)'] if metric in data.columns]
+    if procedures is None:
+        procedures = [procedure for procedure in data['Mapped Procedures'].dropna().unique() if procedure != 'Unmapped']
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+
+    data = data[data['Mapped Procedures'].isin(procedures)]
+    frames = [data]
+    if include_all_labs:
+        frames.append(data.assign(**{'Modality Room': 'Alle'}))
+    data = pd.concat(frames, ignore_index=True)
+    data['Mapped Procedures'] = data['Mapped Procedures'].astype(str)
+    data['Modality Room'] = data['Modality Room'].astype(str)
+
+    table = calc_statistics(data, metrics, by=['Mapped Procedures', 'Modality Room'], ci=ci, ci_level=ci_level,
+                            n_bootstrap=n_bootstrap, seed=seed, method=method, n_workers=n_workers)
+
+    if output is not None:
+        if os.path.dirname(output) and not os.path.exists(os.path.dirname(output)):
+            os.makedirs(os.path.dirname(output))
+        # Flatten the columns to 'metric statistic' for the file:
+        table_out = table.copy()
+        table_out.columns = [metric + ' ' + statistic for metric, statistic in table_out.columns]
+        table_out = table_out.reset_index()
+        if output.endswith('.csv'):
+            table_out.to_csv(output, index=False)
+        elif output.endswith('.parquet'):
+            table_out.to_parquet(output, index=False)
+        elif output.endswith('.xlsx'):
+            table_out.to_excel(output, index=False)
+        else:
+            print('WARNING: Unknown file extension for ' + output + '. Use .csv, .parquet or .xlsx.')
+
+    return table